@@ -23,10 +23,11 @@ Data files will download to the pywrds/output directory.  Have fun.
 
 
 thisAlgorithmBecomingSkynetCost = 99999999999
-__all__ = ["ectools", "ivorylib", "wrdslib", "wrds_loop", "get_wrds", "find_wrds", "setup_wrds_key"]
-from . import ectools, wrdslib, ivorylib
+__all__ = ["ectools", "ivorylib", "wrdslib", "wrds_loop", "get_wrds", "find_wrds", "setup_wrds_key", "read"]
+from . import ectools, wrdslib, ivorylib, reader
 
 get_wrds = ectools.get_wrds
 wrds_loop = ectools.wrds_loop
 find_wrds = ectools.find_wrds
-setup_wrds_key = wrdslib.setup_wrds_key
\ No newline at end of file
+setup_wrds_key = wrdslib.setup_wrds_key
+read = reader.read
\ No newline at end of file
@@ -0,0 +1,506 @@
+__author__ = 'cpt'
+"""
+Typed columnar copies of the tsv files downloaded by pywrds.
+
+Reading a tsv means splitting every line on tabs and parsing every field
+again, each time the file is used.  convert_file does this once and
+stores the typed columns next to the tsv, under the same name as given by
+utility.fix_input_name, e.g. crsp_dsf200801.tsv becomes
+
+- crsp_dsf200801.parquet, with one row group per ROW_GROUP_SIZE rows, if
+  pyarrow is installed, or
+- crsp_dsf200801.cols/, a directory holding one .npy file per column and
+  a _schema.json, if only numpy is installed.  The .npy files can be
+  opened with numpy.load(..., mmap_mode='r').
+
+The tsv is read ROW_GROUP_SIZE rows at a time, so memory use does not
+grow with the size of the file.  Column types are inferred from the
+header and the first SAMPLE_ROWS rows: int, float, date or str.  Dates
+are the dataset's date variable (or columns named like one) when they
+hold yyyymmdd values, and any column in SAS's DATE9. format, e.g.
+02JAN2008.  SAS missing values ('.', '.A' to '.Z', '._' or blank) become
+NaN, NaT or null.  If a later row does not fit the inferred type, the
+column is widened (int to float, anything to str) and the conversion
+starts again.
+"""
+
+import csv
+import itertools
+import json
+import os
+import re
+import shutil
+import string
+
+from . import utility
+
+
+# Rows converted at once, and rows per parquet row group.
+ROW_GROUP_SIZE = 2**20
+
+# Rows read to infer the column types.
+SAMPLE_ROWS = 10000
+
+# Encoding used to decode str columns for parquet.  latin-1 maps every
+# byte to a character, so decoding never fails and can be undone.
+ENCODING = 'latin-1'
+
+# Name of the schema file in a .cols directory.
+SCHEMA_FILE = '_schema.json'
+
+FORMATS = ['parquet', 'npy']
+
+# Extension of the cache of a tsv file in each format.
+EXTENSIONS = {'parquet': '.parquet', 'npy': '.cols'}
+
+# How a column is widened when a value does not fit its type.
+PROMOTIONS = {'int': 'float', 'float': 'str', 'ymd': 'str', 'date9': 'str'}
+
+MISSING = [b'', b'.', b'._'] + [b'.' + x.encode('ascii')
+                                for x in string.ascii_uppercase]
+
+MONTHS = dict((x.encode('ascii'), i + 1) for (i, x) in enumerate(
+    ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+     'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']))
+
+
+def default_format():
+    """Returns the best columnar format the installed packages allow,
+    or None if numpy is missing.
+
+    :return fmt: 'parquet', 'npy' or None
+    """
+    if has_modules['pyarrow']:
+        return 'parquet'
+    if has_modules['numpy']:
+        return 'npy'
+    return None
+
+
+def cache_path(path2file, fmt):
+    """Returns the path of the columnar copy of the tsv file path2file.
+
+    :param path2file:
+    :param fmt: 'parquet' or 'npy'.
+    :return cache_path:
+    """
+    return re.sub('\.tsv$', '', path2file) + EXTENSIONS[fmt]
+
+
+def read_schema(cache):
+    """Returns the schema stored with a columnar copy, a dict with keys
+    'columns', 'kinds', 'date_var', 'n_rows', 'source_size' and
+    'source_mtime', or None if cache does not exist.
+
+    :param cache: path of a .parquet file or .cols directory.
+    :return schema:
+    """
+    if not os.path.exists(cache):
+        return None
+    try:
+        if cache.endswith(EXTENSIONS['parquet']):
+            metadata = pq.ParquetFile(cache).metadata
+            schema = json.loads(
+                metadata.metadata[b'pywrds'].decode('ascii'))
+            schema['n_rows'] = metadata.num_rows
+            return schema
+        with open(os.path.join(cache, SCHEMA_FILE), 'r') as fd:
+            return json.loads(fd.read())
+    except (IOError, KeyError, TypeError, ValueError):
+        return None
+
+
+def is_current(path2file, fmt):
+    """Checks whether the columnar copy of path2file was made from the
+    tsv as it is now.
+
+    :param path2file:
+    :param fmt:
+    :return current (bool):
+    """
+    schema = read_schema(cache_path(path2file, fmt))
+    if schema is None:
+        return 0
+    stat = os.stat(path2file)
+    return int(schema['source_size'] == stat.st_size
+               and schema['source_mtime'] == stat.st_mtime)
+
+
+def infer_schema(path2file, dataset=None, n_sample=SAMPLE_ROWS):
+    """Reads the header and the first n_sample rows of path2file and
+    guesses the type of each column.
+
+    :param path2file:
+    :param dataset: e.g. 'crsp.dsf', used to find the date variable.
+    :param n_sample:
+    :return [columns, kinds]: kinds are 'int', 'float', 'ymd' (yyyymmdd
+        dates), 'date9' (DATE9. dates) or 'str'.
+    """
+    columns = read_header(path2file)
+    kinds = ['str'] * len(columns)
+    for values in _iter_row_groups(path2file, len(columns), n_sample):
+        kinds = [_infer_kind(name, x, dataset)
+                 for (name, x) in zip(columns, values)]
+        break
+    return [columns, kinds]
+
+
+def read_header(path2file):
+    """Returns the column names in the header line of path2file.
+
+    :param path2file:
+    :return columns:
+    """
+    with open(path2file, 'rb') as fd:
+        header = fd.readline()
+    return [x.decode(ENCODING) for x in _split_line(header)]
+
+
+def convert_file(path2file, dataset=None, fmt=None,
+                 row_group_size=ROW_GROUP_SIZE):
+    """Writes the columnar copy of the tsv file path2file, unless an up
+    to date copy exists already.
+
+    :param path2file:
+    :param dataset: e.g. 'crsp.dsf', used to find the date variable.
+    :param fmt: 'parquet' or 'npy', defaults to default_format().
+    :param row_group_size:
+    :return cache: path of the copy, or None if it could not be written.
+    """
+    if fmt is None:
+        fmt = default_format()
+    if fmt not in FORMATS or not has_modules['numpy'] or (
+            fmt == 'parquet' and not has_modules['pyarrow']):
+        print('convert_file: the "' + str(fmt) + '" format requires the '
+              'packages numpy and, for parquet, pyarrow.  Please "pip '
+              'install numpy pyarrow".')
+        return None
+    cache = cache_path(path2file, fmt)
+    if is_current(path2file, fmt):
+        return cache
+
+    [columns, kinds] = infer_schema(path2file, dataset)
+    stat = os.stat(path2file)
+    schema = {'columns': columns,
+              'kinds': kinds,
+              'date_var': _date_var(columns, kinds, dataset),
+              'n_rows': 0,
+              'source_size': stat.st_size,
+              'source_mtime': stat.st_mtime}
+    writer = {'parquet': _write_parquet, 'npy': _write_npy}[fmt]
+    while True:
+        try:
+            n_rows = writer(path2file, cache + '--writing', schema,
+                            row_group_size)
+            break
+        except _Promote as err:
+            # The inferred type was too narrow: widen it and start over.
+            schema['kinds'][err.index] = \
+                err.kind or PROMOTIONS[schema['kinds'][err.index]]
+            schema['date_var'] = _date_var(columns, schema['kinds'], dataset)
+
+    if os.path.isdir(cache):
+        shutil.rmtree(cache)
+    elif os.path.exists(cache):
+        os.remove(cache)
+    os.rename(cache + '--writing', cache)
+    return cache
+
+
+class _Promote(Exception):
+    """Raised when the column at index holds a value that does not fit its
+    inferred type.  kind, if given, is the kind to promote the column to,
+    instead of the next one in PROMOTIONS."""
+
+    def __init__(self, index, kind=None):
+        Exception.__init__(self, index)
+        self.index = index
+        self.kind = kind
+
+
+def _write_parquet(path2file, out_path, schema, row_group_size):
+    """Writes the columns of path2file to the parquet file out_path, one
+    row group per row_group_size rows.
+
+    :return n_rows:
+    """
+    fields = [pa.field(x, _arrow_type(kind))
+              for (x, kind) in zip(schema['columns'], schema['kinds'])]
+    # n_rows is left out, the parquet footer has it.
+    metadata = {b'pywrds': json.dumps(schema).encode('ascii')}
+    arrow_schema = pa.schema(fields, metadata=metadata)
+    n_rows = 0
+    writer = pq.ParquetWriter(out_path, arrow_schema)
+    try:
+        for values in _iter_row_groups(path2file, len(fields),
+                                       row_group_size):
+            arrays = []
+            for (i, kind) in enumerate(schema['kinds']):
+                [data, missing] = _to_array(values[i], kind, i)
+                if kind == 'str':
+                    data = numpy.char.decode(data, ENCODING)
+                arrays.append(pa.array(data, type=fields[i].type,
+                                       mask=missing))
+            writer.write_table(pa.Table.from_arrays(arrays,
+                                                    schema=arrow_schema))
+            n_rows += len(values[0])
+    finally:
+        writer.close()
+    return n_rows
+
+
+def _write_npy(path2file, out_path, schema, row_group_size):
+    """Writes each column of path2file to out_path/<column>.npy.  The
+    arrays are preallocated from the file's line count and filled one row
+    group at a time.
+
+    :return n_rows:
+    """
+    if os.path.isdir(out_path):
+        shutil.rmtree(out_path)
+    os.makedirs(out_path)
+    n_rows = utility.get_n_lines(path2file)
+    arrays = [None] * len(schema['columns'])
+    start = 0
+    for values in _iter_row_groups(path2file, len(arrays), row_group_size):
+        stop = start + len(values[0])
+        for (i, kind) in enumerate(schema['kinds']):
+            [data, missing] = _to_array(values[i], kind, i)
+            path = os.path.join(out_path, schema['columns'][i] + '.npy')
+            if arrays[i] is None or arrays[i].dtype.itemsize < \
+                    data.dtype.itemsize:
+                arrays[i] = _reopen(path, arrays[i], data.dtype, n_rows, start)
+            arrays[i][start:stop] = data
+        start = stop
+
+    for (i, kind) in enumerate(schema['kinds']):
+        path = os.path.join(out_path, schema['columns'][i] + '.npy')
+        if arrays[i] is None:
+            dtype = _to_array([], kind, i)[0].dtype
+            arrays[i] = _reopen(path, None, dtype, 0, 0)
+        if start != n_rows:
+            # Blank lines were counted by get_n_lines but not converted.
+            arrays[i] = _reopen(path, arrays[i], arrays[i].dtype, start, start)
+        arrays[i].flush()
+    schema['n_rows'] = start
+    with open(os.path.join(out_path, SCHEMA_FILE), 'w') as fd:
+        fd.write(json.dumps(schema))
+    return start
+
+
+def _reopen(path, old, dtype, n_rows, n_filled):
+    """Creates the .npy file path with n_rows rows of dtype, copying the
+    first n_filled rows of the memmap old, if any, e.g. to widen a str
+    column.
+
+    :return new: writable memmap of path.
+    """
+    new = numpy.lib.format.open_memmap(path + '--new', mode='w+',
+                                       dtype=dtype, shape=(n_rows,))
+    if old is not None:
+        for start in range(0, n_filled, ROW_GROUP_SIZE):
+            stop = min(start + ROW_GROUP_SIZE, n_filled)
+            new[start:stop] = old[start:stop]
+        del old
+    new.flush()
+    del new
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '--new', path)
+    return numpy.lib.format.open_memmap(path, mode='r+')
+
+
+def _iter_row_groups(path2file, n_cols, row_group_size):
+    """Yields the rows of path2file after the header, row_group_size rows
+    at a time, as a list of n_cols lists of raw field values.
+
+    :param path2file:
+    :param n_cols:
+    :param row_group_size:
+    :return:
+    """
+    with open(path2file, 'rb') as fd:
+        fd.readline()
+        while True:
+            lines = list(itertools.islice(fd, row_group_size))
+            if not lines:
+                break
+            yield _split_lines(lines, n_cols)
+
+
+def _split_lines(lines, n_cols):
+    """Splits lines into n_cols lists of field values, skipping blank
+    lines.
+
+    In the usual case of no quotes, no '\r' and no blank lines, the whole
+    group is split at once and each column is a slice of the result.
+
+    :param lines:
+    :param n_cols:
+    :return values:
+    """
+    text = b''.join(lines)
+    if not (b'"' in text or b'\r' in text or b'\n\n' in text):
+        fields = text[:len(text) - text.endswith(b'\n')].replace(
+            b'\n', b'\t').split(b'\t')
+        if len(fields) == len(lines) * n_cols:
+            return [fields[i::n_cols] for i in range(n_cols)]
+    rows = []
+    for line in lines:
+        fields = _split_line(line)
+        if fields == [b'']:
+            continue
+        if len(fields) != n_cols:
+            fields = (fields + [b''] * n_cols)[:n_cols]
+        rows.append(fields)
+    return [list(x) for x in zip(*rows)] or [[] for i in range(n_cols)]
+
+
+def _split_line(line):
+    """Splits a tsv line into its fields, undoing the quotes proc export
+    puts around values that contain a tab or a quote.
+
+    :param line:
+    :return fields: list of bytes
+    """
+    line = line.rstrip(b'\r\n')
+    if b'"' not in line:
+        return line.split(b'\t')
+    if str is bytes:
+        return next(csv.reader([line], delimiter='\t'))
+    text = line.decode(ENCODING)
+    return [x.encode(ENCODING) for x in next(csv.reader([text],
+                                                        delimiter='\t'))]
+
+
+def _infer_kind(name, values, dataset=None):
+    """Returns the narrowest kind that fits all of values.
+
+    :param name: column name.
+    :param values: sample of raw field values.
+    :param dataset:
+    :return kind:
+    """
+    candidates = ['int', 'float', 'date9', 'str']
+    if _is_date_name(name, dataset):
+        candidates.insert(0, 'ymd')
+    present = [x for x in values if x not in MISSING]
+    if not present:
+        return 'float'
+    if any(x[:1] == b'0' and x[1:].isdigit() for x in present):
+        # Codes such as GVKEY 001004 would lose their leading zeros.
+        candidates = ['str']
+    for kind in candidates:
+        try:
+            _to_array(present, kind)
+            return kind
+        except _Promote as err:
+            if err.kind is not None:
+                return err.kind
+    return 'str'
+
+
+def _is_date_name(name, dataset=None):
+    if dataset and name.lower() == utility.wrds_datevar(dataset).lower():
+        return 1
+    return int(re.search('date|dats$', name, re.I) is not None)
+
+
+def _date_var(columns, kinds, dataset=None):
+    """Returns the date column the reader filters on: the dataset's date
+    variable if it was parsed as a date, else the first date column."""
+    dates = [x for (x, kind) in zip(columns, kinds)
+             if kind in ['ymd', 'date9']]
+    if dataset:
+        datevar = utility.wrds_datevar(dataset).lower()
+        for name in dates:
+            if name.lower() == datevar:
+                return name
+    if dates:
+        return dates[0]
+    return None
+
+
+def _arrow_type(kind):
+    return {'int': pa.int64(), 'float': pa.float64(), 'ymd': pa.date32(),
+            'date9': pa.date32(), 'str': pa.string()}[kind]
+
+
+def _to_array(values, kind, index=None):
+    """Converts raw field values to a numpy array of the type for kind.
+
+    :param values: list of bytes.
+    :param kind:
+    :param index: column index, reported if values do not fit kind.
+    :return [data, missing]: missing is a boolean mask, or None if no
+        value can be missing.
+    """
+    raw = numpy.array(values, dtype='S')
+    if kind == 'str':
+        if not len(raw):
+            raw = raw.astype('S1')
+        return [raw, None]
+    missing = numpy.isin(raw, MISSING)
+    try:
+        if kind == 'int':
+            try:
+                data = raw[~missing].astype(numpy.int64)
+            except OverflowError:
+                # As floats such ids or codes would silently lose digits.
+                raise _Promote(index, 'str')
+            if missing.any():
+                raise ValueError('missing value')
+            return [data, None]
+        if kind == 'float':
+            raw = numpy.where(missing, b'nan', raw)
+            return [raw.astype(numpy.float64), missing]
+        if kind == 'ymd':
+            raw = numpy.where(missing, b'19700101', raw)
+            if raw.dtype.itemsize != 8 or not numpy.char.isdigit(raw).all():
+                raise ValueError('not yyyymmdd')
+            ymd = raw.astype(numpy.int64)
+        else:
+            ymd = numpy.array([_date9_to_ymd(x) for x in raw], numpy.int64)
+            ymd[missing] = 19700101
+        data = _ymd_to_datetime64(ymd)
+    except (ValueError, TypeError, KeyError, OverflowError):
+        raise _Promote(index)
+    data[missing] = numpy.datetime64('NaT')
+    return [data, missing]
+
+
+def _date9_to_ymd(value):
+    if not value or value in MISSING:
+        return 19700101
+    if len(value) != 9 or not (value[:2].isdigit() and value[5:].isdigit()):
+        raise ValueError('not a DATE9. value')
+    return (int(value[5:]) * 10000 + MONTHS[value[2:5].upper()] * 100
+            + int(value[:2]))
+
+
+def _ymd_to_datetime64(ymd):
+    [year, month, day] = [ymd // 10000, ymd // 100 % 100, ymd % 100]
+    if ((month < 1) | (month > 12) | (day < 1) | (day > 31)).any():
+        raise ValueError('invalid date')
+    months = (year - 1970) * 12 + month - 1
+    data = (months.astype('datetime64[M]').astype('datetime64[D]')
+            + (day - 1).astype('timedelta64[D]'))
+    if (data.astype('datetime64[M]') != months.astype('datetime64[M]')).any():
+        raise ValueError('invalid date')
+    return data
+
+
+has_modules = {}
+try:
+    import numpy
+    import numpy.lib.format
+    has_modules['numpy'] = 1
+except ImportError:
+    has_modules['numpy'] = 0
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    has_modules['pyarrow'] = 1
+except ImportError:
+    has_modules['pyarrow'] = 0
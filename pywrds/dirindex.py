@@ -0,0 +1,172 @@
+__author__ = 'cpt'
+"""
+In-memory index of the files in a download directory.
+
+get_wrds, wrds_loop and recombine_files ask whether a period or row-chunk
+has been downloaded once per period and chunk.  Listing the directory and
+matching every name against a pattern for each of these questions grows
+quadratically with the number of files, so the directory is listed once
+into a DownloadIndex and later questions are answered from a set of
+names and a dict of row-chunks by dataset and period.
+
+utility.move_file, remove_file and combine_tsv_files report the files
+they create and remove through file_added and file_removed, which keeps
+every index of the directory up to date.  Files changed in the directory
+by other means are only seen after DownloadIndex.refresh, or after reset,
+which wrds_loop calls when it starts.
+"""
+
+import os
+import re
+import threading
+
+
+# Row-chunks of a period, e.g. crsp_dsf2008rows1to10000000.tsv; the
+# period name is everything before 'rows'.
+CHUNK_PATTERN = re.compile('^(.*)rows_?([0-9]+)_?to_?([0-9]+)\.tsv$')
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class DownloadIndex(object):
+    """Names of the files in the directory dname, with the row-chunks
+    grouped by the name of the period file they belong to.
+
+    All methods may be called from several threads at once.
+    """
+
+    def __init__(self, dname):
+        self.dname = dname
+        self._lock = threading.Lock()
+        self._files = set()
+        # period name (without .tsv) -> {first_row: [first_row, last_row,
+        # fname]}
+        self._chunks = {}
+        self.refresh()
+
+    def refresh(self):
+        """Lists the directory again, e.g. after files were added or
+        removed outside of pywrds.
+
+        :return:
+        """
+        fnames = []
+        if os.path.isdir(self.dname):
+            # Otherwise files are added as they are written, see file_added.
+            fnames = os.listdir(self.dname)
+        with self._lock:
+            self._files = set()
+            self._chunks = {}
+            for fname in fnames:
+                self._add(fname)
+
+    def exists(self, fname):
+        """Checks whether the directory holds a file named fname.
+
+        :param fname:
+        :return (bool):
+        """
+        return fname in self._files
+
+    def __contains__(self, fname):
+        return fname in self._files
+
+    def chunks(self, period_name):
+        """Lists the row-chunks of a period, e.g. for period_name
+        'crsp_dsf2008' the files crsp_dsf2008rows1to10000000.tsv, ...
+
+        :param period_name: name of the period file without '.tsv'.
+        :return chunks: list of [first_row, last_row, fname], sorted by
+            first_row.
+        """
+        with self._lock:
+            chunks = list(self._chunks.get(period_name, {}).values())
+        return sorted(chunks)
+
+    def add(self, fname):
+        """Records that the file fname was created in the directory.
+
+        :param fname:
+        :return:
+        """
+        with self._lock:
+            self._add(fname)
+
+    def discard(self, fname):
+        """Records that the file fname was removed from the directory.
+
+        :param fname:
+        :return:
+        """
+        with self._lock:
+            self._files.discard(fname)
+            match = CHUNK_PATTERN.match(fname)
+            if match:
+                chunks = self._chunks.get(match.group(1), {})
+                first_row = int(match.group(2))
+                if chunks.get(first_row, [0, 0, None])[2] == fname:
+                    del chunks[first_row]
+                if not chunks:
+                    self._chunks.pop(match.group(1), None)
+
+    def _add(self, fname):
+        self._files.add(fname)
+        match = CHUNK_PATTERN.match(fname)
+        if match:
+            [first_row, last_row] = [int(match.group(2)),
+                                     int(match.group(3))]
+            self._chunks.setdefault(match.group(1), {})[first_row] = \
+                [first_row, last_row, fname]
+
+
+def get_index(dname):
+    """Returns the DownloadIndex of the directory dname, listing the
+    directory on first use.
+
+    :param dname:
+    :return index: DownloadIndex
+    """
+    key = os.path.abspath(dname)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = DownloadIndex(dname)
+        return _indexes[key]
+
+
+def file_added(path2file):
+    """Adds path2file to the index of its directory, if there is one.
+
+    :param path2file:
+    :return:
+    """
+    [dname, fname] = os.path.split(os.path.abspath(path2file))
+    index = _indexes.get(dname)
+    if index is not None:
+        index.add(fname)
+
+
+def file_removed(path2file):
+    """Removes path2file from the index of its directory, if there is one.
+
+    :param path2file:
+    :return:
+    """
+    [dname, fname] = os.path.split(os.path.abspath(path2file))
+    index = _indexes.get(dname)
+    if index is not None:
+        index.discard(fname)
+
+
+def reset(dname):
+    """Drops the indexes of dname and of the directories below it, so that
+    each is listed again on its next use.
+
+    :param dname:
+    :return:
+    """
+    top = os.path.abspath(dname)
+    with _indexes_lock:
+        for key in list(_indexes.keys()):
+            if key == top or key.startswith(os.path.join(top, '')):
+                del _indexes[key]
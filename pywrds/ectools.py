@@ -14,7 +14,7 @@ thisAlgorithmBecomingSkynetCost = 99999999999  # http://xkcd.com/534/
 import datetime, math, os, re, shutil, sys, time
 import paramiko
 
-from . import sshlib, wrdslib
+from . import saslog, sshlib, utility, wrdslib
 from _wrds_db_descriptors import AUTOEXEC_TEXT
 
 getSSH = sshlib.getSSH
@@ -41,59 +41,7 @@ def get_numlines_from_log(outfile, dname=_dlpath):
 
     return logfile_lines
     """
-    log_lines = -1
-    sasfile = 'wrds_export_'+re.sub('\.tsv$','.log',outfile)
-    if not os.path.exists(os.path.join(dname,sasfile)):
-        partial_fname = re.sub('[0-9]*rows.*','',sasfile)
-        sasfile2 = partial_fname+'_'+re.sub(partial_fname,'',sasfile)
-        if os.path.exists(os.path.join(dname,sasfile2)):
-            sasfile = sasfile2
-        all_fname = re.sub('rows', '_allrows', sasfile)
-        if os.path.exists(os.path.join(dname, all_fname)):
-            sasfile = all_fname
-
-    if os.path.exists(os.path.join(dname,sasfile)):
-        fd = open(os.path.join(dname,sasfile))
-        fsize = os.stat(fd.name).st_size
-        while fd.tell() < fsize:
-            fline = fd.readline()
-            if re.search('^[0-9]* records created in ',fline):
-                log_lines = re.split(' records created in ',fline)[0]
-                log_lines = int(float(log_lines))
-                break
-
-            pattern0 = ('NOTE: The data set WORK\.NEW_DATA '
-                +'has [0-9]* observations')
-            if re.search(pattern0,fline):
-                pattern01 = 'NOTE: The data set WORK\.NEW_DATA has '
-                pattern02 = ' observations'
-                split_log = re.split(pattern02,fline)[0]
-                log_lines = re.split(pattern01, split_log)[-1]
-                log_lines = int(float(log_lines))
-                break
-
-            pattern1 = 'NOTE: [0-9]* records were written to the file'
-            if re.search(pattern1,fline):
-                split_log = re.split('NOTE: ',fline)[-1]
-                log_lines = re.split('records',split_log)[0]
-                log_lines = int(float(log_lines))
-                break
-
-            # The numbers given by the pattern below are often     #
-            # one row lower than the numbers given by the above    #
-            # patterns, the latter being the desired answer.       #
-            # This code is kept as an option to re-implement       #
-            # should their arise cases where none of the other     #
-            # patterns are found.                                  #
-            #pattern2 = 'NOTE: There were [0-9]* observations read'
-            #if re.search(pattern2,fline):
-            #	split_log = re.split(' observations read',fline)[0]
-            #	log_lines = re.split('NOTE: There were ',split_log)[-1]
-            #	log_lines = int(float(log_lines))
-            #	break
-        fd.close()
-
-    return log_lines
+    return utility.get_n_lines_from_log(outfile, dname)
 
 
 def _rename_after_download():
@@ -175,14 +123,14 @@ def get_wrds(dataset, Y, M=0, D=0, ssh=[], sftp=[], recombine=1):
                         newname = re.sub(subfrom, '', outfile)
                         newp2f = os.path.join(_dlpath, newname)
                         oldp2f = os.path.join(_dlpath, outfile)
-                        os.rename(oldp2f, newp2f)
+                        utility.move_file(oldp2f, newp2f)
                     else:
                         subfrom = 'to'+str(R[-1])
                         subto = 'to'+str(R[0]-1+numlines)
                         newname = re.sub(subfrom, subto, outfile)
                         oldp2f = os.path.join(_dlpath, outfile)
                         newp2f = os.path.join(_dlpath, newname)
-                        os.rename(oldp2f, newp2f)
+                        utility.move_file(oldp2f, newp2f)
                     if recombine == 1:
                         subfrom = 'rows[0-9]*to[0-9]*\.tsv'
                         recombine_name = re.sub(subfrom, '', outfile)
@@ -459,7 +407,7 @@ def _handle_sas_failure(ssh, sftp, exit_status, outfile, log_file):
         fd = sftp.file(log_file)
         logcontent = fd.read()
         fd.close()
-        if re.search('error: file .* does not exist.',logcontent,flags=re.I):
+        if saslog.parse_log_text(logcontent)['file_missing']:
             real_failure = 0
 
     if exit_status not in [0, 1] and real_failure == 1:
@@ -628,7 +576,7 @@ def _compare_local_to_remote(ssh, sftp, outfile, remote_size, local_size):
         [exec_succes, stdin, stdout, stderr, ssh, sftp] = _try_exec('rm ' + outfile, ssh, sftp, _domain, _uname)
         #[stdin, stdout, stderr] = ssh.exec_command('rm ' + outfile)
         to_path = os.path.join(_dlpath,outfile)
-        shutil.move(local_path, to_path)
+        utility.move_file(local_path, to_path)
         comare_success = 1
 
     elif local_size != 0:
@@ -851,35 +799,13 @@ def recombine_files(fname, dname=None, suppress=0):
         'should_be='+repr(rows_per_file)])
         return combined_files
 
-    fd = open(os.path.join(dname,fname0+'.tsv'),'wb')
-    headers = []
-    found_problem = 0
-    for fname1 in flist:
-        fd1 = open(os.path.join(dname,fname1),'rb')
-        fsize1 = os.stat(fd1.name).st_size
-        headers1 = fd1.readline().strip('\r\n')
-        if headers == []:
-            headers = headers1
-            fd.write(headers1+'\n')
-        if headers1 != headers:
-            print('Problem with header matching:' +fname1)
-            found_problem = 1
-        if found_problem == 0:
-            try:
-                while fd1.tell() < fsize1:
-                    fd.write(fd1.readline().strip('\r\n')+'\n')
-                fd1.close()
-            except KeyboardInterrupt:
-                fd1.close()
-                fd.close()
-                os.remove(fd.name)
-                raise KeyboardInterrupt
-            combined_files += 1
-    fd.close()
+    [combined_files, found_problem] = utility.combine_tsv_files(
+        [os.path.join(dname,x) for x in flist],
+        os.path.join(dname,fname0+'.tsv'))
 
     if found_problem == 0:
         for fname1 in flist:
-            os.remove(os.path.join(dname,fname1))
+            utility.remove_file(os.path.join(dname,fname1))
     return combined_files
 
 
@@ -889,15 +815,7 @@ def get_numlines(path2file):
 
     return numlines
     """
-    fd = open(path2file,'rb')
-    fsize = os.stat(fd.name).st_size
-    numlines = 0
-    first_line = fd.readline().split('\t')
-    while fd.tell()<fsize:
-        fline = fd.readline()
-        numlines += 1
-    fd.close()
-    return numlines
+    return utility.get_n_lines(path2file)
 
 
 has_modules = {}
@@ -0,0 +1,185 @@
+__author__ = 'cpt'
+"""
+Placement of downloaded files within download_path.
+
+With the default 'flat' layout every output lands directly in
+download_path.  With the 'partitioned' layout (user_info "layout":
+"partitioned") each period file, together with its sidecars, SAS log and
+columnar copy, goes to a directory of its dataset, year and month:
+
+download_path/dataset=crsp_dsf/year=2008/crsp_dsf2008.tsv
+download_path/dataset=crsp_dsf/year=2008/month=01/crsp_dsf20080102.tsv
+download_path/dataset=comp_fundq/comp_fundq.tsv
+
+File names are those of utility.fix_input_name in both layouts, so a
+file can be moved between them without renaming.  migrate moves the
+files of an existing flat archive into the partitioned layout.
+"""
+
+import os
+import re
+import shutil
+
+
+LAYOUTS = ['flat', 'partitioned']
+
+# Names of the files pywrds keeps for a period, e.g. crsp_dsf2008.tsv,
+# crsp_dsf200801rows1to10000000.tsv, wrds_export_crsp_dsf_2008rows1to10.log
+# or crsp_dsf2008.parquet.  The stem is the dataset name with '.' replaced
+# by '_'; a file without a date holds all dates of the dataset.
+NAME_PATTERN = re.compile(
+    '^(?:wrds_export_)?(?P<stem>.+?)_?'
+    '(?:(?P<year>[0-9]{4})(?P<month>[0-9]{2})?(?P<day>[0-9]{2})?)?'
+    '(?:_?(?:all)?rows_?[0-9]+_?to_?[0-9]+)?'
+    '(?P<ext>\.tsv|\.log|\.parquet|\.cols)$')
+
+
+def partition_dir(dataset, year, month=0, day=0):
+    """Returns the directory of the files for one period, relative to
+    download_path, in the partitioned layout.  Daily files share the
+    directory of their month.
+
+    :param dataset:
+    :param year: or 'all'.
+    :param month:
+    :param day:
+    :return partition_dir:
+    """
+    parts = ['dataset=' + re.sub('\.', '_', dataset)]
+    if year != 'all':
+        parts.append('year=' + str(year))
+        if month:
+            parts.append('month=%02d' % month)
+    return os.path.join(*parts)
+
+
+def output_dir(download_path, dataset, year, month=0, day=0, layout='flat'):
+    """Returns the directory in which the files for one period are kept.
+    The directory may not exist yet, see make_output_dir.
+
+    :param download_path:
+    :param dataset:
+    :param year:
+    :param month:
+    :param day:
+    :param layout: one of LAYOUTS.
+    :return dname:
+    """
+    if layout != 'partitioned':
+        return download_path
+    return os.path.join(download_path,
+                        partition_dir(dataset, year, month, day))
+
+
+def make_output_dir(download_path, dataset, year, month=0, day=0,
+                    layout='flat'):
+    """output_dir, creating the directory if needed, for writing the files
+    of a period.
+
+    :param download_path:
+    :param dataset:
+    :param year:
+    :param month:
+    :param day:
+    :param layout: one of LAYOUTS.
+    :return dname:
+    """
+    dname = output_dir(download_path, dataset, year, month, day, layout)
+    if not os.path.isdir(dname):
+        try:
+            os.makedirs(dname)
+        except OSError:
+            # Created meanwhile by another thread.
+            if not os.path.isdir(dname):
+                raise
+    return dname
+
+
+def parse_name(fname):
+    """Splits the name of a file kept by pywrds into its dataset stem and
+    period, the reverse of utility.fix_input_name.  The stem of a dataset
+    whose name ends in a 4, 6 or 8 digit number cannot be told apart from
+    a date, so files of such datasets holding all dates are misread.
+
+    :param fname:
+    :return [stem, year, month, day]: year is 'all' for files holding all
+        dates; None if fname is not a pywrds file name.
+    """
+    match = NAME_PATTERN.match(fname)
+    if not match:
+        return None
+    if match.group('year') is None:
+        return [match.group('stem'), 'all', 0, 0]
+    [year, month, day] = [int(match.group(x) or 0)
+                          for x in ['year', 'month', 'day']]
+    if not (1900 <= year <= 2100 and 0 <= month <= 12 and 0 <= day <= 31
+            and (month or not day)):
+        return None
+    return [match.group('stem'), year, month, day]
+
+
+def dataset_files(download_path, dataset):
+    """Lists the files in download_path that may belong to dataset, in
+    either layout: those directly in download_path and those anywhere
+    under its partitioned directory.
+
+    :param download_path:
+    :param dataset:
+    :return files: list of [fname, path2file]
+    """
+    files = [[x, os.path.join(download_path, x)]
+             for x in os.listdir(download_path)]
+    top = os.path.join(download_path, partition_dir(dataset, 'all'))
+    for [dname, dnames, fnames] in os.walk(top):
+        files += [[x, os.path.join(dname, x)] for x in fnames]
+    return files
+
+
+def migrate(download_path, dry_run=0):
+    """Moves the files of a flat archive in download_path into the
+    partitioned layout, e.g.
+
+    layout.migrate('/data/wrds')
+
+    Each tsv file is moved together with its sidecar files (see
+    utility.move_file); SAS logs and columnar copies are moved to the
+    directory of the period they belong to.  Files whose names are not
+    those of pywrds downloads are left where they are.  Set "layout":
+    "partitioned" in user_info.txt afterwards.
+
+    :param download_path:
+    :param dry_run: if 1, only print what would be moved.
+    :return n_moved:
+    """
+    from . import utility
+
+    n_moved = 0
+    for fname in sorted(os.listdir(download_path)):
+        path2file = os.path.join(download_path, fname)
+        parsed = parse_name(fname)
+        if parsed is None or re.search('_batch|_count|_partition[MD]',
+                                       fname):
+            # Logs of batch, count and partition runs cover several periods.
+            continue
+        [stem, year, month, day] = parsed
+        to_dir = os.path.join(download_path,
+                              partition_dir(stem, year, month, day))
+        if dry_run:
+            print('migrate: ' + fname + ' -> ' + to_dir)
+            n_moved += 1
+            continue
+        if not os.path.isdir(to_dir):
+            os.makedirs(to_dir)
+        to_path = os.path.join(to_dir, fname)
+        if os.path.exists(to_path):
+            print('migrate: ' + to_path + ' already exists, leaving ' +
+                  fname + ' in place.')
+            continue
+        if os.path.isdir(path2file):
+            # A columnar copy in the npy format.
+            shutil.move(path2file, to_path)
+        else:
+            utility.move_file(path2file, to_path)
+        n_moved += 1
+    print('migrate: moved ' + str(n_moved) + ' files from ' + download_path)
+    return n_moved
@@ -0,0 +1,204 @@
+__author__ = 'cpt'
+"""
+Record of every period and row-chunk downloaded into a download_path.
+
+The manifest is a SQLite database, MANIFEST_FILE in download_path, with
+one row per period (table periods) and per row-chunk (table chunks)
+holding its status, row count, size, CRC-32 and the seconds it took.
+Periods are keyed by dataset and ymd = year*10000 + month*100 + day as in
+user_info["last_wrds_download"], with ymd 0 for files holding all dates.
+
+Writes are committed in batches of commit_every rows, or after
+commit_interval seconds, whichever comes first, and in WAL mode, so
+recording a period costs an insert rather than a rewrite of
+user_info.txt; an interrupted loop loses at most the last batch, which
+is downloaded again.  wrds_loop starts from first_period rather than the
+latest download, so that it also fills any gaps before the latest one.
+
+Status is one of STATUSES: 'done' once the period's file is complete,
+'partial' while its row-chunks still need recombining, 'failed' if it
+could not be retrieved, 'empty' if WRDS has no table for it.  sync.plan
+reads these records to decide which periods wrds_loop requests.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from . import utility
+
+
+MANIFEST_FILE = '.pywrds_manifest.sqlite'
+
+STATUSES = ['done', 'partial', 'failed', 'empty']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS periods (
+    dataset TEXT NOT NULL,
+    ymd INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    n_rows INTEGER,
+    n_bytes INTEGER,
+    crc32 INTEGER,
+    seconds REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (dataset, ymd));
+CREATE TABLE IF NOT EXISTS chunks (
+    dataset TEXT NOT NULL,
+    ymd INTEGER NOT NULL,
+    first_row INTEGER NOT NULL,
+    last_row INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    n_rows INTEGER,
+    n_bytes INTEGER,
+    crc32 INTEGER,
+    seconds REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (dataset, ymd, first_row));
+"""
+
+
+class Manifest(object):
+    """Connection to the manifest of one download_path.  All methods may
+    be called from several threads at once.
+    """
+
+    def __init__(self, path2db, commit_every=100, commit_interval=5.0):
+        self.path2db = path2db
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path2db, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        [self._n_uncommitted, self._last_commit] = [0, time.time()]
+
+    def record_period(self, dataset, year, month=0, day=0, status='done',
+                      n_rows=None, n_bytes=None, crc32=None, seconds=None):
+        """Records the outcome of downloading one period.
+
+        :param dataset:
+        :param year: or 'all'.
+        :param month:
+        :param day:
+        :param status: one of STATUSES.
+        :param n_rows:
+        :param n_bytes:
+        :param crc32:
+        :param seconds:
+        :return committed (bool): whether this write ended a batch.
+        """
+        return self._write(
+            'INSERT OR REPLACE INTO periods VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [dataset, ymd_key(year, month, day), status, n_rows, n_bytes,
+             crc32, seconds, time.time()])
+
+    def record_chunk(self, dataset, year, month, day, rows, status='done',
+                     n_rows=None, n_bytes=None, crc32=None, seconds=None):
+        """Records the outcome of downloading one row-chunk of a period.
+
+        :param dataset:
+        :param year:
+        :param month:
+        :param day:
+        :param rows: [first_row, last_row] requested.
+        :param status: one of STATUSES.
+        :param n_rows:
+        :param n_bytes:
+        :param crc32:
+        :param seconds:
+        :return committed (bool):
+        """
+        return self._write(
+            'INSERT OR REPLACE INTO chunks VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [dataset, ymd_key(year, month, day), rows[0], rows[1], status,
+             n_rows, n_bytes, crc32, seconds, time.time()])
+
+    def first_period(self, dataset):
+        """Returns the ymd key of the earliest period of dataset in the
+        manifest, or None if there is none.
+
+        :param dataset:
+        :return ymd:
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT MIN(ymd) FROM periods WHERE dataset = ?',
+                [dataset]).fetchone()
+        return row[0]
+
+    def periods(self, dataset):
+        """Returns the records of the periods of dataset, in date order.
+
+        :param dataset:
+        :return periods: list of dicts keyed by column name.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                'SELECT * FROM periods WHERE dataset = ? ORDER BY ymd',
+                [dataset])
+            names = [x[0] for x in cursor.description]
+            return [dict(zip(names, x)) for x in cursor.fetchall()]
+
+    def commit(self):
+        """Commits the writes of the current batch.
+
+        :return:
+        """
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """Commits and closes the connection.
+
+        :return:
+        """
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+    def _write(self, statement, values):
+        with self._lock:
+            self._conn.execute(statement, values)
+            self._n_uncommitted += 1
+            if (self._n_uncommitted >= self.commit_every or
+                    time.time() - self._last_commit >= self.commit_interval):
+                self._commit()
+                return 1
+        return 0
+
+    def _commit(self):
+        self._conn.commit()
+        [self._n_uncommitted, self._last_commit] = [0, time.time()]
+
+
+def ymd_key(year, month=0, day=0):
+    """Returns year*10000 + month*100 + day, or 0 if year == 'all'.
+
+    :param year:
+    :param month:
+    :param day:
+    :return ymd:
+    """
+    if year == 'all':
+        return 0
+    return year * 10000 + month * 100 + day
+
+
+def file_stats(path2file):
+    """Returns the row count, size and CRC-32 of a downloaded file, from
+    its metadata record where there is one (see utility.record_file_meta).
+
+    :param path2file:
+    :return [n_rows, n_bytes, crc32]: crc32 is None if it was not recorded.
+    """
+    stat = os.stat(path2file)
+    meta = utility.read_file_meta(path2file, stat)
+    crc32 = None
+    if meta is not None:
+        crc32 = meta['crc32']
+    return [utility.get_n_lines(path2file), stat.st_size, crc32]
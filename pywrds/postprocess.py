@@ -0,0 +1,122 @@
+__author__ = 'cpt'
+"""
+Background pool for the work done on the client once a period has been
+downloaded: recombining its row-chunks, verifying the result and writing
+its columnar copy.
+
+wrds_loop hands each finished period to a PostProcessor (see
+WrdsSession._finish_period) and moves straight on to the next server job
+while the pool's threads do the copying.  The copies themselves run in
+os.sendfile, zlib and numpy, which release the GIL, so threads are
+enough here and keep the directory indexes of dirindex shared.
+
+submit blocks while max_pending tasks are already waiting, and while the
+disk lacks room for the bytes a task will write on top of those reserved
+by the tasks ahead of it.  close is the barrier at the end of the loop:
+it waits for every task and reports the ones that failed.
+"""
+
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class PostProcessor(object):
+    """Bounded pool of n_workers threads running post-processing tasks in
+    the order they were submitted.
+    """
+
+    def __init__(self, n_workers=2, max_pending=None):
+        if max_pending is None:
+            max_pending = 2 * n_workers
+        self._queue = queue.Queue(max_pending)
+        self._cond = threading.Condition()
+        self._reserved = 0
+        self.failures = []
+        self.n_done = 0
+        self._threads = [threading.Thread(target=self._work)
+                         for i in range(n_workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, name, fn, args=(), n_bytes=0, dname=None):
+        """Queues fn(*args), which should return a true value on success.
+
+        :param name: reported with the task if it fails.
+        :param fn:
+        :param args:
+        :param n_bytes: disk space the task needs in dname.
+        :param dname:
+        :return:
+        """
+        if dname is None:
+            n_bytes = 0
+        if n_bytes:
+            with self._cond:
+                # A task larger than the free space still runs once it is
+                # alone, and fails on its own.
+                while self._reserved and \
+                        self._reserved + n_bytes > free_space(dname):
+                    self._cond.wait(1)
+                self._reserved += n_bytes
+        self._queue.put([name, fn, args, n_bytes])
+
+    def wait(self):
+        """Waits for every submitted task to finish.
+
+        :return failures: list of [name, error] for the failed tasks.
+        """
+        # Queue.join cannot be interrupted, so poll.
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                self._queue.all_tasks_done.wait(0.5)
+        return list(self.failures)
+
+    def close(self):
+        """Waits for every submitted task, stops the threads and prints
+        the failed tasks.
+
+        :return failures: list of [name, error]
+        """
+        failures = self.wait()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for [name, error] in failures:
+            print('post-processing failed for ' + name + ': ' + error)
+        return failures
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            [name, fn, args, n_bytes] = task
+            try:
+                if not fn(*args):
+                    self.failures.append([name, 'see messages above'])
+            except Exception as err:
+                self.failures.append([name, repr(err)])
+            finally:
+                with self._cond:
+                    self._reserved -= n_bytes
+                    self.n_done += 1
+                    self._cond.notify_all()
+                self._queue.task_done()
+
+
+def free_space(dname):
+    """Returns the bytes available to the user on the disk of dname.
+
+    :param dname:
+    :return n_bytes:
+    """
+    vfs = os.statvfs(dname)
+    return vfs.f_bavail * vfs.f_frsize
@@ -0,0 +1,272 @@
+__author__ = 'cpt'
+"""
+Reading the files downloaded by pywrds without parsing them again.
+
+read(dataset, start, end, columns) finds the period files of dataset in
+the download directory by the names utility.fix_input_name gives them,
+e.g. crsp_dsf2008.tsv, crsp_dsf200801.tsv or crsp_dsf20080102.tsv, and
+returns only the requested columns and dates as numpy arrays.
+
+Every file is read through its typed columnar copy, which is written
+first with columnar.convert_file if it is missing or out of date.  The
+.npy columns of a .cols copy are memory-mapped, so a period entirely
+inside [start, end] costs no copy at all until the periods are joined;
+of a .parquet copy only the requested columns and the row groups that
+can hold matching dates are read.
+
+iter_partitions yields the same data one period file at a time, for
+loops that should never hold more than one period in memory.
+"""
+
+import datetime
+import os
+import re
+from collections import OrderedDict
+
+from . import columnar
+from . import layout
+from . import sas_query
+from . import utility
+
+
+def read(dataset, start=None, end=None, columns=None, download_path=None,
+         as_dict=0, fmt=None):
+    """Reads the rows of dataset dated from start to end (both included)
+    out of the files downloaded with get_wrds or wrds_loop, e.g.
+
+    x = read('crsp.dsf', 20080101, 20080630, columns=['PERMNO', 'RET'])
+
+    start and end may be yyyymmdd, yyyymm or yyyy integers or strings,
+    or datetime.date objects; None leaves that side open.  Rows are
+    filtered on the dataset's date variable (see columnar.read_schema);
+    files without a date column are only selected by their period.  If
+    start or end is given, rows whose date is missing are never returned,
+    whichever period they are in; with neither, every row is.
+
+    :param dataset:
+    :param start:
+    :param end:
+    :param columns: list of column names (any case), defaults to all.
+    :param download_path: defaults to the one in user_info.txt.
+    :param as_dict: if 1, return a dict of arrays instead of a numpy
+        structured array.
+    :param fmt: columnar format used for files without a copy yet.
+    :return data: structured array or dict of arrays, or None if no
+        files were found.
+    """
+    parts = list(iter_partitions(dataset, start, end, columns,
+                                 download_path, fmt))
+    if not parts:
+        print('read: No files found for ' + dataset + ' from ' +
+              str(start) + ' to ' + str(end))
+        return None
+
+    names = list(parts[0].keys())
+    data = OrderedDict()
+    for name in names:
+        if len(parts) == 1:
+            data[name] = parts[0][name]
+        else:
+            data[name] = numpy.concatenate([x[name] for x in parts])
+    if as_dict:
+        return data
+    records = numpy.empty(len(data[names[0]]) if names else 0,
+                          dtype=[(str(x), data[x].dtype) for x in names])
+    for name in names:
+        records[str(name)] = data[name]
+    return records
+
+
+def iter_partitions(dataset, start=None, end=None, columns=None,
+                    download_path=None, fmt=None):
+    """Yields the data of read(dataset, start, end, columns) one period
+    file at a time, in date order, as dicts of arrays keyed by column
+    name.  Periods entirely inside [start, end] are yielded as read-only
+    memory maps where the copy is in the npy format.  str columns are
+    bytes in npy copies and str (object arrays) in parquet copies.
+
+    :param dataset:
+    :param start:
+    :param end:
+    :param columns:
+    :param download_path:
+    :param fmt:
+    :return:
+    """
+    if not columnar.has_modules['numpy']:
+        raise ImportError('pywrds.reader requires the package "numpy".  '
+                          'Please "pip install numpy".')
+    [start, end] = [parse_date(start), parse_date(end, last=1)]
+    for [first, last, path2file] in find_period_files(
+            dataset, start, end, download_path):
+        cache = columnar.convert_file(path2file, dataset, fmt)
+        if cache is None:
+            continue
+        schema = columnar.read_schema(cache)
+        names = _resolve_columns(schema['columns'], columns, path2file)
+        date_var = schema['date_var']
+        dated = int(date_var is not None and
+                    (start is not None or end is not None))
+        if date_var is None or ((start is None or first is not None
+                                 and first >= start) and
+                                (end is None or last is not None
+                                 and last <= end)):
+            # The whole period is in range: only missing dates to drop.
+            [start1, end1] = [None, None]
+        else:
+            [start1, end1] = [start, end]
+        if cache.endswith(columnar.EXTENSIONS['parquet']):
+            yield _read_parquet(cache, names, date_var, start1, end1, dated)
+        else:
+            yield _read_npy(cache, names, date_var, start1, end1, dated)
+
+
+def find_period_files(dataset, start=None, end=None, download_path=None):
+    """Lists the downloaded tsv files of dataset whose period overlaps
+    [start, end], in either layout (see layout.dataset_files).  Row-chunks
+    that were never recombined are left out, as is any file whose period
+    lies within that of another file, e.g. a monthly file next to the
+    yearly file.
+
+    :param dataset:
+    :param start: yyyymmdd, or None.
+    :param end: yyyymmdd, or None.
+    :param download_path:
+    :return period_files: list of [first, last, path2file], sorted by date;
+        first and last are None for a file holding all dates.
+    """
+    if download_path is None:
+        from . import wrdslib
+        download_path = wrdslib.download_path
+    [dset2, all_file] = utility.fix_input_name(dataset, 'all', 0, 0, [])
+    stem = re.sub('\.tsv$', '', all_file)
+    pattern = re.compile(re.escape(stem) + '_' * dataset[-1].isdigit() +
+                         '([0-9]{4})([0-9]{2})?([0-9]{2})?\.tsv$')
+
+    found = []
+    for [fname, path2file] in layout.dataset_files(download_path, dataset):
+        if fname == all_file:
+            found.append([None, None, path2file])
+            continue
+        match = pattern.match(fname)
+        if not match:
+            continue
+        [year, month, day] = [int(x or 0) for x in match.groups()]
+        [first, last] = sas_query.period_date_range(year, month, day)
+        if (start is None or last >= start) and (end is None or
+                                                 first <= end):
+            found.append([first, last, path2file])
+
+    found.sort(key=lambda x: [x[0] or 0, -((x[1] or 0) - (x[0] or 0))])
+    period_files = []
+    for [first, last, path2file] in found:
+        if period_files and period_files[-1][0] is not None and \
+                first is not None and last <= period_files[-1][1]:
+            continue
+        period_files.append([first, last, path2file])
+    return period_files
+
+
+def parse_date(value, last=0):
+    """Converts a date given as yyyymmdd, yyyymm or yyyy (int or str),
+    'yyyy-mm-dd' or datetime.date into a yyyymmdd integer.  For yyyy and
+    yyyymm, the first day of the period is returned, or the last one if
+    last == 1.
+
+    :param value:
+    :param last:
+    :return ymd: yyyymmdd, or None if value is None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.year * 10000 + value.month * 100 + value.day
+    value = int(re.sub('-', '', str(value)))
+    if value < 10000:
+        return sas_query.period_date_range(value, 0, 0)[last]
+    if value < 1000000:
+        return sas_query.period_date_range(value // 100, value % 100,
+                                           0)[last]
+    return value
+
+
+def _resolve_columns(available, columns, path2file):
+    """Matches the requested column names against the names in a file,
+    ignoring case as SAS does.
+
+    :return names: list of [requested_name, name_in_file]
+    """
+    if columns is None:
+        return [[x, x] for x in available]
+    lower = dict((x.lower(), x) for x in available)
+    missing = [x for x in columns if x.lower() not in lower]
+    if missing:
+        raise KeyError('read: ' + os.path.basename(path2file) +
+                       ' has no columns ' + repr(missing) +
+                       ', only ' + repr(available))
+    return [[x, lower[x.lower()]] for x in columns]
+
+
+def _date64(ymd):
+    return numpy.datetime64('%04d-%02d-%02d' % (ymd // 10000,
+                                                ymd // 100 % 100,
+                                                ymd % 100), 'D')
+
+
+def _read_npy(cache, names, date_var, start=None, end=None, dated=0):
+    """Memory-maps the requested columns of a .cols copy, keeping the rows
+    dated from start to end if either is given, and only rows with a date
+    if dated == 1.  The columns are only copied if rows are dropped.
+
+    :return data: dict of arrays keyed by requested name.
+    """
+    def load(name):
+        return numpy.load(os.path.join(cache, name + '.npy'), mmap_mode='r')
+
+    data = OrderedDict((x, load(name)) for [x, name] in names)
+    if start is None and end is None and not dated:
+        return data
+    dates = load(date_var)
+    keep = ~numpy.isnat(dates)
+    if start is None and end is None and keep.all():
+        return data
+    if start is not None:
+        keep &= dates >= _date64(start)
+    if end is not None:
+        keep &= dates <= _date64(end)
+    return OrderedDict((x, data[x][keep]) for x in data)
+
+
+def _read_parquet(cache, names, date_var, start=None, end=None, dated=0):
+    """Reads the requested columns of a .parquet copy, keeping the rows
+    dated from start to end if either is given, and only rows with a date
+    if dated == 1.  Row groups whose date statistics are out of range are
+    skipped.
+
+    :return data: dict of arrays keyed by requested name.
+    """
+    filters = []
+    if start is not None:
+        filters.append((date_var, '>=', datetime.date(
+            start // 10000, start // 100 % 100, start % 100)))
+    if end is not None:
+        filters.append((date_var, '<=', datetime.date(
+            end // 10000, end // 100 % 100, end % 100)))
+    if dated and not filters:
+        # Nulls fail any comparison, so this only drops missing dates.
+        filters.append((date_var, '>=', datetime.date(1, 1, 1)))
+    table = pq.read_table(cache, columns=[name for [x, name] in names],
+                          filters=filters or None, memory_map=True)
+    return OrderedDict((x, table.column(name).to_numpy())
+                       for [x, name] in names)
+
+
+try:
+    import numpy
+except ImportError:
+    pass
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pass
@@ -6,19 +6,40 @@ wrdsapi.
 """
 
 from . import utility as wrds_util
+import calendar
 import os
 import re
 
+MONTH_ABBRS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP',
+               'OCT', 'NOV', 'DEC']
 
-def wrds_sas_script(download_path, dataset, year, month=0, day=0, rows=[]):
+
+def wrds_sas_script(download_path, dataset, year, month=0, day=0, rows=[],
+                    stream=0, date_range=None, columns=None, where=None,
+                    ids=None, id_var=None):
     """Generates a .sas file.
      To be executed on the WRDS server to produce the desired dataset.
 
+     If stream == 1, the export is written to standard output instead of
+     the home directory, for use with "sas -stdio" (see
+     WrdsSession._stream_wrds).
+
+     date_range = [first, last], given as yyyymmdd, selects those dates
+     instead of the period year/month/day, which then only names the output.
+
+     Only the variables in columns are exported, if given, and only rows
+     satisfying the SAS expression where.  If ids is given, only rows whose
+     id_var (by default wrds_util.wrds_idvar(dataset), e.g. PERMNO for
+     crsp) is in ids are exported; the list is written next to sas_file
+     (see ids_file_name), to be uploaded with it, and looked up in a hash.
+     The names of filtered exports carry wrds_util.filter_tag, so that they
+     are not taken for the full dataset.
+
      e.g. sample request.
 
         DATA new_data;
-            SET crsp.dsf (where = ((year(date) between 2008 and 2008) and
-            (month(date) between 2 and 2) and (day(date) between 2 and 2)));
+            SET crsp.dsf (where = (date between '02FEB2008'd and
+            '02FEB2008'd));
             IF (1<= _N_<= 10000000);
 
         proc export data = new_data
@@ -34,13 +55,21 @@ def wrds_sas_script(download_path, dataset, year, month=0, day=0, rows=[]):
     :param month:
     :param day:
     :param rows:
+    :param stream:
+    :param date_range:
+    :param columns: list of variables to keep.
+    :param where: SAS where expression, e.g. 'shrcd in (10, 11)'.
+    :param ids: list of ids to keep.
+    :param id_var:
     :return [sas_file, output_file, dataset]:
     """
     ystr = '' + ('_' + str(year)) * (year != 'all')
     mstr = '' + (month != 0)*('0'*(month < 10) + str(month))
     dstr = '' + (day != 0)*('0'*(day < 10) + str(day))
     ymdstr = ystr + mstr + dstr
-    sas_file = 'wrds_export_' + re.sub('\.', '_', dataset)
+    tag = wrds_util.filter_tag(columns, where, ids, id_var)
+    sas_file = 'wrds_export_' + re.sub('\.', '_',
+                                       wrds_util.dataset_key(dataset, tag))
 
     if rows:
         row_str = 'rows' + str(rows[0]) + 'to' + str(rows[1])
@@ -49,44 +78,453 @@ def wrds_sas_script(download_path, dataset, year, month=0, day=0, rows=[]):
         sas_file += ymdstr
     sas_file += '.sas'
 
+    id_var = _write_ids_file(download_path, sas_file, dataset, ids, id_var)
     [dataset, output_file] = \
-        wrds_util.fix_input_name(dataset, year, month, day, rows)
+        wrds_util.fix_input_name(dataset, year, month, day, rows, tag)
+
+    export_path = '~/' + output_file
+    if stream:
+        export_path = '/dev/stdout'
 
     with open(os.path.join(download_path, sas_file), 'wb') as fd:
-        fd.write('DATA new_data;\n')
-        fd.write('\tSET ' + dataset)
-        if year != 'all':
-            where_query = ' (where = ('
-            year_query = ('(year(' + wrds_util.wrds_datevar(dataset) + ')'
-                + ' between ' + str(year) + ' and ' + str(year) + ')')
-            where_query += year_query
-
-            if month != 0:
-                month_query = (' and (month(' + wrds_util.wrds_datevar(dataset)
-                    + ') between ' + str(month) + ' and ' + str(month)+')')
-                where_query += month_query
-
-            if day != 0:
-                day_query = (' and (day(' + wrds_util.wrds_datevar(dataset)
-                    + ') between ' + str(day) + ' and ' + str(day) + ')')
-                where_query += day_query
-
-            where_query += '));\n'
-            fd.write(where_query)
-        else:
-            fd.write(';\n')
-
-        if rows:
-            row_query = ('\tIF (' + str(rows[0]) + '<= _N_<= ' + str(rows[1]) +
-                        '); \n')
-            fd.write(row_query)
-
-        fd.write('\n')
-        fd.write('proc export data = new_data\n')
-        fd.write(('\toutfile = "~/' + output_file + '" \n'
-                  + '\tdbms = tab \n'
-                  + '\treplace; \n'
-                  + '\tputnames = yes; \n'
-                  + 'run; \n'))
+        if stream:
+            # Keep listing output off stdout, which carries the data.
+            fd.write('ods listing close;\n')
+        if id_var:
+            fd.write(_ids_step(dataset, id_var, ids_file_name(sas_file)))
+        fd.write(_export_step(dataset, year, month, day, rows, export_path,
+                              date_range, columns, where, id_var))
     return [sas_file, output_file, dataset]
 
+
+def wrds_sas_batch_script(download_path, dataset, ymds, columns=None,
+                          where=None, ids=None, id_var=None):
+    """Generates a single .sas file exporting every period in ymds, so that
+    SAS (and the autoexec) only has to start once for the whole loop.
+
+    Each export is followed by an "<output_file>.done" marker holding the
+    number of rows exported, which tells the downloader that the output
+    is complete while SAS moves on to the next period, e.g.
+
+        %let n_obs = -1;
+        proc sql noprint;
+            select nobs format=20. into :n_obs trimmed
+            from dictionary.tables
+            where libname = "WORK" and memname = "NEW_DATA";
+        quit;
+        data _null_;
+            file "~/comp_fundq200801.tsv.done";
+            put "&n_obs";
+        run;
+        proc delete data = new_data;
+        run;
+
+    The marker is written even if the period fails, with a count of -1.
+    The periods are not split into row-chunks.  columns, where, ids and
+    id_var filter each period as in wrds_sas_script.
+
+    :param download_path: path for local sas script.
+    :param dataset:
+    :param ymds: list of [year, month, day].
+    :param columns:
+    :param where:
+    :param ids:
+    :param id_var:
+    :return [sas_file, output_files, dataset]:
+    """
+    tag = wrds_util.filter_tag(columns, where, ids, id_var)
+    [Y, M, D] = ymds[0]
+    [dset2, first_file] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+    [Y, M, D] = ymds[-1]
+    [dset2, last_file] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+    stem = re.sub('\.', '_', wrds_util.dataset_key(dataset, tag))
+    sas_file = ('wrds_export_' + stem + '_batch' +
+                re.sub('^' + stem + '|\.tsv$', '', first_file) + 'to' +
+                re.sub('^' + stem + '|\.tsv$', '', last_file) + '.sas')
+    id_var = _write_ids_file(download_path, sas_file, dataset, ids, id_var)
+
+    output_files = []
+    with open(os.path.join(download_path, sas_file), 'wb') as fd:
+        # After an error, batch SAS would otherwise only syntax-check the
+        # remaining steps, losing every later period.
+        fd.write('options nosyntaxcheck;\n\n')
+        if id_var:
+            fd.write(_ids_step(dset2, id_var, ids_file_name(sas_file)))
+        for [year, month, day] in ymds:
+            [dset2, output_file] = \
+                wrds_util.fix_input_name(dataset, year, month, day, [], tag)
+            output_files.append(output_file)
+            fd.write(_export_step(dset2, year, month, day, [],
+                                  '~/' + output_file, None, columns, where,
+                                  id_var))
+            fd.write(('%let n_obs = -1;\n'
+                      + 'proc sql noprint;\n'
+                      + '\tselect nobs format=20. into :n_obs trimmed\n'
+                      + '\tfrom dictionary.tables\n'
+                      + '\twhere libname = "WORK" and memname = "NEW_DATA";\n'
+                      + 'quit;\n'
+                      + 'data _null_;\n'
+                      + '\tfile "~/' + output_file + '.done";\n'
+                      + '\tput "&n_obs";\n'
+                      + 'run;\n'
+                      + 'proc delete data = new_data;\n'
+                      + 'run;\n\n'))
+    return [sas_file, output_files, dset2]
+
+
+def wrds_sas_count_script(download_path, dataset, ymds, where=None, tag=''):
+    """Generates a single .sas file counting the rows of every period in
+    ymds, without exporting them, so that the row-chunks each period needs
+    are known before any export starts (see WrdsSession._probe_row_counts).
+
+    One line "<output_file> <n_obs>" per period is appended to counts_file,
+    in the order of ymds, e.g.
+
+        %let n_obs = -1;
+        proc sql noprint;
+            select count(*) format=20. into :n_obs trimmed
+            from crsp.dsf (where = (date between '01JAN2008'd and
+            '31DEC2008'd));
+        quit;
+        data _null_;
+            file "~/wrds_export_crsp_dsf_count2008to2010.counts" mod;
+            put "crsp_dsf2008.tsv &n_obs";
+        run;
+
+    The count is -1 for a period whose table is missing or whose count
+    failed.  where filters each period as in wrds_sas_script.
+
+    :param download_path: path for local sas script.
+    :param dataset:
+    :param ymds: list of [year, month, day].
+    :param where:
+    :param tag: see wrds_util.filter_tag, of the filter of the files whose
+        rows are counted.
+    :return [sas_file, counts_file, dataset]:
+    """
+    [Y, M, D] = ymds[0]
+    [dset2, first_file] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+    [Y, M, D] = ymds[-1]
+    [dset2, last_file] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+    stem = re.sub('\.', '_', wrds_util.dataset_key(dataset, tag))
+    sas_file = ('wrds_export_' + stem + '_count' +
+                re.sub('^' + stem + '|\.tsv$', '', first_file) + 'to' +
+                re.sub('^' + stem + '|\.tsv$', '', last_file) + '.sas')
+    counts_file = re.sub('\.sas$', '.counts', sas_file)
+
+    with open(os.path.join(download_path, sas_file), 'wb') as fd:
+        # A missing table must not stop the counts of the later periods.
+        fd.write('options nosyntaxcheck;\n\n')
+        fd.write(('data _null_;\n'
+                  + '\tfile "~/' + counts_file + '";\n'
+                  + 'run;\n\n'))
+        for [year, month, day] in ymds:
+            [dset2, output_file] = \
+                wrds_util.fix_input_name(dataset, year, month, day, [], tag)
+            fd.write(('%let n_obs = -1;\n'
+                      + 'proc sql noprint;\n'
+                      + '\tselect count(*) format=20. into :n_obs trimmed\n'
+                      + '\tfrom ' + dset2
+                      + _where_query(dset2, year, month, day, None, where)
+                      + ';\n'
+                      + 'quit;\n'
+                      + 'data _null_;\n'
+                      + '\tfile "~/' + counts_file + '" mod;\n'
+                      + '\tput "' + output_file + ' &n_obs";\n'
+                      + 'run;\n\n'))
+    return [sas_file, counts_file, dset2]
+
+
+def wrds_sas_partition_script(download_path, dataset, ymds, frequency='D',
+                              columns=None, where=None, ids=None,
+                              id_var=None):
+    """Generates a .sas file which reads dataset from the first to the last
+    period of ymds once and writes one output file per period (monthly or
+    daily, frequency 'M' or 'D'), named as fix_input_name names the
+    single-period outputs.
+
+    The source table is scanned once instead of once per period.  Every
+    period has its own fileref, so that its file is opened once however
+    the rows are sorted; rows of periods not in ymds are dropped.  The
+    header line is written before the first row of each file.  The number
+    of rows in each file is written to counts_file, after a first line
+    holding the header, e.g.
+
+        ~/optionm_opprcd20080102.tsv 512345
+        ~/optionm_opprcd20080103.tsv 509876
+
+    Files of periods without any rows are not created.  columns, where,
+    ids and id_var filter the rows as in wrds_sas_script.
+
+    :param download_path: path for local sas script.
+    :param dataset:
+    :param ymds: list of [year, month, day], in date order.
+    :param frequency: 'M' or 'D'.
+    :param columns:
+    :param where:
+    :param ids:
+    :param id_var:
+    :return [sas_file, counts_file, dataset]:
+    """
+    tag = wrds_util.filter_tag(columns, where, ids, id_var)
+    [Y, M, D] = ymds[0]
+    [dset2, first_file] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+    first = period_date_range(Y, M, D)[0]
+    [Y, M, D] = ymds[-1]
+    [dset2, last_file] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+    last = period_date_range(Y, M, D)[1]
+    stem = re.sub('\.', '_', wrds_util.dataset_key(dataset, tag))
+    sas_file = ('wrds_export_' + stem + '_partition' + frequency +
+                re.sub('^' + stem + '|\.tsv$', '', first_file) + 'to' +
+                re.sub('^' + stem + '|\.tsv$', '', last_file) + '.sas')
+    counts_file = re.sub('\.sas$', '.counts', sas_file)
+    id_var = _write_ids_file(download_path, sas_file, dataset, ids, id_var)
+    datevar = wrds_util.wrds_datevar(dset2)
+    [libname, memname] = dset2.upper().split('.')
+    column_query = ''
+    if columns:
+        column_query = (' and upcase(name) in (' +
+                        ', '.join(['"' + x.upper() + '"' for x in columns]) +
+                        ')')
+
+    period_key = 'put(month(' + datevar + '), z2.)'
+    if frequency == 'D':
+        period_key = ('cats(' + period_key + ', put(day(' + datevar +
+                      '), z2.))')
+    row_block = '\tdo;\n'
+    if id_var:
+        # Not a subsetting if, the counts must still be written at the end.
+        row_block = '\tif _ids.check() = 0 then do;\n'
+    outfiles = [wrds_util.fix_input_name(dataset, year, month, day, [],
+                                         tag)[1]
+                for [year, month, day] in ymds]
+    n_periods = str(len(ymds))
+
+    with open(os.path.join(download_path, sas_file), 'wb') as fd:
+        fd.write(('proc sql noprint;\n'
+                  + '\tselect name into :columns separated by " "\n'
+                  + '\tfrom dictionary.columns\n'
+                  + '\twhere libname = "' + libname + '" and memname = "'
+                  + memname + '"' + column_query + '\n'
+                  + '\torder by varnum;\n'
+                  + "\tselect name into :header separated by '09'x\n"
+                  + '\tfrom dictionary.columns\n'
+                  + '\twhere libname = "' + libname + '" and memname = "'
+                  + memname + '"' + column_query + '\n'
+                  + '\torder by varnum;\n'
+                  + 'quit;\n\n'))
+        if id_var:
+            fd.write(_ids_step(dset2, id_var, ids_file_name(sas_file)))
+        for (k, outfile) in enumerate(outfiles):
+            fd.write('filename _p' + str(k + 1) + ' "~/' + outfile + '";\n')
+        # Written up front so that it exists even if no rows are read.
+        fd.write(('\ndata _null_;\n'
+                  + '\tfile "~/' + counts_file + '";\n'
+                  + '\tput "&header";\n'
+                  + 'run;\n\n'))
+        fd.write('data _null_;\n')
+        fd.write('\tSET ' + dset2 +
+                 _where_query(dset2, 'all', 0, 0, [first, last], where) +
+                 ' end = _last_row;\n')
+        fd.write('\tarray _n_rows {' + n_periods + '} _temporary_ (' +
+                 n_periods + '*0);\n')
+        if id_var:
+            fd.write('\tif _n_ = 1 then do;\n' + _ids_hash(id_var) +
+                     '\tend;\n')
+        fd.write(row_block
+                 + '\t\tselect (' + period_key + ');\n')
+        for (k, [year, month, day]) in enumerate(ymds):
+            key = '0'*(month < 10) + str(month)
+            if frequency == 'D':
+                key += '0'*(day < 10) + str(day)
+            fd.write('\t\t\twhen ("' + key + '") do;\n'
+                     + '\t\t\t\tfile _p' + str(k + 1) + ' dsd '
+                     + "dlm = '09'x lrecl = 32767;\n"
+                     + '\t\t\t\t_i = ' + str(k + 1) + ';\n'
+                     + '\t\t\tend;\n')
+        fd.write(('\t\t\totherwise _i = 0;\n'
+                  + '\t\tend;\n'
+                  + '\t\tif _i > 0 then do;\n'
+                  + '\t\t\tif _n_rows{_i} = 0 then put "&header";\n'
+                  + '\t\t\tput &columns;\n'
+                  + '\t\t\t_n_rows{_i} = _n_rows{_i} + 1;\n'
+                  + '\t\tend;\n'
+                  + '\tend;\n'
+                  + '\tif _last_row then do;\n'
+                  + '\t\tfile "~/' + counts_file + '" mod;\n'))
+        for (k, outfile) in enumerate(outfiles):
+            fd.write('\t\tput "~/' + outfile + ' " _n_rows{' + str(k + 1) +
+                     '} 20.;\n')
+        fd.write(('\tend;\n'
+                  + 'run;\n'))
+    return [sas_file, counts_file, dset2]
+
+
+def period_date_range(year, month=0, day=0):
+    """Gives the first and last dates of the period year/month/day.
+
+    :param year:
+    :param month:
+    :param day:
+    :return [first, last]: dates as yyyymmdd.
+    """
+    if day != 0:
+        first = 10000*year + 100*month + day
+        return [first, first]
+    if month != 0:
+        last_day = calendar.monthrange(year, month)[1]
+        return [10000*year + 100*month + 1, 10000*year + 100*month + last_day]
+    return [10000*year + 101, 10000*year + 1231]
+
+
+def sas_date(ymd):
+    """Formats a yyyymmdd date as a SAS date literal, e.g. '02JAN2008'd.
+
+    :param ymd:
+    :return date_literal:
+    """
+    [year, month, day] = [ymd//10000, (ymd % 10000)//100, ymd % 100]
+    return ("'" + '0'*(day < 10) + str(day) + MONTH_ABBRS[month - 1] +
+            str(year) + "'d")
+
+
+def _where_query(dataset, year, month=0, day=0, date_range=None, where=None):
+    """Builds the dataset option restricting dataset to a single period, or
+    to date_range if given, and to the rows satisfying where.
+
+    The date variable is compared to literals directly rather than wrapped
+    in year()/month()/day(), so that SAS can use an index on it.
+
+    :param dataset:
+    :param year:
+    :param month:
+    :param day:
+    :param date_range: [first, last] as yyyymmdd.
+    :param where: SAS where expression.
+    :return where_query: empty if there is nothing to filter on.
+    """
+    conditions = []
+    if date_range is None and year != 'all':
+        date_range = period_date_range(year, month, day)
+    if date_range:
+        conditions.append(wrds_util.wrds_datevar(dataset) + ' between ' +
+                          sas_date(date_range[0]) + ' and ' +
+                          sas_date(date_range[1]))
+    if where:
+        conditions.append(where)
+
+    if not conditions:
+        return ''
+    if len(conditions) == 1:
+        return ' (where = (' + conditions[0] + '))'
+    return (' (where = (' + ' and '.join(['(' + x + ')' for x in conditions])
+            + '))')
+
+
+def ids_file_name(sas_file):
+    """Name of the file holding the ids filter of sas_file.
+
+    :param sas_file:
+    :return ids_file:
+    """
+    return re.sub('\.sas$', '_ids.txt', sas_file)
+
+
+def _write_ids_file(download_path, sas_file, dataset, ids, id_var=None):
+    """Writes ids one per line to ids_file_name(sas_file) in download_path.
+
+    :param download_path:
+    :param sas_file:
+    :param dataset:
+    :param ids:
+    :param id_var:
+    :return id_var: None if there are no ids to filter on.
+    """
+    if not ids:
+        return None
+    if not id_var:
+        id_var = wrds_util.wrds_idvar(dataset)
+    with open(os.path.join(download_path, ids_file_name(sas_file)), 'wb') as fd:
+        fd.write(''.join([str(x) + '\n' for x in ids]))
+    return id_var
+
+
+def _ids_step(dataset, id_var, ids_file):
+    """Builds the DATA step reading the uploaded ids_file into work._ids,
+    with id_var taking its type from dataset.
+
+    :param dataset:
+    :param id_var:
+    :param ids_file:
+    :return sas_text:
+    """
+    return ('data _ids;\n'
+            + '\tif 0 then set ' + dataset + ' (keep = ' + id_var + ');\n'
+            + '\tinfile "~/' + ids_file + '" truncover;\n'
+            + '\tinput ' + id_var + ';\n'
+            + 'run;\n\n')
+
+
+def _ids_hash(id_var):
+    """Builds the statements loading work._ids into the hash _ids, to be
+    run once at the start of a DATA step.
+
+    :param id_var:
+    :return sas_text:
+    """
+    return ("\t\tdeclare hash _ids(dataset: 'work._ids');\n"
+            + "\t\t_ids.defineKey('" + id_var + "');\n"
+            + '\t\t_ids.defineDone();\n')
+
+
+def _export_step(dataset, year, month, day, rows, export_path,
+                 date_range=None, columns=None, where=None, id_var=None):
+    """Builds the DATA step and proc export for a single period.
+
+    If id_var is given, work._ids must have been created with _ids_step.
+    Rows are then counted after the ids filter, so that row-chunks still
+    hold rows[1] - rows[0] + 1 rows.
+
+    :param dataset:
+    :param year:
+    :param month:
+    :param day:
+    :param rows:
+    :param export_path:
+    :param date_range:
+    :param columns:
+    :param where:
+    :param id_var:
+    :return sas_text:
+    """
+    sas_text = 'DATA new_data'
+    if columns:
+        sas_text += ' (keep = ' + ' '.join(columns) + ')'
+    elif id_var:
+        sas_text += ' (drop = _row)'
+    sas_text += ';\n'
+    if id_var:
+        sas_text += '\tif _n_ = 1 then do;\n' + _ids_hash(id_var) + '\tend;\n'
+    sas_text += '\tSET ' + dataset + _where_query(dataset, year, month, day,
+                                                   date_range, where)
+    sas_text += ';\n'
+
+    row_var = '_N_'
+    if id_var:
+        sas_text += '\tif _ids.check() = 0;\n'
+        sas_text += '\t_row + 1;\n'
+        row_var = '_row'
+
+    if rows:
+        row_query = ('\tIF (' + str(rows[0]) + '<= ' + row_var + '<= ' +
+                     str(rows[1]) + '); \n')
+        sas_text += row_query
+
+    sas_text += '\n'
+    sas_text += 'proc export data = new_data\n'
+    sas_text += ('\toutfile = "' + export_path + '" \n'
+                 + '\tdbms = tab \n'
+                 + '\treplace; \n'
+                 + '\tputnames = yes; \n'
+                 + 'run; \n')
+    return sas_text
@@ -0,0 +1,143 @@
+__author__ = 'cpt'
+"""
+Parsing of the SAS logs written by the pywrds export scripts.
+
+parse_log_text scans a log once with LOG_PATTERN, a single compiled
+pattern with one alternative per kind of line of interest, and returns
+a summary dict:
+
+- 'n_records': rows exported, from the first "N records created in",
+  "The data set WORK.NEW_DATA has N observations" or "N records were
+  written to the file" note, or -1 if there is none.
+- 'errors', 'warnings': the ERROR and WARNING messages, in order.
+- 'file_missing': 1 if an error says that a file does not exist, which
+  SAS reports with exit status 2 for periods without data.
+- 'real_time', 'cpu_time': seconds, summed over all steps.
+- 'memory': largest memory use of a step in kilobytes, or None (only
+  logged with the FULLSTIMER option).
+
+read_log parses a local log file and keeps the summary until the file
+changes, so that the checks in get_wrds and recombine_ready read each
+log only once.
+"""
+
+import os
+import re
+
+
+LOG_PATTERN = re.compile(
+    r'^(?:(?P<created>[0-9]+) records created in '
+    r'|NOTE: The data set WORK\.NEW_DATA has (?P<obs>[0-9]+) observations'
+    r'|NOTE: (?P<written>[0-9]+) records were written to the file'
+    r'|\s+(?P<timer>real|cpu) time\s+(?P<time>[0-9:.]+)'
+    r'|\s+memory\s+(?P<memory>[0-9.]+)(?P<unit>[kmg])'
+    r'|(?P<level>ERROR|WARNING)[0-9 -]*: (?P<message>.*)$)',
+    re.M | re.I)
+
+MISSING_FILE_PATTERN = re.compile('file .* does not exist', re.I)
+
+MEMORY_UNITS = {'k': 1, 'm': 2**10, 'g': 2**20}
+
+# Summaries of local logs by path, with the size and mtime they were
+# read at, see read_log.
+_log_cache = {}
+
+
+def parse_log_text(text):
+    """Summarises the content of a SAS log, see the module docstring.
+
+    :param text: str (or bytes) content of the log.
+    :return summary: dict
+    """
+    if isinstance(text, bytes) and not isinstance(text, str):
+        text = text.decode('latin-1')
+    summary = {'n_records': -1,
+               'errors': [],
+               'warnings': [],
+               'file_missing': 0,
+               'real_time': 0.0,
+               'cpu_time': 0.0,
+               'memory': None}
+    for match in LOG_PATTERN.finditer(text):
+        groups = match.groupdict()
+        count = groups['created'] or groups['obs'] or groups['written']
+        if count is not None:
+            if summary['n_records'] == -1:
+                summary['n_records'] = int(count)
+        elif groups['timer'] is not None:
+            summary[groups['timer'].lower() + '_time'] += \
+                _seconds(groups['time'])
+        elif groups['memory'] is not None:
+            memory = (float(groups['memory'])
+                      * MEMORY_UNITS[groups['unit'].lower()])
+            summary['memory'] = max(summary['memory'] or 0, memory)
+        else:
+            message = groups['message'].strip()
+            summary[groups['level'].lower() + 's'].append(message)
+            if MISSING_FILE_PATTERN.search(message):
+                summary['file_missing'] = 1
+    return summary
+
+
+def read_log(path2log):
+    """Returns the summary of the SAS log file path2log, parsing it only
+    if it has changed since the last call.
+
+    :param path2log:
+    :return summary: dict, or None if path2log does not exist.
+    """
+    try:
+        stat = os.stat(path2log)
+    except OSError:
+        return None
+    key = (stat.st_size, stat.st_mtime)
+    cached = _log_cache.get(path2log)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(path2log, 'rb') as fd:
+        summary = parse_log_text(fd.read())
+    _log_cache[path2log] = [key, summary]
+    return summary
+
+
+def export_log_path(outfile, dname):
+    """Finds the log of the export of outfile in dname.  Besides the usual
+    wrds_export_<name>.log, logs of row-chunks may be named with an
+    underscore before the date, or "_allrows" for datasets without
+    dates.
+
+    :param outfile:
+    :param dname:
+    :return path2log: or None if there is no such log.
+    """
+    log_file = 'wrds_export_' + re.sub('\.tsv$', '.log', outfile)
+    partial_fname = re.sub('[0-9]*rows.*', '', log_file)
+    candidates = [log_file,
+                  re.sub('rows', '_allrows', log_file),
+                  partial_fname + '_' + log_file[len(partial_fname):]]
+    for fname in candidates:
+        if os.path.isfile(os.path.join(dname, fname)):
+            return os.path.join(dname, fname)
+    return None
+
+
+def read_export_log(outfile, dname):
+    """Returns the summary of the log of the export of outfile in dname.
+
+    :param outfile:
+    :param dname:
+    :return summary: dict, or None if there is no such log.
+    """
+    path2log = export_log_path(outfile, dname)
+    if path2log is None:
+        return None
+    return read_log(path2log)
+
+
+def _seconds(value):
+    """Converts a SAS step time, e.g. '0.01', '1:02.03' or '1:02:03.04',
+    to seconds."""
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part or 0)
+    return seconds
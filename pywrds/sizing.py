@@ -0,0 +1,135 @@
+__author__ = 'cpt'
+"""
+Choice of the period frequency and row-chunk size of a dataset from the
+sizes of its earlier downloads.
+
+utility.get_loop_frequency and utility.rows_per_file_adjusted give fixed
+guesses for every dataset.  Once the manifest (see manifest.Manifest)
+holds some downloaded periods of a dataset, SizeModel estimates from
+them its bytes per row and bytes per year, and picks:
+
+- the row window that makes a full row-chunk about target_bytes, rounded
+  down to 1, 2 or 5 times a power of 10 and kept within MIN_ROWS_PER_FILE
+  and MAX_ROWS_PER_FILE;
+- the coarsest of FREQUENCIES whose periods are expected to fit in
+  target_bytes, for years not downloaded yet.  Years already in the
+  manifest keep the frequency they were downloaded at, so sync.plan does
+  not download them again under other file names.
+
+Datasets with a table per period on WRDS, e.g. taq.ct, always use the
+frequency of utility.get_loop_frequency.  The bytes per year are taken
+from the largest of the N_RECENT latest periods, since most datasets
+grow over time.
+"""
+
+import re
+
+from _wrds_db_descriptors import WRDS_USER_QUOTA
+
+from . import utility
+
+
+# Size of a full row-chunk; the pipelined wrds_loop keeps several of
+# them on the server at once.
+TARGET_FILE_BYTES = WRDS_USER_QUOTA // 4
+
+MIN_ROWS_PER_FILE = 10**5
+MAX_ROWS_PER_FILE = 10**8
+
+FREQUENCIES = ['Y', 'M', 'D']
+
+# Periods per year at each frequency, counting trading days for 'D'.
+PERIODS_PER_YEAR = {'Y': 1, 'M': 12, 'D': 252}
+
+N_RECENT = 20
+
+
+class SizeModel(object):
+    """Estimates of the size of one dataset from its manifest records.
+    """
+
+    def __init__(self, dataset, records, target_bytes=TARGET_FILE_BYTES):
+        """
+        :param dataset:
+        :param records: the manifest records of dataset, see
+            manifest.Manifest.periods.
+        :param target_bytes:
+        """
+        self.dataset = dataset
+        self.target_bytes = target_bytes
+        self.year_frequency = {}
+        sized = []
+        for record in records:
+            if not record['ymd']:
+                continue
+            frequency = ymd_frequency(record['ymd'])
+            self.year_frequency[record['ymd'] // 10000] = frequency
+            if record['status'] == 'done' and record['n_rows'] and \
+                    record['n_bytes']:
+                sized.append([record['ymd'], frequency, record['n_rows'],
+                              record['n_bytes']])
+        [self.bytes_per_row, self.bytes_per_year] = [None, None]
+        if sized:
+            self.bytes_per_row = \
+                float(sum(x[3] for x in sized)) / sum(x[2] for x in sized)
+            self.bytes_per_year = max(x[3] * PERIODS_PER_YEAR[x[1]]
+                                      for x in sorted(sized)[-N_RECENT:])
+
+    def loop_frequency(self, year):
+        """Returns the frequency at which to query year, one of FREQUENCIES.
+
+        :param year:
+        :return frequency:
+        """
+        if year in self.year_frequency:
+            return self.year_frequency[year]
+        default = utility.get_loop_frequency(self.dataset, year)
+        if self.bytes_per_year is None or \
+                re.search('taq', self.dataset, flags=re.I):
+            return default
+        for frequency in FREQUENCIES:
+            if self.bytes_per_year <= \
+                    self.target_bytes * PERIODS_PER_YEAR[frequency]:
+                return frequency
+        return 'D'
+
+    def rows_per_file(self):
+        """Returns the number of rows to query in each row-chunk.
+
+        :return rows_per_file:
+        """
+        if self.bytes_per_row is None:
+            return utility.rows_per_file_adjusted(self.dataset)
+        return round_rows(self.target_bytes / self.bytes_per_row)
+
+
+def ymd_frequency(ymd):
+    """Returns the frequency of the period with key ymd, see
+    manifest.ymd_key.
+
+    :param ymd:
+    :return frequency: one of FREQUENCIES.
+    """
+    if ymd % 10000 == 0:
+        return 'Y'
+    if ymd % 100 == 0:
+        return 'M'
+    return 'D'
+
+
+def round_rows(n_rows):
+    """Rounds n_rows down to 1, 2 or 5 times a power of 10, within
+    MIN_ROWS_PER_FILE and MAX_ROWS_PER_FILE.
+
+    :param n_rows:
+    :return rows_per_file:
+    """
+    rows_per_file = MIN_ROWS_PER_FILE
+    power = 1
+    while power <= MAX_ROWS_PER_FILE:
+        for step in [1, 2, 5]:
+            if MIN_ROWS_PER_FILE <= step * power <= \
+                    min(n_rows, MAX_ROWS_PER_FILE):
+                rows_per_file = step * power
+        power *= 10
+    return rows_per_file
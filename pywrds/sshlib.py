@@ -402,12 +402,18 @@ def _check_stats(local_path, remote_path, ssh, sftp, domain, username, ports, la
     return [ssh, sftp, 1, 0]
 
 
-def _try_get(ssh, sftp, domain, username, remote_path, local_path, ports=[22]):
-    """_try_get(ssh, sftp, domain, username, remote_path, local_path, ports=[22])
+def _try_get(ssh, sftp, domain, username, remote_path, local_path, ports=[22],
+             n_streams=1):
+    """_try_get(ssh, sftp, domain, username, remote_path, local_path, ports=[22],
+             n_streams=1)
 
     Trys three times to download a file from the remote ssh server
     from remote_path to local_path.  If a connection error occurs, it
-    is re-established.
+    is re-established.  With n_streams > 1 the file is fetched over
+    that many parallel SFTP channels, see transfer.parallel_get.
+
+    Failed attempts keep the partial file and its checkpoint, so that
+    the next attempt resumes where the last one stopped.
 
     _try_get does *not* check that the remote file exists, that
     the local_path is not already in use, or that there is enough
@@ -419,17 +425,17 @@ def _try_get(ssh, sftp, domain, username, remote_path, local_path, ports=[22]):
     [success, numtrys, maxtrys] = [0, 0, 3]
     while success == 0 and numtrys < maxtrys:
         try:
-            sftp.get(remotepath=remote_path, localpath=local_path)
+            if n_streams > 1:
+                [success, stream_stats] = transfer.parallel_get(ssh,
+                    remote_path, local_path, n_streams=n_streams)
+                if not success:
+                    raise IOError('parallel_get failed: ' + remote_path)
+            else:
+                transfer.resumable_get(sftp, remote_path, local_path)
             success = 1
         except (paramiko.SSHException,paramiko.SFTPError,IOError,EOFError):
-            if os.path.exists(local_path):
-                os.remove(local_path)
             [ssh, sftp] = getSSH(ssh, sftp, domain=domain, username=username)
             numtrys += 1
-        except KeyboardInterrupt:
-            if os.path.exists(local_path):
-                os.remove(local_path)
-            raise KeyboardInterrupt
 
     return [success, ssh, sftp, time.time()-tic]
 
@@ -498,6 +504,22 @@ def _try_exec(command, ssh, sftp, domain, username, ports=[22]):
     return [success, stdin, stdout, stderr, ssh, sftp]
 
 
+def _wait_for_exit(channel, poll_interval=60):
+    """_wait_for_exit(channel, poll_interval=60)
+
+    Blocks until the command running on channel exits, however
+    long that takes.  The channel sets its status event as soon
+    as the exit status arrives, so this returns without any
+    polling delay; poll_interval only bounds each single wait,
+    which keeps the loop interruptible.
+
+    return exit_status (-1 if the channel closed without one)
+    """
+    while not channel.status_event.is_set():
+        channel.status_event.wait(poll_interval)
+    return channel.recv_exit_status()
+
+
 def print_func(level=1):
     """print_func(level=1)
 
@@ -572,6 +594,7 @@ def quick_password(prompt="Please enter your password: "):
 has_modules = {}
 try:
     import paramiko
+    from . import transfer
     has_modules['paramiko'] = 1
 except:
     print('Some pywrds.sshlib'
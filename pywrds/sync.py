@@ -0,0 +1,117 @@
+__author__ = 'cpt'
+"""
+Planning of the work needed to bring a dataset up to date.
+
+plan compares the periods wrds_loop expects (WrdsSession.get_ymd_range)
+against what is already in download_path, using only the manifest (see
+manifest.Manifest) and the directory indexes of dirindex, and sorts
+every period into one of:
+
+- 'done': its file exists and, if verify == 1, has the size recorded in
+  the manifest, or all of its row-chunks do (see
+  utility.chunks_complete).
+- 'empty': the manifest records that WRDS has no table for it, e.g. a
+  daily TAQ file for a holiday, and the period ended more than
+  EMPTY_RECHECK_DAYS before that was recorded.
+- 'resume': some of its row-chunks were downloaded, but not the last.
+- 'mismatched': its file exists but differs from the size recorded in
+  the manifest.  These are reported, not downloaded again.
+- 'download': nothing is known about it.
+
+Only 'resume' and 'download' periods are passed on to get_wrds, so a
+nightly run over an up to date dataset costs one manifest query and one
+hash lookup per period.
+"""
+
+import calendar
+import datetime
+import os
+import re
+
+from . import dirindex
+from . import sas_query
+from . import utility
+
+
+# Periods recorded as having no data so soon after they ended may just
+# not have been published yet, so they are checked again.
+EMPTY_RECHECK_DAYS = 7
+
+PLAN_KEYS = ['done', 'empty', 'resume', 'mismatched', 'download']
+
+
+def plan(dataset, ymds, output_dir, records, verify=1, tag=''):
+    """Sorts the periods ymds of dataset by the work they need, see the
+    module docstring.
+
+    :param dataset:
+    :param ymds: list of [year, month, day] expected, in date order.
+    :param output_dir: function of (dataset, year, month, day, tag)
+        giving the directory of a period's files, e.g.
+        WrdsSession._output_dir.
+    :param records: the manifest records of dataset, see
+        manifest.Manifest.periods, kept under
+        utility.dataset_key(dataset, tag).
+    :param verify: if 1, check the size of every existing file against
+        the manifest.
+    :param tag: of a filtered download, see utility.filter_tag.
+    :return sync_plan: dict of lists of [year, month, day], keyed by the
+        names in PLAN_KEYS.
+    """
+    by_ymd = dict((x['ymd'], x) for x in records)
+    sync_plan = dict((x, []) for x in PLAN_KEYS)
+    for [Y, M, D] in ymds:
+        record = by_ymd.get(Y*10000 + M*100 + D)
+        [dset2, outfile] = utility.fix_input_name(dataset, Y, M, D, [], tag)
+        dname = output_dir(dataset, Y, M, D, tag)
+        index = dirindex.get_index(dname)
+        chunks = index.chunks(re.sub('\.tsv$', '', outfile))
+        if index.exists(outfile):
+            if verify and record is not None and record['status'] == 'done' \
+                    and record['n_bytes'] is not None and record['n_bytes'] \
+                    != os.path.getsize(os.path.join(dname, outfile)):
+                sync_plan['mismatched'].append([Y, M, D])
+            else:
+                sync_plan['done'].append([Y, M, D])
+        elif record is not None and record['status'] == 'empty' and \
+                record['updated'] > _recheck_time(Y, M, D):
+            sync_plan['empty'].append([Y, M, D])
+        elif utility.chunks_complete(chunks):
+            # Kept in row-chunks, e.g. downloaded with recombine=0.
+            sync_plan['done'].append([Y, M, D])
+        elif chunks:
+            sync_plan['resume'].append([Y, M, D])
+        else:
+            sync_plan['download'].append([Y, M, D])
+    return sync_plan
+
+
+def work(sync_plan):
+    """Returns the periods of sync_plan that need get_wrds, in date order.
+
+    :param sync_plan: see plan.
+    :return ymds: list of [year, month, day]
+    """
+    return sorted(sync_plan['resume'] + sync_plan['download'])
+
+
+def summary(dataset, sync_plan):
+    """Describes sync_plan in one line, e.g. for wrds_loop to print.
+
+    :param dataset:
+    :param sync_plan:
+    :return line:
+    """
+    return (dataset + ': ' + ', '.join(str(len(sync_plan[x])) + ' ' + x
+                                       for x in PLAN_KEYS))
+
+
+def _recheck_time(year, month, day):
+    """Returns the time (seconds since the epoch) EMPTY_RECHECK_DAYS after
+    the end of the period, before which a record of it being empty may
+    be premature.
+    """
+    last = sas_query.period_date_range(year, month, day)[1]
+    last = datetime.date(last // 10000, last // 100 % 100, last % 100)
+    recheck = last + datetime.timedelta(days=EMPTY_RECHECK_DAYS + 1)
+    return calendar.timegm(recheck.timetuple())
@@ -0,0 +1,182 @@
+__author__ = 'cpt'
+"""
+Trading days of the New York Stock Exchange.
+
+get_ymd_range loops daily datasets such as taq.* and optionm.opprcd over
+the days returned by trading_days, so that no SAS job is started for a
+day on which the exchange was closed and WRDS has no table.
+
+The holidays are generated from the exchange's rules, so no calendar
+needs to be downloaded:
+
+- New Year's Day, January 1, or Monday January 2 if it is a Sunday.  It
+  is not made up when it falls on a Saturday.
+- Martin Luther King Jr. Day, the third Monday of January, from 1998.
+- Washington's Birthday, the third Monday of February (February 22
+  before 1971).
+- Good Friday.
+- Memorial Day, the last Monday of May (May 30 before 1971).
+- Juneteenth, June 19, from 2022.
+- Independence Day, July 4.
+- Labor Day, the first Monday of September.
+- Thanksgiving, the fourth Thursday of November.
+- Christmas, December 25.
+
+Fixed-date holidays other than New Year's Day move to the Friday before
+or the Monday after when they fall on a weekend.  SPECIAL_CLOSURES lists
+the unscheduled closings since 1970, e.g. for national days of mourning
+and hurricanes; closings before 1970 are not covered.
+
+With numpy installed the days of a year are filtered at once with
+numpy.is_busday, otherwise one day at a time.
+"""
+
+import datetime
+
+
+# Days the exchange closed outside its holiday rules, as yyyymmdd.
+SPECIAL_CLOSURES = [
+    19721228,  # President Truman's funeral
+    19730125,  # President Johnson's funeral
+    19770714,  # New York City blackout
+    19850927,  # Hurricane Gloria
+    19940427,  # President Nixon's funeral
+    20010911, 20010912, 20010913, 20010914,  # September 11 attacks
+    20040611,  # President Reagan's funeral
+    20070102,  # President Ford's day of mourning
+    20121029, 20121030,  # Hurricane Sandy
+    20181205,  # President G.H.W. Bush's day of mourning
+    20250109,  # President Carter's day of mourning
+]
+
+
+def holidays(year):
+    """Returns the days of year on which the exchange was closed, other
+    than weekends.
+
+    :param year:
+    :return holidays: sorted list of datetime.date
+    """
+    days = []
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() == 6:
+        days.append(datetime.date(year, 1, 2))
+    elif new_year.weekday() < 5:
+        days.append(new_year)
+    if year >= 1998:
+        days.append(_nth_weekday(year, 1, 0, 3))
+    if year >= 1971:
+        days.append(_nth_weekday(year, 2, 0, 3))
+        days.append(_nth_weekday(year, 5, 0, -1))
+    else:
+        days.append(_observed(datetime.date(year, 2, 22)))
+        days.append(_observed(datetime.date(year, 5, 30)))
+    days.append(_easter(year) - datetime.timedelta(days=2))
+    if year >= 2022:
+        days.append(_observed(datetime.date(year, 6, 19)))
+    days.append(_observed(datetime.date(year, 7, 4)))
+    days.append(_nth_weekday(year, 9, 0, 1))
+    days.append(_nth_weekday(year, 11, 3, 4))
+    days.append(_observed(datetime.date(year, 12, 25)))
+    days += [datetime.date(x // 10000, x // 100 % 100, x % 100)
+             for x in SPECIAL_CLOSURES if x // 10000 == year]
+    return sorted(set(days))
+
+
+def is_trading_day(year, month, day):
+    """Checks whether the exchange was open on a day.
+
+    :param year:
+    :param month:
+    :param day:
+    :return is_trading_day (bool): False also for invalid dates.
+    """
+    try:
+        date = datetime.date(year, month, day)
+    except ValueError:
+        return False
+    return date.weekday() < 5 and date not in holidays(year)
+
+
+def trading_days(year, month=0):
+    """Lists the days the exchange was open in a year, or in one month
+    of it.
+
+    :param year:
+    :param month: 0 for the whole year.
+    :return ymds: list of [year, month, day] in date order.
+    """
+    if month:
+        first = datetime.date(year, month, 1)
+        last = datetime.date(year + month // 12, month % 12 + 1, 1)
+    else:
+        [first, last] = [datetime.date(year, 1, 1),
+                         datetime.date(year + 1, 1, 1)]
+    closed = holidays(year)
+    if has_modules['numpy']:
+        return _trading_days_numpy(first, last, closed)
+    ymds = []
+    for ordinal in range(first.toordinal(), last.toordinal()):
+        date = datetime.date.fromordinal(ordinal)
+        if date.weekday() < 5 and date not in closed:
+            ymds.append([date.year, date.month, date.day])
+    return ymds
+
+
+def _trading_days_numpy(first, last, closed):
+    """trading_days for the days from first up to, not including, last.
+    """
+    days = numpy.arange(numpy.datetime64(first, 'D'),
+                        numpy.datetime64(last, 'D'))
+    days = days[numpy.is_busday(days, holidays=closed)]
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(int) + 1970
+    month_numbers = months.astype(int) % 12 + 1
+    day_numbers = (days - months).astype(int) + 1
+    return [[int(y), int(m), int(d)] for [y, m, d]
+            in zip(years, month_numbers, day_numbers)]
+
+
+def _observed(date):
+    """Moves a holiday falling on a Saturday to the Friday before, and
+    one falling on a Sunday to the Monday after."""
+    if date.weekday() == 5:
+        return date - datetime.timedelta(days=1)
+    if date.weekday() == 6:
+        return date + datetime.timedelta(days=1)
+    return date
+
+
+def _nth_weekday(year, month, weekday, n):
+    """Returns the n-th given weekday (Monday is 0) of a month, or the
+    last one if n == -1."""
+    if n == -1:
+        last = datetime.date(year + month // 12, month % 12 + 1, 1) - \
+            datetime.timedelta(days=1)
+        return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+    first = datetime.date(year, month, 1)
+    return first + datetime.timedelta(
+        days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+
+
+def _easter(year):
+    """Returns Easter Sunday of year in the Gregorian calendar, by the
+    anonymous Gregorian algorithm."""
+    [a, b, c] = [year % 19, year // 100, year % 100]
+    [d, e] = [b // 4, b % 4]
+    [f, i, k] = [(b + 8) // 25, c // 4, c % 4]
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month = (h + l - 7 * m + 114) // 31
+    day = (h + l - 7 * m + 114) % 31 + 1
+    return datetime.date(year, month, day)
+
+
+has_modules = {}
+try:
+    import numpy
+    has_modules['numpy'] = 1
+except ImportError:
+    has_modules['numpy'] = 0
@@ -0,0 +1,562 @@
+__author__ = 'cpt'
+"""
+Download engine for pulling large files off the WRDS server over SFTP.
+
+A single SFTP channel is limited by its window and by the round trip of
+each read request, so on high-latency links one sftp.get is far slower
+than the link itself.  parallel_get splits the remote file into byte
+ranges and fetches each range over its own SFTP channel with pipelined
+reads, writing every range straight to its offset in a preallocated
+local file.  Like sshlib, nothing in here is specific to WRDS.
+
+Downloads are resumable: while a file is being written, a small sidecar
+checkpoint <local_path>.ckpt records the size and mtime of the remote
+file and, for each byte range, the offset up to which the local data has
+been fsync'ed.  A later attempt, even from a new process, continues from
+those offsets, unless the remote file has changed in the meantime.
+
+Files compressed on the server (see COMPRESSORS) are downloaded with
+decompress_get, which inflates them while they stream to disk.  Those
+transfers cannot be resumed, since the decompressor state is not saved.
+
+Every download passes what it writes through a CountingSink, which
+counts bytes and newlines and keeps a running CRC-32 in the same pass,
+and stores the result with utility.record_file_meta, so that the file
+need not be read again to check its number of rows.  Files fetched by
+several streams at once get no CRC-32, as the ranges arrive out of
+order.  The sink also feeds a tsv_index.IndexBuilder for tsv files
+downloaded from start to end in one go, see new_index.
+"""
+
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import paramiko
+
+from . import tsv_index
+from . import utility
+
+
+# Bytes requested from the server per readv batch of one stream.
+BLOCK_SIZE = 8 * 2**20
+
+# Files smaller than this are not worth splitting across streams.
+PARALLEL_MIN_SIZE = 64 * 2**20
+
+# Bytes written by a stream between two checkpoints.
+CHECKPOINT_EVERY = 32 * 2**20
+
+# Shell command prefix run on the server to compress a file in place, and
+# the extension it adds, for each supported compression.
+COMPRESSORS = {
+    'gzip': ['gzip -f -1 ', '.gz'],
+    'zstd': ['zstd -q -f --rm ', '.zst'],
+}
+
+
+class CountingSink(object):
+    """Writes to a local file object while counting the bytes and newlines
+    written and updating their CRC-32.
+
+    The counts can start from those of a partial download, so that a
+    resumed range carries on from its checkpoint.  If index is given, the
+    data is also fed to it.
+    """
+
+    def __init__(self, fd, n_bytes=0, n_newlines=0, crc32=0, index=None):
+        self.fd = fd
+        self.n_bytes = n_bytes
+        self.n_newlines = n_newlines
+        self.crc32 = crc32
+        self.index = index
+
+    def write(self, data):
+        self.fd.write(data)
+        self.n_bytes += len(data)
+        self.n_newlines += data.count(b'\n')
+        self.crc32 = zlib.crc32(data, self.crc32) & 0xffffffff
+        if self.index is not None:
+            self.index.write(data)
+
+
+def new_index(local_path):
+    """Returns a tsv_index.IndexBuilder for a download to local_path, or
+    None if it is not a tsv file or numpy is not installed.
+
+    :param local_path:
+    :return index:
+    """
+    if tsv_index.has_modules['numpy'] and \
+            '.tsv' in os.path.basename(local_path):
+        return tsv_index.IndexBuilder(tsv_index.dataset_from_path(local_path))
+    return None
+
+
+def record_download(local_path, n_newlines, crc32=None, index=None):
+    """Stores what was counted while local_path was downloaded: its
+    metadata record and, if one was built, its row index.
+
+    :param local_path:
+    :param n_newlines:
+    :param crc32:
+    :param index: IndexBuilder fed with the whole file, or None.
+    :return:
+    """
+    utility.record_file_meta(local_path, n_newlines, crc32)
+    if index is not None:
+        index.finish()
+        tsv_index.write_index(local_path, index)
+
+
+def split_ranges(size, n_streams):
+    """Splits a file of size bytes into n_streams contiguous byte ranges
+    [start, end) of (nearly) equal length.
+
+    :param size:
+    :param n_streams:
+    :return ranges: list of [start, end]
+    """
+    n_streams = max(1, min(n_streams, size))
+    step = size // n_streams
+    ranges = [[i * step, (i + 1) * step] for i in range(n_streams)]
+    if ranges:
+        ranges[-1][1] = size
+    return ranges
+
+
+def preallocate(local_path, size):
+    """Creates (or truncates) local_path and reserves size bytes for it,
+    so that streams can write their ranges at any offset.
+
+    :param local_path:
+    :param size:
+    :return:
+    """
+    with open(local_path, 'wb') as fd:
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd.fileno(), 0, size)
+            except OSError:
+                fd.truncate(size)
+        else:
+            fd.truncate(size)
+
+
+def checkpoint_path(local_path):
+    """Returns the path of the sidecar checkpoint for local_path.
+
+    :param local_path:
+    :return ckpt_path:
+    """
+    return local_path + '.ckpt'
+
+
+def save_checkpoint(local_path, remote_path, remote_stat, ranges):
+    """Atomically writes the checkpoint of a partial download.
+
+    :param local_path:
+    :param remote_path:
+    :param remote_stat: stat of the remote file (st_size, st_mtime).
+    :param ranges: list of [start, verified_offset, end, n_newlines, crc32]
+    :return:
+    """
+    ckpt = {'remote_path': remote_path,
+            'size': remote_stat.st_size,
+            'mtime': remote_stat.st_mtime,
+            'ranges': ranges}
+    ckpt_path = checkpoint_path(local_path)
+    with open(ckpt_path + '--writing', 'w') as fd:
+        fd.write(json.dumps(ckpt))
+    if os.name == 'nt' and os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+    os.rename(ckpt_path + '--writing', ckpt_path)
+
+
+def load_checkpoint(local_path, remote_path, remote_stat):
+    """Returns the byte ranges recorded for a partial download of
+    remote_path into local_path, or None if there is nothing valid to
+    resume from.
+
+    A checkpoint is only valid if it was written for the same remote
+    path, the remote file still has the recorded size and mtime, and the
+    local file still exists, so a stale partial is never appended to.
+
+    :param local_path:
+    :param remote_path:
+    :param remote_stat:
+    :return ranges: list of [start, verified_offset, end, n_newlines,
+        crc32], or None
+    """
+    ckpt_path = checkpoint_path(local_path)
+    if not (os.path.exists(ckpt_path) and os.path.exists(local_path)):
+        return None
+    try:
+        with open(ckpt_path, 'r') as fd:
+            ckpt = json.loads(fd.read())
+    except (IOError, ValueError):
+        return None
+    if (ckpt.get('remote_path') != remote_path
+            or ckpt.get('size') != remote_stat.st_size
+            or ckpt.get('mtime') != remote_stat.st_mtime):
+        return None
+    if any(len(x) != 5 for x in ckpt['ranges']):
+        # Written without newline counts or CRC-32, which cannot be
+        # recovered.
+        return None
+    return ckpt['ranges']
+
+
+def clear_checkpoint(local_path):
+    """Removes the checkpoint of local_path, if any.
+
+    :param local_path:
+    :return:
+    """
+    ckpt_path = checkpoint_path(local_path)
+    if os.path.exists(ckpt_path):
+        os.remove(ckpt_path)
+
+
+def checkpoint_matches(sftp, remote_path, local_path):
+    """Checks whether local_path is a resumable partial download of the
+    file currently at remote_path.
+
+    :param sftp:
+    :param remote_path:
+    :param local_path:
+    :return resumable (bool):
+    """
+    if not os.path.exists(checkpoint_path(local_path)):
+        return 0
+    try:
+        remote_stat = sftp.stat(remote_path)
+    except (IOError, EOFError, paramiko.SSHException):
+        return 0
+    return int(load_checkpoint(local_path, remote_path, remote_stat)
+               is not None)
+
+
+def get_range(sftp, remote_path, local_path, progress, block_size=BLOCK_SIZE,
+              checkpoint_every=CHECKPOINT_EVERY, checkpoint=None, index=None):
+    """Copies the bytes [progress[1], progress[2]) of remote_path into the
+    same offsets of the existing file local_path.
+
+    Reads are issued through SFTPFile.readv, which keeps many read
+    requests in flight instead of waiting for each one in turn.  Every
+    checkpoint_every bytes the local file is fsync'ed, progress[1] is
+    advanced to the verified offset, progress[3] and progress[4] to the
+    newlines and CRC-32 of [start, verified_offset), and checkpoint() is
+    called.
+
+    :param sftp:
+    :param remote_path:
+    :param local_path:
+    :param progress: [start, verified_offset, end, n_newlines, crc32],
+        updated in place.
+    :param block_size:
+    :param checkpoint_every:
+    :param checkpoint: callable run after each verified advance.
+    :param index: IndexBuilder fed with the data, which must then start
+        at offset 0.
+    :return n_bytes: number of bytes written.
+    """
+    n_bytes = 0
+    rfd = sftp.open(remote_path, 'rb')
+    try:
+        with open(local_path, 'r+b') as lfd:
+            offset = progress[1]
+            end = progress[2]
+            lfd.seek(offset)
+            sink = CountingSink(lfd, 0, progress[3], progress[4], index)
+            unsynced = 0
+            while offset < end:
+                length = min(block_size, end - offset)
+                for data in rfd.readv([(offset, length)]):
+                    sink.write(data)
+                offset += length
+                unsynced += length
+                if unsynced >= checkpoint_every or offset >= end:
+                    lfd.flush()
+                    os.fsync(lfd.fileno())
+                    # One slice assignment, so that a checkpoint written by
+                    # another stream never sees the offset without its count.
+                    progress[1:] = [offset, end, sink.n_newlines, sink.crc32]
+                    unsynced = 0
+                    if checkpoint:
+                        checkpoint()
+            n_bytes = sink.n_bytes
+    finally:
+        rfd.close()
+    return n_bytes
+
+
+def resumable_get(sftp, remote_path, local_path, block_size=BLOCK_SIZE,
+                  checkpoint_every=CHECKPOINT_EVERY):
+    """Downloads remote_path to local_path over a single SFTP channel,
+    continuing a previous partial download if its checkpoint is valid.
+
+    Network errors propagate to the caller with the checkpoint left in
+    place, so that the caller can simply call resumable_get again.
+
+    :param sftp:
+    :param remote_path:
+    :param local_path:
+    :param block_size:
+    :param checkpoint_every:
+    :return n_bytes: number of bytes transferred by this call.
+    """
+    remote_stat = sftp.stat(remote_path)
+    ranges = load_checkpoint(local_path, remote_path, remote_stat)
+    index = None
+    if ranges and len(ranges) == 1:
+        # Drop anything written after the last verified offset.  The
+        # bytes before it are not indexed again.
+        with open(local_path, 'r+b') as fd:
+            fd.truncate(ranges[0][1])
+    else:
+        ranges = [[0, 0, remote_stat.st_size, 0, 0]]
+        open(local_path, 'wb').close()
+        index = new_index(local_path)
+    save_checkpoint(local_path, remote_path, remote_stat, ranges)
+
+    def checkpoint():
+        save_checkpoint(local_path, remote_path, remote_stat, ranges)
+
+    n_bytes = get_range(sftp, remote_path, local_path, ranges[0], block_size,
+                        checkpoint_every, checkpoint, index)
+    clear_checkpoint(local_path)
+    record_download(local_path, ranges[0][3], ranges[0][4], index)
+    return n_bytes
+
+
+def parallel_get(ssh, remote_path, local_path, n_streams=4,
+                 block_size=BLOCK_SIZE, max_tries=3,
+                 checkpoint_every=CHECKPOINT_EVERY):
+    """Downloads remote_path to local_path over n_streams SFTP channels
+    in parallel.
+
+    Each stream opens its own channel on the ssh transport, so the
+    streams do not share one SFTP window.  A stream that hits a network
+    error reopens its channel and resumes its range from the last
+    verified offset, up to max_tries times.  If the download still fails
+    the checkpoint is kept, and the next call picks up the unfinished
+    ranges.
+
+    The per-stream statistics are [start, end, n_bytes, seconds] so that
+    callers can report the throughput of each stream.
+
+    :param ssh: connected paramiko.SSHClient.
+    :param remote_path:
+    :param local_path:
+    :param n_streams:
+    :param block_size:
+    :param max_tries:
+    :param checkpoint_every:
+    :return [success (bool), stream_stats]:
+    """
+    sftp = ssh.open_sftp()
+    remote_stat = sftp.stat(remote_path)
+    sftp.close()
+
+    ranges = load_checkpoint(local_path, remote_path, remote_stat)
+    # Only a single range, read in one go from offset 0, can be indexed;
+    # builder[0] is dropped if the range has to be retried.
+    builder = [None]
+    if not (ranges and os.stat(local_path).st_size == remote_stat.st_size):
+        ranges = [[start, start, end, 0, 0] for [start, end]
+                  in split_ranges(remote_stat.st_size, n_streams)]
+        preallocate(local_path, remote_stat.st_size)
+        if len(ranges) == 1:
+            builder = [new_index(local_path)]
+    lock = threading.Lock()
+
+    def checkpoint():
+        with lock:
+            save_checkpoint(local_path, remote_path, remote_stat, ranges)
+    checkpoint()
+
+    stream_stats = [[x[0], x[2], 0, 0.0] for x in ranges]
+    failures = []
+
+    def stream(index):
+        [n_tries, tic] = [0, time.time()]
+        while ranges[index][1] < ranges[index][2] and n_tries < max_tries:
+            sftp = None
+            try:
+                sftp = ssh.open_sftp()
+                stream_stats[index][2] += get_range(
+                    sftp, remote_path, local_path, ranges[index], block_size,
+                    checkpoint_every, checkpoint, builder[0])
+            except (IOError, EOFError, paramiko.SSHException):
+                n_tries += 1
+                builder[0] = None
+            finally:
+                if sftp:
+                    sftp.close()
+        stream_stats[index][3] = time.time() - tic
+        if ranges[index][1] < ranges[index][2]:
+            failures.append(index)
+
+    threads = [threading.Thread(target=stream, args=(i,))
+               for i in range(len(ranges))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(0.5)
+
+    success = int(not failures)
+    if success:
+        clear_checkpoint(local_path)
+        crc32 = None
+        if len(ranges) == 1:
+            crc32 = ranges[0][4]
+        record_download(local_path, sum(x[3] for x in ranges), crc32,
+                        builder[0])
+    return [success, stream_stats]
+
+
+def decompressor(compression):
+    """Returns a streaming decompressor object for compression, one of
+    the keys of COMPRESSORS.
+
+    :param compression:
+    :return decompressor: object with decompress(data) and flush().
+    """
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if not has_modules['zstandard']:
+            raise ValueError('zstd decompression requires the package '
+                             '"zstandard".  Please "pip install zstandard".')
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('Unknown compression: ' + repr(compression))
+
+
+def decompress_get(sftp, remote_path, local_path, compression,
+                   block_size=BLOCK_SIZE):
+    """Downloads the compressed file remote_path and writes its
+    decompressed content to local_path as it arrives.
+
+    :param sftp:
+    :param remote_path:
+    :param local_path:
+    :param compression: one of the keys of COMPRESSORS.
+    :param block_size:
+    :return n_bytes: number of compressed bytes transferred.
+    :raises: one of DECOMPRESS_ERRORS if remote_path is corrupt or
+        truncated.
+    """
+    remote_size = sftp.stat(remote_path).st_size
+    dec = decompressor(compression)
+    n_bytes = 0
+    rfd = sftp.open(remote_path, 'rb')
+    try:
+        with open(local_path, 'wb') as lfd:
+            sink = CountingSink(lfd, index=new_index(local_path))
+            tail = b''
+            while n_bytes < remote_size:
+                length = min(block_size, remote_size - n_bytes)
+                for data in rfd.readv([(n_bytes, length)]):
+                    sink.write(dec.decompress(data))
+                    tail = (tail + data)[-4:]
+                n_bytes += length
+            if hasattr(dec, 'flush'):
+                sink.write(dec.flush())
+            # Truncated input decompresses without complaint.  A gzip file
+            # ends with the size of its content modulo 2**32.
+            truncated = not getattr(dec, 'eof', True)
+            if compression == 'gzip':
+                truncated = truncated or len(tail) < 4 or \
+                    struct.unpack('<I', tail)[0] != sink.n_bytes % 2**32
+            if truncated:
+                raise zlib.error('Truncated ' + compression + ' file: ' +
+                                 remote_path)
+    finally:
+        rfd.close()
+    record_download(local_path, sink.n_newlines, sink.crc32, sink.index)
+    return n_bytes
+
+
+def stream_channel(channel, local_path, stderr_path=None,
+                   block_size=2**20, poll_interval=1):
+    """Writes everything a remote command sends on stdout to local_path,
+    and its stderr to stderr_path, until the command exits.
+
+    Both streams are drained together: a command blocked on a full
+    stderr window would otherwise never finish its stdout.
+
+    :param channel: paramiko channel of a running exec_command.
+    :param local_path:
+    :param stderr_path: where to write stderr, discarded if None.
+    :param block_size:
+    :param poll_interval: seconds to wait for stdout before checking
+        stderr again.
+    :return [n_bytes, exit_status]:
+    """
+    err_fd = None
+    if stderr_path:
+        err_fd = open(stderr_path, 'wb')
+    channel.settimeout(poll_interval)
+    try:
+        with open(local_path, 'wb') as out_fd:
+            sink = CountingSink(out_fd, index=new_index(local_path))
+            while True:
+                try:
+                    data = channel.recv(block_size)
+                except socket.timeout:
+                    data = None
+                if data:
+                    sink.write(data)
+                while channel.recv_stderr_ready():
+                    err_data = channel.recv_stderr(block_size)
+                    if err_fd:
+                        err_fd.write(err_data)
+                if data is not None and not data:
+                    # stdout is closed, the command has finished writing.
+                    break
+        while not channel.exit_status_ready() or channel.recv_stderr_ready():
+            if channel.recv_stderr_ready():
+                err_data = channel.recv_stderr(block_size)
+                if err_fd:
+                    err_fd.write(err_data)
+            else:
+                channel.status_event.wait(poll_interval)
+    finally:
+        if err_fd:
+            err_fd.close()
+    record_download(local_path, sink.n_newlines, sink.crc32, sink.index)
+    return [sink.n_bytes, channel.recv_exit_status()]
+
+
+def print_stream_stats(fname, stream_stats):
+    """Prints the throughput of each stream of a parallel_get call.
+
+    :param fname:
+    :param stream_stats:
+    :return:
+    """
+    for [i, [start, end, n_bytes, seconds]] in enumerate(stream_stats):
+        mbps = float(n_bytes) / 2**20 / max(seconds, 1e-6)
+        print('retrieve_file: ' + fname + ' stream ' + str(i) + ' bytes '
+              + str(start) + '-' + str(end) + ': ' + '%.2f' % mbps
+              + ' MB/s (' + '%.1f' % seconds + 's)')
+
+
+has_modules = {}
+try:
+    import zstandard
+    has_modules['zstandard'] = 1
+except ImportError:
+    has_modules['zstandard'] = 0
+
+# Raised by decompress_get on corrupt or truncated input.
+DECOMPRESS_ERRORS = (zlib.error,)
+if has_modules['zstandard']:
+    DECOMPRESS_ERRORS += (zstandard.ZstdError,)
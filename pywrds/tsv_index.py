@@ -0,0 +1,418 @@
+__author__ = 'cpt'
+"""
+Row-offset index of the tsv files downloaded by pywrds.
+
+Finding row 5,000,000 of a tsv, or the rows of one week of a year of
+taq.ct, otherwise means reading the file from the top.  The index kept
+in the hidden sidecar .<name>.tsv.idx records, for every block of
+BLOCK_ROWS rows, the row number and byte offset where the block starts
+and the smallest and largest value of the dataset's date variable (see
+utility.wrds_datevar) within it, so that read_rows and read_date_rows
+can seek straight to the blocks they need.
+
+The index costs no extra pass over the data: IndexBuilder is fed the
+bytes as transfer writes them to disk, and combine_tsv_files merges the
+indexes of the row-chunks into one for the recombined file.  Files that
+were not indexed on the way in (resumed or multi-stream downloads, or
+chunks with '\r\n' line endings) can be indexed with build_index.
+
+Dates are recorded as yyyymmdd integers, parsed from yyyymmdd or DATE9.
+(e.g. 02JAN2008) values.  Building an index requires numpy, reading one
+does not.
+"""
+
+import bisect
+import json
+import os
+import re
+
+from . import utility
+
+
+# Rows per index block.
+BLOCK_ROWS = 2**14
+
+INDEX_EXTENSION = '.idx'
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def index_path(path2file):
+    """Returns the path of the index of path2file.
+
+    :param path2file:
+    :return index_path:
+    """
+    return utility.sidecar_path(path2file, INDEX_EXTENSION)
+
+
+def dataset_from_path(path2file):
+    """Guesses the dataset of a downloaded file from its name, e.g.
+    'comp.fundq' for comp_fundq2008rows1to10.tsv, for wrds_datevar.
+
+    :param path2file:
+    :return dataset:
+    """
+    fname = os.path.basename(path2file).lstrip('.')
+    fname = re.sub('_?[0-9]*(rows[0-9]+to[0-9]+)?\.tsv.*$', '', fname)
+    return fname.replace('_', '.', 1)
+
+
+class IndexBuilder(object):
+    """Builds the index of a tsv file from its bytes, fed in order with
+    write() as the file is written.  Call finish() after the last write.
+
+    Newlines and tabs are located with numpy, so each write costs a few
+    vectorised scans of the data rather than a loop over its rows.
+    """
+
+    def __init__(self, dataset=None, block_rows=BLOCK_ROWS):
+        self.dataset = dataset
+        self.block_rows = block_rows
+        self.date_var = None
+        self.date_col = None
+        self.header = None
+        self.n_bytes = 0
+        self.n_rows = 0
+        self.partial = b''
+        # [first_row, offset, min_date, max_date] per block.
+        self.blocks = []
+
+    def write(self, data):
+        if not data:
+            return
+        buf = self.partial + data if self.partial else data
+        base = self.n_bytes - len(self.partial)
+        self.n_bytes += len(data)
+        arr = numpy.frombuffer(buf, numpy.uint8)
+        ends = numpy.flatnonzero(arr == 10)
+        if not len(ends):
+            self.partial = buf
+            return
+        self.partial = buf[ends[-1] + 1:]
+        starts = numpy.empty(len(ends), numpy.int64)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        if self.header is None:
+            self._read_header(buf[:ends[0]])
+            [starts, ends] = [starts[1:], ends[1:]]
+        if len(starts):
+            self._add_rows(arr, base, starts, ends)
+
+    def finish(self):
+        """Indexes a last line without a trailing newline."""
+        if self.partial:
+            self.write(b'\n')
+            self.n_bytes -= 1
+
+    def _read_header(self, line):
+        self.header = [x.decode('latin-1')
+                       for x in line.rstrip(b'\r').split(b'\t')]
+        dataset = self.dataset
+        if dataset is None:
+            dataset = 'unknown'
+        date_var = utility.wrds_datevar(dataset).lower()
+        names = [x.lower() for x in self.header]
+        if date_var in names:
+            self.date_col = names.index(date_var)
+            self.date_var = self.header[self.date_col]
+
+    def _add_rows(self, arr, base, starts, ends):
+        rows = self.n_rows + numpy.arange(len(starts))
+        self.n_rows += len(starts)
+        first = numpy.flatnonzero(rows % self.block_rows == 0)
+        for i in first:
+            self.blocks.append([int(rows[i]), int(base + starts[i]),
+                                None, None])
+        if self.date_col is None:
+            return
+        dates = _parse_dates(arr, starts, ends, self.date_col)
+        valid = dates > 0
+        block_ids = rows // self.block_rows
+        for block_id in numpy.unique(block_ids[valid]):
+            values = dates[valid & (block_ids == block_id)]
+            block = self.blocks[block_id]
+            [low, high] = [int(values.min()), int(values.max())]
+            if block[2] is None or low < block[2]:
+                block[2] = low
+            if block[3] is None or high > block[3]:
+                block[3] = high
+
+
+def _parse_dates(arr, starts, ends, date_col):
+    """Parses the field date_col of the lines [starts, ends) of arr as a
+    date.
+
+    :return dates: yyyymmdd per line, 0 where it is not a date.
+    """
+    n_lines = len(starts)
+    dates = numpy.zeros(n_lines, numpy.int64)
+    tabs = numpy.flatnonzero(arr == 9)
+    if date_col and not len(tabs):
+        return dates
+    ends = ends - ((ends > starts) & (arr[ends - 1] == 13))
+    # The k-th tab of a line is the k-th tab at or after its start.
+    first_tab = numpy.searchsorted(tabs, starts)
+    ok = numpy.ones(n_lines, bool)
+    if date_col == 0:
+        field_starts = starts
+    else:
+        idx = first_tab + date_col - 1
+        ok &= idx < len(tabs)
+        field_starts = tabs[numpy.minimum(idx, len(tabs) - 1)] + 1
+        ok &= field_starts <= ends
+    field_ends = ends
+    if len(tabs):
+        idx = first_tab + date_col
+        field_ends = numpy.where(idx < len(tabs),
+                                 tabs[numpy.minimum(idx, len(tabs) - 1)], ends)
+        field_ends = numpy.minimum(field_ends, ends)
+    lengths = field_ends - field_starts
+
+    for length in [8, 9]:
+        rows = numpy.flatnonzero(ok & (lengths == length))
+        if not len(rows):
+            continue
+        chars = arr[field_starts[rows, None] + numpy.arange(length)]
+        if length == 8:
+            digits = chars.astype(numpy.int64) - 48
+            good = ((digits >= 0) & (digits <= 9)).all(axis=1)
+            values = digits.dot(10**numpy.arange(7, -1, -1))
+        else:
+            digits = chars[:, [0, 1, 5, 6, 7, 8]].astype(numpy.int64) - 48
+            good = ((digits >= 0) & (digits <= 9)).all(axis=1)
+            codes = (chars[:, 2].astype(numpy.int64) * 65536
+                     + chars[:, 3].astype(numpy.int64) * 256
+                     + chars[:, 4].astype(numpy.int64)) & ~0x202020
+            month = numpy.zeros(len(rows), numpy.int64)
+            for (i, name) in enumerate(MONTHS):
+                code = ord(name[0]) * 65536 + ord(name[1]) * 256 + ord(name[2])
+                month[codes == code] = i + 1
+            good &= month > 0
+            values = (digits[:, 2:].dot([1000, 100, 10, 1]) * 10000
+                      + month * 100 + digits[:, :2].dot([10, 1]))
+        month = values // 100 % 100
+        day = values % 100
+        good &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+        dates[rows[good]] = values[good]
+    return dates
+
+
+def write_index(path2file, builder):
+    """Stores the index built by builder for path2file, which must be
+    fully written.
+
+    :param path2file:
+    :param builder: finished IndexBuilder.
+    :return:
+    """
+    stat = os.stat(path2file)
+    index = {'size': stat.st_size,
+             'mtime': stat.st_mtime,
+             'block_rows': builder.block_rows,
+             'n_rows': builder.n_rows,
+             'date_var': builder.date_var,
+             'date_col': builder.date_col,
+             'blocks': builder.blocks}
+    with open(index_path(path2file), 'w') as fd:
+        fd.write(json.dumps(index))
+
+
+def read_index(path2file):
+    """Returns the index of path2file as a dict with keys 'size', 'mtime',
+    'block_rows', 'n_rows', 'date_var', 'date_col' and 'blocks', or None
+    if there is no index or the file has changed since it was built.
+
+    :param path2file:
+    :return index:
+    """
+    path2index = index_path(path2file)
+    if not os.path.exists(path2index):
+        return None
+    stat = os.stat(path2file)
+    try:
+        with open(path2index, 'r') as fd:
+            index = json.loads(fd.read())
+    except (IOError, ValueError):
+        return None
+    if index.get('size') != stat.st_size or \
+            index.get('mtime') != stat.st_mtime:
+        return None
+    return index
+
+
+def build_index(path2file, dataset=None, block_rows=BLOCK_ROWS,
+                block_size=utility.COPY_BLOCK_SIZE):
+    """Reads path2file once and writes its index.
+
+    :param path2file:
+    :param dataset: defaults to dataset_from_path(path2file).
+    :param block_rows:
+    :param block_size:
+    :return index:
+    """
+    if dataset is None:
+        dataset = dataset_from_path(path2file)
+    builder = IndexBuilder(dataset, block_rows)
+    with open(path2file, 'rb') as fd:
+        while True:
+            data = fd.read(block_size)
+            if not data:
+                break
+            builder.write(data)
+    builder.finish()
+    write_index(path2file, builder)
+    return read_index(path2file)
+
+
+def merge_indexes(paths, out_path, positions):
+    """Writes the index of out_path, the concatenation of the bodies of the
+    tsv files in paths, from their indexes, without reading any data.
+
+    :param paths: files that were concatenated.
+    :param out_path:
+    :param positions: [body_offset, out_offset] per path: where the rows of
+        the file start in it, and where they were copied to in out_path.
+    :return merged (bool): 0 if some file in paths had no index.
+    """
+    indexes = [read_index(path) for path in paths]
+    if not indexes or None in indexes:
+        return 0
+    [blocks, n_rows] = [[], 0]
+    for (index, [body_offset, out_offset]) in zip(indexes, positions):
+        for [row, offset, low, high] in index['blocks']:
+            blocks.append([n_rows + row, out_offset + offset - body_offset,
+                           low, high])
+        n_rows += index['n_rows']
+    stat = os.stat(out_path)
+    index = dict(indexes[0])
+    index.update({'size': stat.st_size,
+                  'mtime': stat.st_mtime,
+                  'block_rows': max(x['block_rows'] for x in indexes),
+                  'n_rows': n_rows,
+                  'blocks': blocks})
+    with open(index_path(out_path), 'w') as fd:
+        fd.write(json.dumps(index))
+    return 1
+
+
+def row_offset(path2file, row):
+    """Finds where to start reading path2file to get to row (counted from
+    0, after the header).
+
+    :param path2file:
+    :param row:
+    :return [block_row, offset]: the first row of the block holding row
+        and its byte offset, or None if path2file has no index.
+    """
+    index = read_index(path2file)
+    if index is None or not index['blocks']:
+        return None
+    rows = [x[0] for x in index['blocks']]
+    i = max(bisect.bisect_right(rows, row) - 1, 0)
+    return index['blocks'][i][:2]
+
+
+def date_offsets(path2file, start=None, end=None):
+    """Lists the byte ranges of path2file whose blocks may hold rows dated
+    from start to end.  Blocks without dates are always included.
+
+    :param path2file:
+    :param start: yyyymmdd, or None.
+    :param end: yyyymmdd, or None.
+    :return ranges: list of [first_row, offset, end_offset], or None if
+        path2file has no index.
+    """
+    index = read_index(path2file)
+    if index is None:
+        return None
+    blocks = index['blocks']
+    ranges = []
+    for (i, [row, offset, low, high]) in enumerate(blocks):
+        if low is not None and ((start is not None and high < start) or
+                                (end is not None and low > end)):
+            continue
+        end_offset = index['size']
+        if i + 1 < len(blocks):
+            end_offset = blocks[i + 1][1]
+        if ranges and ranges[-1][2] == offset:
+            ranges[-1][2] = end_offset
+        else:
+            ranges.append([row, offset, end_offset])
+    return ranges
+
+
+def read_rows(path2file, start_row, n_rows):
+    """Returns the lines of rows start_row to start_row + n_rows - 1
+    (counted from 0, after the header) of path2file, seeking to the
+    nearest indexed block if there is an index.
+
+    :param path2file:
+    :param start_row:
+    :param n_rows:
+    :return lines: list of bytes, without line endings.
+    """
+    found = row_offset(path2file, start_row)
+    lines = []
+    with open(path2file, 'rb') as fd:
+        if found is None:
+            fd.readline()
+            row = 0
+        else:
+            [row, offset] = found
+            fd.seek(offset)
+        for line in fd:
+            if row >= start_row + n_rows:
+                break
+            if row >= start_row:
+                lines.append(line.rstrip(b'\r\n'))
+            row += 1
+    return lines
+
+
+def read_date_rows(path2file, start=None, end=None):
+    """Returns the lines of path2file dated from start to end, reading only
+    the blocks that may hold them.
+
+    :param path2file:
+    :param start: yyyymmdd, or None.
+    :param end: yyyymmdd, or None.
+    :return lines: list of bytes, without line endings, or None if
+        path2file has no index with a date column.
+    """
+    index = read_index(path2file)
+    if index is None or index['date_col'] is None:
+        return None
+    lines = []
+    with open(path2file, 'rb') as fd:
+        for [row, offset, end_offset] in date_offsets(path2file, start, end):
+            fd.seek(offset)
+            for line in fd.read(end_offset - offset).splitlines():
+                fields = line.split(b'\t')
+                if len(fields) <= index['date_col']:
+                    continue
+                date = _parse_date(fields[index['date_col']])
+                if date and (start is None or date >= start) and \
+                        (end is None or date <= end):
+                    lines.append(line.rstrip(b'\r'))
+    return lines
+
+
+def _parse_date(value):
+    if len(value) == 8 and value.isdigit():
+        return int(value)
+    value = value.decode('latin-1').upper()
+    if len(value) == 9 and value[2:5] in MONTHS and value[:2].isdigit() \
+            and value[5:].isdigit():
+        return (int(value[5:]) * 10000 + (MONTHS.index(value[2:5]) + 1) * 100
+                + int(value[:2]))
+    return 0
+
+
+has_modules = {}
+try:
+    import numpy
+    has_modules['numpy'] = 1
+except ImportError:
+    has_modules['numpy'] = 0
@@ -7,8 +7,29 @@ Generally, taking outside of wrdsapi any static methods.
 
 import re
 import datetime
+import json
+import multiprocessing
 import os
+import shutil
 import time
+import zlib
+
+from . import dirindex
+from . import saslog
+
+COPY_BLOCK_SIZE = 16*2**20
+
+# Files smaller than this are counted in a single process, see count_newlines.
+PARALLEL_COUNT_MIN_SIZE = 2**30
+
+# Extension of the metadata record kept next to each downloaded file, see
+# record_file_meta.
+META_EXTENSION = '.meta'
+
+# Extensions of all hidden sidecar files that belong to a downloaded file
+# and follow it through move_file and remove_file; '.idx' is the row
+# index of tsv_index.
+SIDECAR_EXTENSIONS = [META_EXTENSION, '.idx']
 
 
 def rows_per_file_adjusted(dataset):
@@ -20,7 +41,8 @@ def rows_per_file_adjusted(dataset):
 
     To date optionm.opprcd is the only dataset for which this has
     consistently been necessary.  This is subject to change with further use
-    cases.
+    cases.  WrdsSession only uses this guess until the manifest holds
+    downloads of the dataset, see sizing.SizeModel.
 
     :param dataset:
     :return rows_per_file:
@@ -33,9 +55,42 @@ def rows_per_file_adjusted(dataset):
     return rows_per_file
 
 
+def chunk_rows(chunks):
+    """Finds the number of rows per file with which the row-chunks of a
+    period were requested, from their names.  Only the last chunk holds
+    fewer rows, so this is the widest row range among them.  The window
+    may differ between periods, see sizing.SizeModel.
+
+    :param chunks: list of [first_row, last_row, fname], see
+        dirindex.DownloadIndex.chunks.
+    :return rows_per_file: 0 if there are no chunks.
+    """
+    return max([x[1] - x[0] + 1 for x in chunks] + [0])
+
+
+def chunks_complete(chunks):
+    """Checks whether the row-chunks of a period hold all of its rows,
+    i.e. they follow on from row 1 and the last one, which
+    WrdsSession._check_chunk renames to the rows it actually holds, is
+    narrower than chunk_rows(chunks).
+
+    :param chunks: list of [first_row, last_row, fname], see
+        dirindex.DownloadIndex.chunks.
+    :return complete (bool):
+    """
+    if not chunks or chunks[0][0] != 1:
+        return 0
+    for [previous, chunk] in zip(chunks[:-1], chunks[1:]):
+        if chunk[0] != previous[1] + 1:
+            return 0
+    return int(chunks[-1][1] - chunks[-1][0] + 1 < chunk_rows(chunks))
+
+
 def get_loop_frequency(dataset, year):
     """Finds the best frequency at which to query the server for the given
-    dataset so as to avoid producing problematically large files.
+    dataset so as to avoid producing problematically large files.  As for
+    rows_per_file_adjusted, WrdsSession replaces this guess with
+    sizing.SizeModel once it has downloads to go by.
 
     :param dataset:
     :param year:
@@ -84,7 +139,7 @@ def fix_weekdays(ymds, weekdays=1):
     return ymds2
 
 
-def fix_input_name(dataset, year, month, day, rows=[]):
+def fix_input_name(dataset, year, month, day, rows=[], tag=''):
     """Adjusts the user-supplied dataset name to use the same upper/lower
     case conventions as WRDS does.
 
@@ -93,17 +148,19 @@ def fix_input_name(dataset, year, month, day, rows=[]):
     :param month:
     :param day:
     :param rows:
+    :param tag: see filter_tag; included in output_file if not empty.
     :return [dataset, output_file]:
     """
     [Y, M, D, R] = [year, month, day, rows]
+    stem = re.sub('\.', '_', dataset_key(dataset, tag))
     if year != 'all':
-        ystr = '_' * (dataset[-1].isdigit()) + str(Y)
+        ystr = '_' * (stem[-1].isdigit()) + str(Y)
         mstr = '' + (M != 0) * ('0' * (month < 10) + str(M))
         dstr = (D != 0)*('0'*(D < 10) + str(D))
         ymdstr = ystr + mstr + dstr + '.tsv'
-        output_file = re.sub('\.', '_', dataset) + ymdstr
+        output_file = stem + ymdstr
     else:
-        output_file = re.sub('\.', '_', dataset) + '.tsv'
+        output_file = stem + '.tsv'
 
     if dataset.lower() == 'optionm.opprcd':
         dataset += str(year)
@@ -157,14 +214,79 @@ def wrds_datevar(filename):
     return 'date'
 
 
-def wait_for_retrieve_completion(outfile, get_success, max_wait=1200):
+def filter_tag(columns=None, where=None, ids=None, id_var=None):
+    """Returns a short tag identifying the filter of a filtered download
+    (see WrdsSession.get_wrds), e.g. 'qkbnfdjap', or '' if nothing is
+    filtered.  Equal filters give equal tags, whatever the order of
+    columns and ids.  Only letters are used, so that the date following
+    the tag in a file name can still be told apart.
+
+    :param columns:
+    :param where:
+    :param ids:
+    :param id_var:
+    :return tag:
+    """
+    if not (columns or where or ids):
+        return ''
+    text = json.dumps([sorted(str(x).upper() for x in columns or []),
+                       (where or '').strip(),
+                       sorted(str(x) for x in ids or []),
+                       str(id_var or '').upper() if ids else ''])
+    digest = '%08x' % (zlib.crc32(text.encode('utf-8')) & 0xffffffff)
+    return 'q' + ''.join(chr(ord('a') + int(x, 16)) for x in digest)
+
+
+def dataset_key(dataset, tag=''):
+    """Returns the name under which the files of dataset filtered as
+    identified by tag are kept, in the manifest and in the directories of
+    the partitioned layout, e.g. 'crsp.dsf_qkbnfdjap'; dataset itself if
+    tag is empty.
+
+    :param dataset:
+    :param tag: see filter_tag.
+    :return key:
+    """
+    if not tag:
+        return dataset
+    return dataset + '_' + tag
+
+
+def wrds_idvar(filename):
+    """Returns the variable identifying firms or securities in each
+    dataset, which the ids filter of get_wrds matches against.
+
+    :param filename:
+    :return id_var:
+    """
+    if filename in ['tfn.s12', 'tfn.s34']:
+        return 'cusip'
+    if re.search('^crsp', filename):
+        return 'PERMNO'
+    if re.search('^comp', filename):
+        return 'GVKEY'
+    if re.search('^optionm', filename):
+        return 'secid'
+    if re.search('^ibes', filename):
+        return 'ticker'
+    if re.search('^taq', filename):
+        return 'symbol'
+    return 'PERMNO'
+
+
+def wait_for_retrieve_completion(outfile, get_success, max_wait=1200,
+                                 synchronous=0):
     """Checks size of downloaded outfile until two successive
     give the same result.
     Until this point, it infers that the download is still in progress.
 
+    If synchronous == 1 the transfer has already returned, so the size
+    is read once instead of polled.
+
     :param outfile:
     :param get_success:
     :param max_wait:
+    :param synchronous:
     :return: local_size
     """
     if get_success == 0:
@@ -175,6 +297,10 @@ def wait_for_retrieve_completion(outfile, get_success, max_wait=1200):
 
     write_file = '.' + outfile + '--writing'
     local_path = os.path.join(os.path.expanduser('~'), write_file)
+    if synchronous:
+        if not os.path.exists(local_path):
+            return 0
+        return os.stat(local_path).st_size
 
     while total_wait < max_wait and local_size != local_size_delayed:
         local_size = local_size_delayed
@@ -192,20 +318,209 @@ def wait_for_retrieve_completion(outfile, get_success, max_wait=1200):
     return local_size
 
 
-def get_n_lines(path2file):
-    """Returns number of lines for a text files located at path2file.
+def get_n_lines(path2file, n_procs=None):
+    """Returns number of lines for a text files located at path2file, not
+    counting the header line.
+
+    If the newlines of the file were counted while it was downloaded (see
+    record_file_meta) the file is not read at all; otherwise they are
+    counted with count_newlines.
 
     :param path2file:
+    :param n_procs: passed to count_newlines.
     :return n_lines:
     """
+    stat = os.stat(path2file)
+    if stat.st_size == 0:
+        return 0
+    meta = read_file_meta(path2file, stat)
+    if meta is None:
+        n_newlines = count_newlines(path2file, n_procs)
+    else:
+        n_newlines = meta['n_newlines']
+
     with open(path2file, 'rb') as fd:
-        fsize = os.stat(fd.name).st_size
-        n_lines = 0
-        first_line = fd.readline().split('\t')
-        while fd.tell() < fsize:
-            fline = fd.readline()
-            n_lines += 1
-    return n_lines
+        fd.seek(-1, os.SEEK_END)
+        unterminated = int(fd.read(1) != b'\n')
+    return max(n_newlines + unterminated - 1, 0)
+
+
+def count_newlines(path2file, n_procs=None, block_size=COPY_BLOCK_SIZE):
+    """Counts the newline bytes in path2file, reading it in blocks of
+    block_size.  Files of at least PARALLEL_COUNT_MIN_SIZE are split into
+    n_procs segments counted by separate processes.
+
+    :param path2file:
+    :param n_procs: one per CPU if None; 1 to always use a single process.
+    :param block_size:
+    :return n_newlines:
+    """
+    size = os.stat(path2file).st_size
+    if n_procs is None and size >= PARALLEL_COUNT_MIN_SIZE:
+        try:
+            n_procs = multiprocessing.cpu_count()
+        except NotImplementedError:
+            n_procs = 1
+    if size >= PARALLEL_COUNT_MIN_SIZE and n_procs > 1:
+        bounds = [size*i//n_procs for i in range(n_procs + 1)]
+        segments = [[path2file, bounds[i], bounds[i + 1], block_size]
+                    for i in range(n_procs)]
+        pool = multiprocessing.Pool(n_procs)
+        try:
+            counts = pool.map(_count_newlines_range, segments)
+        finally:
+            pool.close()
+            pool.join()
+        return sum(counts)
+    return _count_newlines_range([path2file, 0, size, block_size])
+
+
+def _count_newlines_range(segment):
+    """Counts the newline bytes in [start, end) of a file.
+
+    :param segment: [path2file, start, end, block_size]
+    :return n_newlines:
+    """
+    [path2file, start, end, block_size] = segment
+    n_newlines = 0
+    with open(path2file, 'rb') as fd:
+        fd.seek(start)
+        while start < end:
+            block = fd.read(min(block_size, end - start))
+            if not block:
+                break
+            n_newlines += block.count(b'\n')
+            start += len(block)
+    return n_newlines
+
+
+def sidecar_path(path2file, extension):
+    """Returns the path of the sidecar file of path2file with extension,
+    a hidden file in the same directory.
+
+    :param path2file:
+    :param extension: one of SIDECAR_EXTENSIONS.
+    :return sidecar_path:
+    """
+    [dname, fname] = os.path.split(path2file)
+    return os.path.join(dname, '.' + fname + extension)
+
+
+def meta_path(path2file):
+    """Returns the path of the metadata record of path2file.
+
+    :param path2file:
+    :return meta_path:
+    """
+    return sidecar_path(path2file, META_EXTENSION)
+
+
+def record_file_meta(path2file, n_newlines, crc32=None):
+    """Writes the metadata record of path2file: its size, mtime, number of
+    newlines and, if known, the CRC-32 of its content, all counted while
+    the file was written.
+
+    get_n_lines and verify_file_meta then look the counts up instead of
+    reading the file again.  The record is only trusted while the file
+    keeps the size and mtime it was written with, see read_file_meta.
+
+    :param path2file:
+    :param n_newlines:
+    :param crc32: unsigned CRC-32, or None if it was not computed.
+    :return:
+    """
+    stat = os.stat(path2file)
+    meta = {'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'n_newlines': n_newlines,
+            'crc32': crc32}
+    with open(meta_path(path2file), 'w') as fd:
+        fd.write(json.dumps(meta))
+
+
+def read_file_meta(path2file, stat=None):
+    """Returns the metadata record of path2file as a dict with keys
+    'size', 'mtime', 'n_newlines' and 'crc32', or None if there is no
+    record or the file has changed since it was written.
+
+    :param path2file:
+    :param stat: os.stat(path2file), if the caller already has it.
+    :return meta:
+    """
+    path2meta = meta_path(path2file)
+    if not os.path.exists(path2meta):
+        return None
+    if stat is None:
+        stat = os.stat(path2file)
+    try:
+        with open(path2meta, 'r') as fd:
+            meta = json.loads(fd.read())
+    except (IOError, ValueError):
+        return None
+    if meta.get('size') != stat.st_size or meta.get('mtime') != stat.st_mtime:
+        return None
+    return meta
+
+
+def verify_file_meta(path2file, block_size=COPY_BLOCK_SIZE):
+    """Reads path2file again and checks its newlines and, where recorded,
+    its CRC-32 against the metadata record written when it was downloaded.
+
+    :param path2file:
+    :param block_size:
+    :return verified: 1 if the file matches its record, 0 if it does not,
+        None if it has no valid record.
+    """
+    meta = read_file_meta(path2file)
+    if meta is None:
+        return None
+    [n_newlines, crc32] = [0, 0]
+    with open(path2file, 'rb') as fd:
+        while True:
+            block = fd.read(block_size)
+            if not block:
+                break
+            n_newlines += block.count(b'\n')
+            crc32 = zlib.crc32(block, crc32)
+    if n_newlines != meta['n_newlines']:
+        return 0
+    if meta['crc32'] is not None and crc32 & 0xffffffff != meta['crc32']:
+        return 0
+    return 1
+
+
+def move_file(from_path, to_path):
+    """Moves from_path to to_path together with its sidecar files, and
+    drops any sidecars left over from a previous file at to_path.  The
+    directory indexes of dirindex are updated.
+
+    :param from_path:
+    :param to_path:
+    :return:
+    """
+    for extension in SIDECAR_EXTENSIONS:
+        if os.path.exists(sidecar_path(to_path, extension)):
+            os.remove(sidecar_path(to_path, extension))
+    shutil.move(from_path, to_path)
+    for extension in SIDECAR_EXTENSIONS:
+        if os.path.exists(sidecar_path(from_path, extension)):
+            shutil.move(sidecar_path(from_path, extension),
+                        sidecar_path(to_path, extension))
+    dirindex.file_removed(from_path)
+    dirindex.file_added(to_path)
+
+
+def remove_file(path2file):
+    """Removes path2file and its sidecar files, if any.
+
+    :param path2file:
+    :return:
+    """
+    os.remove(path2file)
+    dirindex.file_removed(path2file)
+    for extension in SIDECAR_EXTENSIONS:
+        if os.path.exists(sidecar_path(path2file, extension)):
+            os.remove(sidecar_path(path2file, extension))
 
 
 def get_n_lines_from_log(outfile, dname):
@@ -214,63 +529,17 @@ def get_n_lines_from_log(outfile, dname):
     file "outfile".
 
     This number can then be checked against the number actually found in
-    the file.
+    the file.  The log is parsed by saslog.read_log, which keeps the
+    result until the log changes.
 
     :param outfile:
     :param dname:
-    :return logfile_lines:
+    :return logfile_lines: -1 if there is no log or it reports no count.
     """
-    log_lines = -1
-    sasfile = 'wrds_export_' + re.sub('\.tsv$', '.log', outfile)
-    if not os.path.exists(os.path.join(dname, sasfile)):
-        partial_fname = re.sub('[0-9]*rows.*', '', sasfile)
-        sasfile2 = partial_fname+'_'+re.sub(partial_fname, '', sasfile)
-        if os.path.exists(os.path.join(dname, sasfile2)):
-            sasfile = sasfile2
-        all_fname = re.sub('rows', '_allrows', sasfile)
-        if os.path.exists(os.path.join(dname, all_fname)):
-            sasfile = all_fname
-
-    if os.path.exists(os.path.join(dname, sasfile)):
-        with open(os.path.join(dname, sasfile)) as fd:
-            fsize = os.stat(fd.name).st_size
-            while fd.tell() < fsize:
-                fline = fd.readline()
-                if re.search('^[0-9]* records created in ', fline):
-                    log_lines = re.split(' records created in ', fline)[0]
-                    log_lines = int(float(log_lines))
-                    break
-
-                pattern0 = ('NOTE: The data set WORK\.NEW_DATA '
-                    +'has [0-9]* observations')
-                if re.search(pattern0, fline):
-                    pattern01 = 'NOTE: The data set WORK\.NEW_DATA has '
-                    pattern02 = ' observations'
-                    split_log = re.split(pattern02, fline)[0]
-                    log_lines = re.split(pattern01, split_log)[-1]
-                    log_lines = int(float(log_lines))
-                    break
-
-                pattern1 = 'NOTE: [0-9]* records were written to the file'
-                if re.search(pattern1, fline):
-                    split_log = re.split('NOTE: ', fline)[-1]
-                    log_lines = re.split('records', split_log)[0]
-                    log_lines = int(float(log_lines))
-                    break
-
-                # The numbers given by the pattern below are often     #
-                # one row lower than the numbers given by the above    #
-                # patterns, the latter being the desired answer.       #
-                # This code is kept as an option to re-implement       #
-                # should their arise cases where none of the other     #
-                # patterns are found.                                  #
-                #pattern2 = 'NOTE: There were [0-9]* observations read'
-                #if re.search(pattern2,fline):
-                #	split_log = re.split(' observations read',fline)[0]
-                #	log_lines = re.split('NOTE: There were ',split_log)[-1]
-                #	log_lines = int(float(log_lines))
-                #	break
-    return log_lines
+    summary = saslog.read_export_log(outfile, dname)
+    if summary is None:
+        return -1
+    return summary['n_records']
 
 
 def _recombine_ready(fname, dname=None, suppress=0):
@@ -289,24 +558,19 @@ def _recombine_ready(fname, dname=None, suppress=0):
     isready = 1
     fname0 = re.sub('rows[0-9][0-9]*to[0-9][0-9]*\.tsv', '', fname)
 
-    if os.path.exists(os.path.join(dname, fname + '.tsv')):
+    index = dirindex.get_index(dname)
+    if index.exists(fname + '.tsv'):
         isready = 0
 
-    rows_per_file = rows_per_file_adjusted(fname0)
-    flist0 = os.listdir(dname)
-    flist0 = [x for x in flist0 if x.endswith('.tsv')]
-    flist0 = [x for x in flist0 if re.search(fname0, x)]
-    fdict = {x: x.split('rows')[-1] for x in flist0}
-    fdict = {x: re.split('_?to_?',fdict[x])[0] for x in fdict}
-    fdict = {x: float(fdict[x]) for x in fdict if fdict[x].isdigit()}
-    flist = [[fdict[x], x] for x in fdict]
+    flist = index.chunks(fname0)
+    rows_per_file = chunk_rows(flist)
 
     if isready and flist == []:
         isready = 0
         if suppress == 0:
             print('recombine_ready: No such files found: ' + fname)
 
-    numlist = [x[0] for x in sorted(flist)]
+    numlist = [x[0] for x in flist]
     missing_nums = [x for x in numlist if x != 1]
     missing_nums = [x for x in missing_nums if x-rows_per_file not in numlist]
 
@@ -316,14 +580,10 @@ def _recombine_ready(fname, dname=None, suppress=0):
             print('recombine_ready: ' + fname
                 + ' missing_nums ' + repr(missing_nums+numlist))
 
-    end_nums = [re.sub('\.tsv$', '', x[1]) for x in flist]
-    end_nums = [re.split('to', x)[-1] for x in end_nums]
-    end_nums = [float(x) for x in end_nums]
+    end_nums = [x[1] for x in flist]
 
     if isready and end_nums != [] and max(end_nums)%rows_per_file == 0:
-        max_num = int(max(end_nums))
-        flist2 = [x[1] for x in flist if x[1].endswith(repr(max_num)
-                                                       + '.tsv')]
+        flist2 = [x[2] for x in flist if x[1] == max(end_nums)]
         if len(flist2) == 1:
             outfile = flist2[0]
             n_lines = get_n_lines(os.path.join(dname, outfile))
@@ -341,6 +601,120 @@ def _recombine_ready(fname, dname=None, suppress=0):
     return isready
 
 
+def combine_tsv_files(paths, out_path, block_size=COPY_BLOCK_SIZE):
+    """Concatenates the tsv files in paths into out_path, keeping only the
+    first header line.
+
+    Only the header line of each file is read line by line, to check it
+    against the first file's; the rest is copied in blocks of block_size,
+    with os.sendfile where available.  Line endings are converted to '\n'
+    only for files whose header line ends in '\r\n'.
+
+    If every file in paths has a metadata record, the newlines of out_path
+    are summed from them and recorded with record_file_meta.  Likewise
+    their row indexes are merged into one for out_path, see
+    tsv_index.merge_indexes.
+
+    :param paths:
+    :param out_path:
+    :param block_size:
+    :return [combined_files, found_problem]:
+    """
+    [combined_files, found_problem, headers] = [0, 0, None]
+    metas = [read_file_meta(path) for path in paths]
+    # [body_offset, out_offset] per file, for the index.
+    [positions, converted] = [[], 0]
+    with open(out_path, 'wb') as fd:
+        try:
+            for path in paths:
+                with open(path, 'rb') as fd1:
+                    header_line = fd1.readline()
+                    offset = fd1.tell()
+                headers1 = header_line.strip(b'\r\n')
+                if headers is None:
+                    headers = headers1
+                    fd.write(headers1 + b'\n')
+                if headers1 != headers:
+                    print('Problem with header matching:' + path)
+                    found_problem = 1
+                if found_problem == 0:
+                    crlf = header_line.endswith(b'\r\n')
+                    positions.append([offset, fd.tell()])
+                    converted += crlf
+                    _append_file(fd, path, offset, crlf, block_size)
+                    combined_files += 1
+        except KeyboardInterrupt:
+            fd.close()
+            os.remove(out_path)
+            raise KeyboardInterrupt
+    dirindex.file_added(out_path)
+    if found_problem == 0 and None not in metas:
+        # Every file contributes its rows, each ending in '\n' once
+        # appended, plus the one header line.
+        n_newlines = 1 + sum(get_n_lines(path) for path in paths)
+        record_file_meta(out_path, n_newlines)
+    if found_problem == 0 and not converted:
+        # '\r\n' conversion moves the rows, so those indexes are useless.
+        from . import tsv_index
+        tsv_index.merge_indexes(paths, out_path, positions)
+    return [combined_files, found_problem]
+
+
+def _append_file(fd, path, offset, crlf=0, block_size=COPY_BLOCK_SIZE):
+    """Appends the contents of path from offset onwards to the open file fd,
+    making sure they end with a newline.
+
+    If crlf == 1, '\r\n' line endings are converted to '\n' on the way.
+    Otherwise the bytes are copied unchanged, by the kernel if os.sendfile
+    is available.
+
+    :param fd:
+    :param path:
+    :param offset:
+    :param crlf:
+    :param block_size:
+    :return n_bytes: number of bytes read from path.
+    """
+    size = os.stat(path).st_size
+    if size <= offset:
+        return 0
+
+    with open(path, 'rb') as fd1:
+        fd1.seek(size - 1)
+        last_byte = fd1.read(1)
+        fd1.seek(offset)
+        if crlf:
+            carry = b''
+            while True:
+                block = fd1.read(block_size)
+                if not block:
+                    break
+                # A '\r\n' may straddle two blocks.
+                block = carry + block
+                carry = block[-1:] if block.endswith(b'\r') else b''
+                fd.write(block[:len(block) - len(carry)].replace(b'\r\n',
+                                                                 b'\n'))
+            if carry:
+                last_byte = b'\n'
+            fd.write(carry.replace(b'\r', b'\n'))
+        elif hasattr(os, 'sendfile'):
+            fd.flush()
+            position = offset
+            while position < size:
+                sent = os.sendfile(fd.fileno(), fd1.fileno(), position,
+                                   min(block_size, size - position))
+                if sent == 0:
+                    break
+                position += sent
+            fd.seek(0, os.SEEK_END)
+        else:
+            shutil.copyfileobj(fd1, fd, block_size)
+
+    if last_byte != b'\n':
+        fd.write(b'\n')
+    return size - offset
+
+
 def recombine_files(fname, dname=None, suppress=0):
     """Reads the files downloaded by get_wrds and combines them
     back into the single file of interest.
@@ -359,16 +733,10 @@ def recombine_files(fname, dname=None, suppress=0):
         return combined_files
 
     fname0 = re.sub('rows[0-9][0-9]*to[0-9][0-9]*\.tsv', '', fname)
-    rows_per_file = rows_per_file_adjusted(fname0)
-
-    flist0 = [x for x in os.listdir(dname) if re.search(fname0, x)]
-    flist0 = [x for x in flist0 if x.endswith('.tsv')]
-    fdict = {x: x.split('rows')[-1] for x in flist0}
-    fdict = {x: re.split('_?to_?',fdict[x])[0] for x in fdict}
-    fdict = {x: float(fdict[x]) for x in fdict if fdict[x].isdigit()}
-    flist = [[fdict[x], x] for x in fdict]
+    chunks = dirindex.get_index(dname).chunks(fname0)
+    rows_per_file = chunk_rows(chunks)
 
-    flist = [x[1] for x in sorted(flist)]
+    flist = [x[2] for x in chunks]
     with open(os.path.join(dname, flist[-1]), 'rb') as fd:
         fsize = os.stat(fd.name).st_size
         nlines = 0
@@ -382,34 +750,13 @@ def recombine_files(fname, dname=None, suppress=0):
         'should_be=' + repr(rows_per_file)])
         return combined_files
 
-    with open(os.path.join(dname, fname0+'.tsv'), 'wb') as fd:
-        headers = []
-        found_problem = 0
-        for fname1 in flist:
-            fd1 = open(os.path.join(dname, fname1), 'rb')
-            fsize1 = os.stat(fd1.name).st_size
-            headers1 = fd1.readline().strip('\r\n')
-            if headers == []:
-                headers = headers1
-                fd.write(headers1 + '\n')
-            if headers1 != headers:
-                print('Problem with header matching:' + fname1)
-                found_problem = 1
-            if found_problem == 0:
-                try:
-                    while fd1.tell() < fsize1:
-                        fd.write(fd1.readline().strip('\r\n') + '\n')
-                    fd1.close()
-                except KeyboardInterrupt:
-                    fd1.close()
-                    fd.close()
-                    os.remove(fd.name)
-                    raise KeyboardInterrupt
-                combined_files += 1
+    [combined_files, found_problem] = combine_tsv_files(
+        [os.path.join(dname, x) for x in flist],
+        os.path.join(dname, fname0 + '.tsv'))
 
     if found_problem == 0:
         for fname1 in flist:
-            os.remove(os.path.join(dname, fname1))
+            remove_file(os.path.join(dname, fname1))
     return combined_files
 
 
@@ -7,12 +7,23 @@ import datetime
 import time
 import math
 import shutil
+import socket
 import paramiko
 
 from _wrds_db_descriptors import WRDS_DOMAIN, _GET_ALL, FIRST_DATES, \
     FIRST_DATE_GUESSES, AUTOEXEC_TEXT, WRDS_USER_QUOTA
 
+from pywrds import columnar
+from pywrds import dirindex
+from pywrds import layout
+from pywrds import manifest
+from pywrds import postprocess
+from pywrds import saslog
+from pywrds import sizing
 from pywrds import sshlib
+from pywrds import sync
+from pywrds import trading_calendar
+from pywrds import transfer
 from pywrds import utility as wrds_util
 from . import sas_query
 
@@ -68,6 +79,65 @@ class WrdsSession(object):
             self.user_info['last_wrds_download'] = {}
         self.last_wrds_download = self.user_info['last_wrds_download']
 
+        # Record of the downloaded periods, opened on first use, see
+        # _open_manifest.
+        self.manifest = None
+
+        # Number of parallel SFTP streams used for large downloads.
+        self.download_streams = 1
+        if 'download_streams' in self.user_info.keys():
+            self.download_streams = int(self.user_info['download_streams'])
+
+        # Compression applied to exported files on the server before
+        # transfer, one of transfer.COMPRESSORS or None.
+        self.compress = None
+        if 'compress' in self.user_info.keys():
+            self.compress = self.user_info['compress']
+        if self.compress == 'zstd' and not transfer.has_modules['zstandard']:
+            print('WrdsSession warning: "compress": "zstd" requires the '
+                  'package "zstandard".  Falling back to gzip.')
+            self.compress = 'gzip'
+
+        # Format of the typed copy written next to each finished download,
+        # 'parquet' or 'npy' (see columnar), or None for no copy.
+        self.columnar = None
+        if self.user_info.get('columnar'):
+            self.columnar = self.user_info['columnar']
+            if self.columnar not in columnar.FORMATS:
+                self.columnar = columnar.default_format()
+            if self.columnar == 'parquet' and \
+                    not columnar.has_modules['pyarrow']:
+                self.columnar = columnar.default_format()
+            if self.columnar is None:
+                print('WrdsSession warning: "columnar" requires the package '
+                      'numpy.  Please "pip install numpy".')
+            elif self.columnar != self.user_info['columnar']:
+                print('WrdsSession warning: writing columnar copies as "' +
+                      self.columnar + '" instead.')
+
+        # Threads recombining and converting finished periods in the
+        # background during wrds_loop, see postprocess; 0 does this work
+        # inline.
+        self.postprocess_workers = 0
+        if 'postprocess_workers' in self.user_info.keys():
+            self.postprocess_workers = \
+                int(self.user_info['postprocess_workers'])
+        self.postprocessor = None
+        self._in_wrds_loop = 0
+
+        # sizing.SizeModel of each dataset, estimated once per wrds_loop.
+        self._size_models = {}
+
+        # Placement of downloads within download_path, one of
+        # layout.LAYOUTS.
+        self.layout = 'flat'
+        if 'layout' in self.user_info.keys():
+            self.layout = self.user_info['layout']
+            if self.layout not in layout.LAYOUTS:
+                print('WrdsSession warning: "layout" must be one of ' +
+                      repr(layout.LAYOUTS) + '.  Using "flat" instead.')
+                self.layout = 'flat'
+
         self.now = time.localtime()
         [self.this_year, self.this_month, self.today] = \
             [self.now.tm_year, self.now.tm_mon, self.now.tm_mday]
@@ -87,7 +157,10 @@ class WrdsSession(object):
 
         Some datasets include very large files and need to be queried at a
         monthly or daily frequency to prevent giant files from causing
-        problems on the server.
+        problems on the server.  The frequency is chosen from the sizes of
+        earlier downloads where there are any, see sizing.SizeModel.  If
+        weekdays == 1, daily datasets are queried on NYSE trading days only,
+        see trading_calendar.
 
         :param min_date:
         :param dataset:
@@ -99,13 +172,16 @@ class WrdsSession(object):
         ymdrange = []
         years = xrange(min_year, self.now.tm_year+1)
         for year in years:
-            frequency = wrds_util.get_loop_frequency(dataset, year)
+            frequency = self._size_model(dataset).loop_frequency(year)
             if frequency == 'Y':
                 new_ymd = [year, 0, 0]
                 ymdrange.append(new_ymd)
             elif frequency == 'M':
                 new_ymd = [[year, x, 0] for x in range(1, 13)]
                 ymdrange = ymdrange + new_ymd
+            elif frequency == 'D' and weekdays == 1:
+                # Daily datasets only have tables for NYSE trading days.
+                ymdrange = ymdrange + trading_calendar.trading_days(year)
             elif frequency == 'D':
                 new_ymd = [[year, x, y] for x in range(1, 13) for y in range(
                     1, 32)]
@@ -118,26 +194,140 @@ class WrdsSession(object):
         return ymdrange
 
     def update_user_info(self, n_files, new_files, fname, dataset, year,
-                         month=0, day=0):
+                         month=0, day=0, seconds=None, tag=''):
         """update_user_info(n_files, new_files, fname, dataset, year, month=0, day=0)
-        amends the user_info file to reflect the most recent download dates
-        for wrds files.
+        records the period in the manifest and amends user_info to reflect
+        the most recent download dates for wrds files.
+
+        The manifest commits its writes in batches (see manifest.Manifest),
+        and user_info.txt is only rewritten when a batch is committed and
+        at the end of wrds_loop, see save_user_info.
+
+        Filtered downloads, identified by tag (see wrds_util.filter_tag),
+        are recorded under wrds_util.dataset_key(dataset, tag).
 
         return
         """
+        records = self._open_manifest()
+        key = wrds_util.dataset_key(dataset, tag)
         if new_files > 0:
             n_files = n_files + new_files
             if 'last_wrds_download' not in self.user_info.keys():
                 self.user_info['last_wrds_download'] = {}
-            self.user_info['last_wrds_download'][dataset] = \
+            self.user_info['last_wrds_download'][key] = \
                 year*10000 + month*100 + day
-            with open(self.user_info_filename, 'wb') as fd:
-                fd.write(json.dumps(self.user_info, indent=4))
+            dname = self._output_dir(dataset, year, month, day, tag)
+            path2file = os.path.join(dname, fname)
+            chunks = dirindex.get_index(dname).chunks(
+                re.sub('\.tsv$', '', fname))
+            committed = 0
+            if os.path.exists(path2file):
+                [n_rows, n_bytes, crc32] = manifest.file_stats(path2file)
+                committed = records.record_period(
+                    key, year, month, day, 'done', n_rows, n_bytes,
+                    crc32, seconds)
+            elif self.postprocessor is None and \
+                    wrds_util.chunks_complete(chunks):
+                # Left in row-chunks, e.g. with recombine=0, but complete.
+                stats = [manifest.file_stats(os.path.join(dname, x[2]))
+                         for x in chunks]
+                committed = records.record_period(
+                    key, year, month, day, 'done', sum(x[0] for x in stats),
+                    sum(x[1] for x in stats), None, seconds)
+            elif self.postprocessor is None:
+                committed = records.record_period(
+                    key, year, month, day, 'partial', seconds=seconds)
+            # Otherwise _post_process records the period once recombined.
+            if committed:
+                self.save_user_info()
         else:
             print ('Could not retrieve: ' + fname)
+            status = 'failed'
+            if self._period_missing(dataset, year, month, day, tag):
+                # WRDS has no table for this period, see sync.plan.
+                status = 'empty'
+            records.record_period(key, year, month, day, status,
+                                  seconds=seconds)
         return
 
-    def min_ymd(self, min_date, dataset):
+    def _period_missing(self, dataset, year, month=0, day=0, tag=''):
+        """Checks whether the SAS log of the first row-chunk of a period
+        says that its source table does not exist.
+
+        :param dataset:
+        :param year:
+        :param month:
+        :param day:
+        :param tag: see wrds_util.filter_tag.
+        :return missing (bool):
+        """
+        rows_per_file = self._rows_per_file(dataset, year, month, day, tag)
+        [dset2, outfile] = wrds_util.fix_input_name(
+            dataset, year, month, day, [1, rows_per_file], tag)
+        log_summary = saslog.read_export_log(
+            outfile, self._output_dir(dataset, year, month, day, tag))
+        return log_summary is not None and log_summary['file_missing'] == 1
+
+    def _size_model(self, dataset, tag=''):
+        """Returns the sizing.SizeModel of dataset, estimating it from the
+        manifest on first use.
+
+        :param dataset:
+        :param tag: see wrds_util.filter_tag.
+        :return size_model:
+        """
+        key = wrds_util.dataset_key(dataset, tag)
+        if key not in self._size_models:
+            self._size_models[key] = sizing.SizeModel(
+                dataset, self._open_manifest().periods(key))
+        return self._size_models[key]
+
+    def _rows_per_file(self, dataset, year, month=0, day=0, tag=''):
+        """Chooses the number of rows in each row-chunk of a period.  A
+        period some of whose chunks are already downloaded keeps their
+        window, so that the remaining chunks line up with them.
+
+        :param dataset:
+        :param year:
+        :param month:
+        :param day:
+        :param tag: see wrds_util.filter_tag.
+        :return rows_per_file:
+        """
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, year, month,
+                                                    day, [], tag)
+        index = dirindex.get_index(self._output_dir(dataset, year, month,
+                                                     day, tag))
+        rows_per_file = wrds_util.chunk_rows(
+            index.chunks(re.sub('\.tsv$', '', outfile)))
+        if rows_per_file:
+            return rows_per_file
+        return self._size_model(dataset, tag).rows_per_file()
+
+    def save_user_info(self):
+        """Commits the manifest and writes user_info to user_info.txt,
+        replacing the old file only once the new one is complete.
+
+        :return:
+        """
+        if self.manifest is not None:
+            self.manifest.commit()
+        write_file = self.user_info_filename + '--writing'
+        with open(write_file, 'wb') as fd:
+            fd.write(json.dumps(self.user_info, indent=4))
+        shutil.move(write_file, self.user_info_filename)
+
+    def _open_manifest(self):
+        """Returns the manifest of download_path, opening it on first use.
+
+        :return manifest: manifest.Manifest
+        """
+        if self.manifest is None:
+            self.manifest = manifest.Manifest(
+                os.path.join(self.download_path, manifest.MANIFEST_FILE))
+        return self.manifest
+
+    def min_ymd(self, min_date, dataset, tag=''):
         """Finds (year,month,day) at which to start wrds_loop when
         downloading the entirety of a dataset.
 
@@ -145,29 +335,31 @@ class WrdsSession(object):
 
         :param min_date:
         :param dataset:
+        :param tag: see wrds_util.filter_tag.
         :return [min_year, min_month, min_day]:
         """
         if dataset in _GET_ALL:
             return [-1, -1, -1]
 
+        key = wrds_util.dataset_key(dataset, tag)
         if 'last_wrds_download' not in self.user_info:
             self.user_info['last_wrds_download'] = {}
-        if dataset not in self.user_info['last_wrds_download']:
+        if key not in self.user_info['last_wrds_download']:
             if dataset in FIRST_DATES:
-                self.user_info['last_wrds_download'][dataset] = FIRST_DATES[
+                self.user_info['last_wrds_download'][key] = FIRST_DATES[
                     dataset]
             else:
-                self.user_info['last_wrds_download'][dataset] = 18000000
+                self.user_info['last_wrds_download'][key] = 18000000
 
         if not isinstance(min_date, (int, float)):
             min_date = 0
 
         if min_date == 0:
-            min_date = self.user_info['last_wrds_download'][dataset]
+            min_date = self.user_info['last_wrds_download'][key]
             min_date = str(min_date)
             if not min_date.isdigit() or len(min_date) != 8:
                 min_date = 0
-                print ('user_info["last_wrds_download"]["' + dataset + '"]='
+                print ('user_info["last_wrds_download"]["' + key + '"]='
                     + min_date + ' error, should be an eight digit integer.')
             min_year = int(float(min_date[:4]))
             min_month = int(float(min_date[4:6]))
@@ -310,10 +502,7 @@ class WrdsSession(object):
         sas_command = 'sas -noterminal wrds_dicts.sas'
 
         [stdin, stdout, stderr] = self.ssh.exec_command(sas_command)
-        exit_status = -1
-        while exit_status == -1:
-            time.sleep(10)
-            exit_status = stdout.channel.recv_exit_status()
+        exit_status = stdout.channel.recv_exit_status()
 
         local_path = os.path.join(self.download_path, filename + '_dicts.lst')
         remote_path = ('/home/' + self.wrds_institution + '/' +
@@ -345,7 +534,8 @@ class WrdsSession(object):
 
         return [flist]
 
-    def get_wrds(self, dataset, Y, M=0, D=0, recombine=1):
+    def get_wrds(self, dataset, Y, M=0, D=0, recombine=1, stream=0,
+                 columns=None, where=None, ids=None, id_var=None):
         """Remotely download a file from the WRDS server. For example,
         the command
 
@@ -370,78 +560,218 @@ class WrdsSession(object):
         better than comma-separated files (csv) because sometimes
         company names have commas e.g. Company Name, Inc.
 
+        If stream == 1, the rows are read straight off the SSH channel
+        instead of being written to the home directory on the server and
+        downloaded afterwards, see _stream_wrds.  Nothing is stored on the
+        server, so the file is not split into row-chunks.
+
+        columns, where and ids narrow the export on the server, see
+        sas_query.wrds_sas_script, e.g.
+
+        get_wrds('crsp.dsf', 2010, columns=['PERMNO', 'DATE', 'RET'],
+                 where='shrcd in (10, 11)', ids=[10107, 14593])
+
+        The output of a filtered download is named with a tag for the
+        filter, see wrds_util.filter_tag, e.g. crsp_dsf_qkbnfdjap2010.tsv,
+        so that it is kept apart from the full dataset and from other
+        filters.
+
         :param dataset:
         :param Y:
         :param M:
         :param D:
         :param recombine:
+        :param stream:
+        :param columns: list of variables to download.
+        :param where: SAS where expression.
+        :param ids: list of PERMNOs, GVKEYs etc. to download.
+        :param id_var: variable ids refers to, see wrds_util.wrds_idvar.
         :return [n_files, total_rows, time_elapsed]:
         """
+        query = {'columns': columns, 'where': where, 'ids': ids,
+                 'id_var': id_var}
+        tag = wrds_util.filter_tag(**query)
+        if stream:
+            get_output = self._stream_wrds(dataset, Y, M, D, query)
+            self._finish_period(dataset, Y, M, D, recombine=0, tag=tag)
+            return get_output
+
         keep_going = 1
         [startrow, n_files, total_rows, tic] = [1, 0, 0, time.time()]
-        rows_per_file = wrds_util.rows_per_file_adjusted(dataset)
-        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [])
+        rows_per_file = self._rows_per_file(dataset, Y, M, D, tag)
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+        downloaded = dirindex.get_index(self._output_dir(dataset, Y, M, D,
+                                                          tag))
 
         # Check if output file in local dir, if not send request.
-        if os.path.exists(os.path.join(self.download_path, outfile)):
+        if downloaded.exists(outfile):
             keep_going = 0
         while keep_going:
             R = [startrow, startrow - 1 + rows_per_file]
-            [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, R)
+            [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, R,
+                                                        tag)
 
-            if not os.path.exists(os.path.join(self.download_path, outfile)):
-                [keep_going, dt] = self._get_wrds_chunk(dataset, Y, M, D, R)
+            dt = None
+            if not downloaded.exists(outfile):
+                [keep_going, dt] = self._get_wrds_chunk(dataset, Y, M, D, R,
+                                                        query)
 
             if keep_going > 0:
                 n_files += 1
-                if os.path.exists(os.path.join(self.download_path, outfile)):
-                    log_lines = wrds_util.get_n_lines_from_log(
-                        outfile, dname=self.download_path)
-                    n_lines = wrds_util.get_n_lines(os.path.join(
-                        self.download_path, outfile))
-                    if log_lines > n_lines:
-                        print('get_wrds error: file "%s" has %s lines, but %s '
-                              'were expected.',
-                              (outfile, str(n_lines), str(log_lines)))
-                        keep_going = 0
-
-                    total_rows += n_lines
-                    if n_lines < rows_per_file:
-                        keep_going = 0
-
-                    if log_lines == n_lines < rows_per_file:
-                        keep_going = 0
-                        if not (log_lines == -1 or log_lines == n_lines):
-                            print('get_wrds warning: '
-                                +'log_lines = '+str(log_lines))
-                        if startrow == 1:
-                            subfrom = 'rows1to' + str(rows_per_file)
-                            newname = re.sub(subfrom, '', outfile)
-                            newp2f = os.path.join(self.download_path, newname)
-                            oldp2f = os.path.join(self.download_path, outfile)
-                            os.rename(oldp2f, newp2f)
-                        else:
-                            subfrom = 'to' + str(R[-1])
-                            subto = 'to' + str(R[0] - 1 + n_lines)
-                            newname = re.sub(subfrom, subto, outfile)
-                            oldp2f = os.path.join(self.download_path, outfile)
-                            newp2f = os.path.join(self.download_path, newname)
-                            os.rename(oldp2f, newp2f)
-                        if recombine == 1:
-                            subfrom = 'rows[0-9]*to[0-9]*\.tsv'
-                            recombine_name = re.sub(subfrom, '', outfile)
-                            wrds_util.recombine_files(recombine_name,
-                                             dname=self.download_path)
-                    else:
-                        startrow += rows_per_file
-                        newname = outfile
+                [keep_going, n_lines] = \
+                    self._check_chunk(dataset, Y, M, D, R, recombine, dt,
+                                      tag)
+                total_rows += n_lines
+                startrow += rows_per_file
+
+        if n_files == 0:
+            # Downloaded earlier; new downloads are finished in _check_chunk.
+            self._finish_period(dataset, Y, M, D, recombine=0, tag=tag)
+        return [n_files, total_rows, time.time()-tic]
 
-                else:
-                    keep_going = 0
+    def _stream_wrds(self, dataset, Y, M=0, D=0, query={}):
+        """Runs the export for one period with "sas -stdio", which reads the
+        script from stdin and writes the log to stderr, while the script
+        itself exports to stdout.  The rows are written to the local
+        "--writing" file as they arrive over the channel and the log is
+        saved next to the output in download_path.
 
-        return [n_files, total_rows, time.time()-tic]
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param query: keyword arguments for sas_query.wrds_sas_script.
+        :return [n_files, total_rows, time_elapsed]:
+        """
+        tic = time.time()
+        tag = wrds_util.filter_tag(**query)
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+        dname = self._make_output_dir(dataset, Y, M, D, tag)
+        if dirindex.get_index(dname).exists(outfile):
+            return [0, 0, time.time()-tic]
+
+        [sas_file, outfile, dataset] = sas_query.wrds_sas_script(
+            self.download_path, dataset, Y, M, D, stream=1, **query)
+        # Named so that saslog.export_log_path finds it for outfile.
+        log_file = 'wrds_export_' + re.sub('\.tsv$', '.log', outfile)
+        put_success = self._put_sas_file(outfile, sas_file)
+
+        write_file = '.' + outfile + '--writing'
+        local_path = os.path.join(os.path.expanduser('~'), write_file)
+        log_path = os.path.join(dname, log_file)
+        sas_command = 'sas -noterminal -stdio < ' + sas_file
+        [exec_success, stdin, stdout, stderr] = self._try_exec(sas_command)
+        if not exec_success:
+            print('get_wrds could not start SAS for ' + outfile)
+            return [0, 0, time.time()-tic]
+        stdin.close()
+        try:
+            [n_bytes, exit_status] = transfer.stream_channel(
+                stdout.channel, local_path, log_path)
+        except (IOError, EOFError, paramiko.SSHException,
+                socket.error) as err:
+            print('get_wrds lost the stream of ' + outfile + ': ' + str(err))
+            stdout.channel.close()
+            [n_bytes, exit_status] = [0, -1]
+        for fname in [sas_file, sas_query.ids_file_name(sas_file)]:
+            try:
+                self.sftp.remove(fname)
+            except (IOError, EOFError, paramiko.SSHException):
+                pass
+        saspath = os.path.join(self.download_path, sas_file)
+        if os.path.exists(saspath):
+            os.remove(saspath)
+
+        log_summary = saslog.read_log(log_path)
+        if exit_status not in [0, 1] or n_bytes == 0:
+            # 1 is "SAS system issued warnings", non-fatal    #
+            print('get_wrds failed on file "' + outfile + '"\n' +
+                  'exit_status = ' + str(exit_status) + '\n' + 'For '
+                  'details, see log file "' + log_path + '"')
+            if log_summary is not None and log_summary['errors']:
+                print('First error in the log: ' + log_summary['errors'][0])
+            if os.path.exists(local_path):
+                wrds_util.remove_file(local_path)
+            return [0, 0, time.time()-tic]
+
+        log_lines = -1 if log_summary is None else log_summary['n_records']
+        n_lines = wrds_util.get_n_lines(local_path)
+        if log_lines != n_lines:
+            print('get_wrds error: file "' + outfile + '" has ' +
+                  str(n_lines) + ' lines, but ' + str(log_lines) +
+                  ' were expected.')
+            wrds_util.remove_file(local_path)
+            return [0, 0, time.time()-tic]
+
+        wrds_util.move_file(local_path, os.path.join(dname, outfile))
+        return [1, n_lines, time.time()-tic]
+
+    def _check_chunk(self, dataset, Y, M, D, R, recombine=1, seconds=None,
+                     tag=''):
+        """Compares a downloaded row-chunk against its SAS log and decides
+        whether another chunk needs to be requested for the same period.
+
+        When the chunk turns out to be the last one, it is renamed to its
+        final row range (or to the plain period name if it is the only
+        chunk) and the period is handed to _finish_period, which
+        recombines the chunks if recombine == 1.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param R:
+        :param recombine:
+        :param seconds: time taken by the download, for the manifest.
+        :param tag: see wrds_util.filter_tag.
+        :return [keep_going, n_lines]:
+        """
+        rows_per_file = R[1] - R[0] + 1
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, R, tag)
+        dname = self._output_dir(dataset, Y, M, D, tag)
+        if not dirindex.get_index(dname).exists(outfile):
+            return [0, 0]
+
+        keep_going = 1
+        log_lines = wrds_util.get_n_lines_from_log(outfile, dname=dname)
+        [n_lines, n_bytes, crc32] = \
+            manifest.file_stats(os.path.join(dname, outfile))
+        if log_lines > n_lines:
+            print('get_wrds error: file "%s" has %s lines, but %s '
+                  'were expected.',
+                  (outfile, str(n_lines), str(log_lines)))
+            keep_going = 0
+        self._open_manifest().record_chunk(
+            wrds_util.dataset_key(dataset, tag), Y, M, D, R,
+            'done' if keep_going else 'failed', n_lines, n_bytes, crc32,
+            seconds)
+
+        if n_lines < rows_per_file:
+            keep_going = 0
+
+        if log_lines == n_lines < rows_per_file:
+            keep_going = 0
+            if not (log_lines == -1 or log_lines == n_lines):
+                print('get_wrds warning: '
+                    +'log_lines = '+str(log_lines))
+            if R[0] == 1:
+                subfrom = 'rows1to' + str(rows_per_file)
+                newname = re.sub(subfrom, '', outfile)
+                newp2f = os.path.join(dname, newname)
+                oldp2f = os.path.join(dname, outfile)
+                wrds_util.move_file(oldp2f, newp2f)
+            else:
+                subfrom = 'to' + str(R[-1])
+                subto = 'to' + str(R[0] - 1 + n_lines)
+                newname = re.sub(subfrom, subto, outfile)
+                oldp2f = os.path.join(dname, outfile)
+                newp2f = os.path.join(dname, newname)
+                wrds_util.move_file(oldp2f, newp2f)
+            self._finish_period(dataset, Y, M, D, recombine, tag)
 
-    def _get_wrds_chunk(self, dataset, Y, M=0, D=0, R=[]):
+        return [keep_going, n_lines]
+
+    def _get_wrds_chunk(self, dataset, Y, M=0, D=0, R=[], query={}):
         """Helper fn to manage server data storage limits.
 
         Some files requested by get_wrds are too large to fit in a user's
@@ -457,16 +787,63 @@ class WrdsSession(object):
         :param M:
         :param D:
         :param R:
+        :param query: keyword arguments for sas_query.wrds_sas_script.
         :return [success, time_elapsed]:
         """
         tic = time.time()
-        [sas_file, outfile, dataset] = \
-            sas_query.wrds_sas_script(self.download_path, dataset, Y, M, D, R)
+        dname = self._make_output_dir(dataset, Y, M, D,
+                                      wrds_util.filter_tag(**query))
+        [sas_file, outfile, dataset] = sas_query.wrds_sas_script(
+            self.download_path, dataset, Y, M, D, R, **query)
         log_file = re.sub('\.sas$', '.log', sas_file)
 
-        put_success = self._put_sas_file(outfile, sas_file)
-        exit_status = self._sas_step(sas_file, outfile)
-        exit_status = self._handle_sas_failure(exit_status, outfile, log_file)
+        if self._resumable(outfile):
+            # An earlier run was interrupted while downloading this output;
+            # the server copy is unchanged, so skip straight to the download.
+            print('get_wrds resuming download of ' + outfile)
+            exit_status = 0
+        else:
+            put_success = self._put_sas_file(outfile, sas_file)
+            exit_status = self._sas_step(sas_file, outfile)
+        success = self._collect_chunk(exit_status, outfile, sas_file, log_file,
+                                      dname=dname)
+        return [success, time.time()-tic]
+
+    def _resumable(self, outfile):
+        """Checks whether a partial download of outfile from an earlier run
+        can be resumed, i.e. its checkpoint matches the file still sitting
+        on the wrds server.
+
+        :param outfile:
+        :return resumable (bool):
+        """
+        remote_path = ('/home/' + self.wrds_institution + '/' +
+                       self.wrds_username + '/' + outfile)
+        write_file = '.' + outfile + '--writing'
+        local_path = os.path.join(os.path.expanduser('~'), write_file)
+        return transfer.checkpoint_matches(self.sftp, remote_path, local_path)
+
+    def _collect_chunk(self, exit_status, outfile, sas_file, log_file,
+                       purge=1, dname=None):
+        """Handles the output of a finished SAS job: checks the exit status,
+        downloads outfile, verifies its size and fetches the log file.
+
+        Shared by _get_wrds_chunk and the pipelined wrds_loop, which start
+        their SAS jobs differently but finish them the same way.
+
+        :param exit_status:
+        :param outfile:
+        :param sas_file:
+        :param log_file: fetched with _get_log_file, unless None.
+        :param purge: passed to _get_log_file.
+        :param dname: local directory for outfile and log_file, see
+            _output_dir; defaults to download_path.
+        :return success (bool):
+        """
+        if dname is None:
+            dname = self.download_path
+        exit_status = self._handle_sas_failure(exit_status, outfile, log_file,
+                                               dname)
 
         if exit_status in [0, 1]:
             remote_files = self._try_listdir('.')
@@ -479,67 +856,846 @@ class WrdsSession(object):
 
             else:
                 remote_size = self._wait_for_sas_file_completion(outfile)
-                [get_success, dt] = self._retrieve_file(outfile, remote_size)
-                local_size \
-                    = wrds_util.wait_for_retrieve_completion(outfile, get_success)
+                remote_file = outfile
+                if self.compress and remote_size:
+                    remote_file = self._compress_remote(outfile)
+                [get_success, dt] = self._retrieve_file(outfile, remote_size,
+                                                        remote_file)
+                local_size = wrds_util.wait_for_retrieve_completion(
+                    outfile, get_success, synchronous=1)
                 compare_success = \
                     self._compare_local_to_remote(outfile, remote_size,
-                                                  local_size)
+                                                  local_size, remote_file,
+                                                  dname)
 
-        got_log = self._get_log_file(log_file, sas_file)
-        checkfile = os.path.join(self.download_path, outfile)
+        if log_file:
+            got_log = self._get_log_file(log_file, sas_file, purge=purge,
+                                         dname=dname)
+        checkfile = os.path.join(dname, outfile)
         if os.path.exists(checkfile) or exit_status == 0:
-            return [1, time.time()-tic]
-        return [0, time.time()-tic]
+            return 1
+        return 0
 
     def _rename_after_download(self):
         return NotImplementedError
 
-    def wrds_loop(self, dataset, min_date=0, recombine=1):
+    def wrds_loop(self, dataset, min_date=0, recombine=1, n_jobs=1,
+                  stream=0, batch=0, partition=None, columns=None,
+                  where=None, ids=None, id_var=None):
         """Executes get_wrds(database_name,...) over all years and months for
         which data is available for the specified data set.  File separated
         into chunks for downloading will be recombined into their original
         forms if recombine is set to its default value 1.
 
+        Only the periods that sync.plan finds missing, or left in
+        row-chunks, are requested; periods the manifest records as having
+        no table on WRDS are skipped.
+
+        If n_jobs > 1, up to n_jobs SAS jobs are kept running on the server
+        at once and finished outputs are downloaded while the others are
+        still computing, see _wrds_loop_pipelined.
+
+        If stream == 1, each period is streamed over the SSH channel as in
+        get_wrds; this bypasses the home directory and so ignores n_jobs.
+
+        If batch == 1, all periods are exported by a single SAS program, see
+        _wrds_loop_batch.  This saves the SAS start-up cost of each period
+        in loops over many small periods, but does not split large periods
+        into row-chunks.
+
+        If partition is 'Y' (or 'M'), monthly and daily periods are exported
+        with a single scan of the source table per year (or month), see
+        _wrds_loop_partitioned.
+
+        columns, where, ids and id_var filter every period as in get_wrds.
+
         :param dataset:
         :param min_date:
         :param recombine:
+        :param n_jobs: number of SAS jobs to run concurrently on the server.
+        :param stream:
+        :param batch:
+        :param partition: None, 'Y' or 'M'.
+        :param columns:
+        :param where:
+        :param ids:
+        :param id_var:
         :return [n_files, time_elapsed]:
         """
+        if not self._in_wrds_loop:
+            # Runs the loop below, with finished periods recombined and
+            # converted in the background if postprocess_workers > 0, then
+            # waits for them all and saves user_info.
+            self._in_wrds_loop = 1
+            self._size_models = {}
+            if self.postprocess_workers > 0:
+                self.postprocessor = \
+                    postprocess.PostProcessor(self.postprocess_workers)
+            try:
+                return self.wrds_loop(dataset, min_date, recombine, n_jobs,
+                                      stream, batch, partition, columns,
+                                      where, ids, id_var)
+            finally:
+                if self.postprocessor is not None:
+                    self.postprocessor.close()
+                    self.postprocessor = None
+                self.save_user_info()
+                self._in_wrds_loop = 0
+
         tic = time.time()
+        query = {'columns': columns, 'where': where, 'ids': ids,
+                 'id_var': id_var}
+        tag = wrds_util.filter_tag(**query)
+        key = wrds_util.dataset_key(dataset, tag)
         [n_files, n_lines, n_lines0] = [0, 0, 0]
-        [min_year, min_month, min_day] = self.min_ymd(min_date, dataset)
-        flist = os.listdir(self.download_path)
+        first_period = self._open_manifest().first_period(key)
+        if min_date == 0 and first_period:
+            # Looks for missing periods from the first one downloaded, not
+            # just after the latest one.
+            min_date = first_period
+        [min_year, min_month, min_day] = self.min_ymd(min_date, dataset, tag)
+        # Picks up any changes made to download_path since the last loop.
+        dirindex.reset(self.download_path)
 
         if [min_year, min_month, min_day] == [-1, -1, -1]:
             Y = 'all'
-            get_output = self.get_wrds(dataset, Y, M=0, D=0, recombine=recombine)
-            [new_files, total_lines, dt] = self.get_output
+            get_output = self.get_wrds(dataset, Y, M=0, D=0,
+                                       recombine=recombine, stream=stream,
+                                       **query)
+            [new_files, total_lines, dt] = get_output
             if new_files > 0:
                 n_files += 1
             return [n_files, time.time()-tic]
 
-        for ymd in self.get_ymd_range(min_date, dataset, 1):
-            [Y, M, D] = ymd
-            [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [])
-            if outfile in flist:
-                continue
-            get_output = self.get_wrds(dataset, Y, M=M, D=D, recombine=recombine)
-            [new_files, total_lines, dt] = self.get_output
+        # Only the periods not downloaded yet, or left in row-chunks, and
+        # not known to be empty.
+        sync_plan = sync.plan(dataset,
+                              self.get_ymd_range(min_date, dataset, 1),
+                              self._output_dir,
+                              self._open_manifest().periods(key), tag=tag)
+        print('wrds_loop plan for ' + sync.summary(key, sync_plan))
+        for [Y, M, D] in sync_plan['mismatched']:
+            [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [],
+                                                        tag)
+            print('wrds_loop warning: the size of ' + outfile + ' differs '
+                  'from the one recorded in the manifest.  Remove it to '
+                  'download it again.')
+        ymds = sync.work(sync_plan)
+
+        if partition and ymds and not stream:
+            n_files = self._wrds_loop_partitioned(dataset, ymds, partition,
+                                                  query)
+            return [n_files, time.time()-tic]
+
+        if batch and ymds and not stream:
+            n_files = self._wrds_loop_batch(dataset, ymds, query=query)
+            return [n_files, time.time()-tic]
+
+        if n_jobs > 1 and not stream:
+            n_files = self._wrds_loop_pipelined(dataset, ymds, recombine,
+                                                n_jobs, query=query)
+            return [n_files, time.time()-tic]
+
+        for [Y, M, D] in ymds:
+            [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [],
+                                                        tag)
+            get_output = self.get_wrds(dataset, Y, M=M, D=D,
+                                       recombine=recombine, stream=stream,
+                                       **query)
+            [new_files, total_lines, dt] = get_output
 
             n_files += new_files
             self.update_user_info(n_files, new_files, fname=outfile,
-                                  dataset=dataset, year=Y, month=M, day=D)
+                                  dataset=dataset, year=Y, month=M, day=D,
+                                  seconds=dt, tag=tag)
 
         return [n_files, time.time()-tic]
 
-    def _put_sas_file(self, outfile, sas_file):
+    def _wrds_loop_pipelined(self, dataset, ymds, recombine=1, n_jobs=4,
+                             poll_interval=1, query={}):
+        """Runs the periods ymds of wrds_loop as a pipeline of SAS jobs.
+
+        The rows of every period are first counted by one SAS program (see
+        _probe_row_counts), so that all the row-chunks of a period are
+        queued, and can run concurrently, from the start.  Up to n_jobs
+        row-chunks are kept running on the server at once.  Whenever a job
+        finishes its output is downloaded, and checked with _check_chunk
+        once the earlier chunks of its period have been, while the
+        remaining jobs keep computing; if a period needs more row-chunks
+        than counted, the next one goes to the front of the queue.
+        No new job is started while the files in the home directory exceed
+        WRDS_USER_QUOTA, unless nothing else is running.
+
+        user_info is only advanced past a period once every earlier period
+        has finished, so an interrupted loop never skips a period on restart.
+
+        :param dataset:
+        :param ymds: list of [year, month, day] to download.
+        :param recombine:
+        :param n_jobs:
+        :param poll_interval: longest wait between checks on running jobs.
+        :param query: keyword arguments for sas_query.wrds_sas_script.
+        :return n_files:
+        """
+        tag = wrds_util.filter_tag(**query)
+        counts = {}
+        if ymds and not query.get('ids'):
+            counts = self._probe_row_counts(dataset, ymds, query)
+        [pending, planned] = [[], {}]
+        for [Y, M, D] in ymds:
+            rows_per_file = self._rows_per_file(dataset, Y, M, D, tag)
+            # As many chunks as get_wrds would request, the last of which
+            # may be empty; without a count only the first is known.
+            n_chunks = counts.get((Y, M, D), 0) // rows_per_file + 1
+            pending += [[Y, M, D, [1 + k*rows_per_file,
+                                   (k + 1)*rows_per_file]]
+                        for k in range(n_chunks)]
+            planned[(Y, M, D)] = 1 + (n_chunks - 1)*rows_per_file
+        [running, n_files, files_per_period, done] = [[], 0, {}, set()]
+        [collected, next_row, seconds_per_period] = [{}, {}, {}]
+        next_period = 0
+
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                if running and self._remote_usage() > WRDS_USER_QUOTA:
+                    break
+                [Y, M, D, R] = pending.pop(0)
+                running.append(self._start_sas_job(dataset, Y, M, D, R,
+                                                   query))
+
+            finished = [job for job in running if job['stdout'] is None
+                        or job['stdout'].channel.exit_status_ready()]
+            if not finished:
+                # Wakes as soon as the oldest job exits; the others are
+                # picked up on the next pass.
+                running[0]['stdout'].channel.status_event.wait(poll_interval)
+                continue
+
+            for job in finished:
+                running.remove(job)
+                [Y, M, D, R] = [job['Y'], job['M'], job['D'], job['R']]
+                exit_status = job['exit_status']
+                if job['stdout'] is not None:
+                    exit_status = job['stdout'].channel.recv_exit_status()
+                if exit_status == -1 and job['stdout'] is None:
+                    # SAS could not be started; the period fails here.
+                    keep_going = 0
+                else:
+                    keep_going = self._collect_chunk(
+                        exit_status, job['outfile'], job['sas_file'],
+                        job['log_file'], purge=0, dname=job['dname'])
+                period = (Y, M, D)
+                files_per_period.setdefault(period, 0)
+                if period in done:
+                    # Planned from a count that has since shrunk.
+                    self._discard_chunk(dataset, Y, M, D, R, tag)
+                    continue
+                collected.setdefault(period, {})[R[0]] = \
+                    [R, keep_going, time.time() - job['tic']]
+
+                # Chunks are checked in row order, since the last one
+                # completes the period and hands it to _finish_period.
+                next_row.setdefault(period, 1)
+                while period not in done and \
+                        next_row[period] in collected[period]:
+                    [R, keep_going, seconds] = \
+                        collected[period].pop(next_row[period])
+                    seconds_per_period[period] = \
+                        seconds_per_period.get(period, 0) + seconds
+                    if keep_going > 0:
+                        files_per_period[period] += 1
+                        [keep_going, n_lines] = \
+                            self._check_chunk(dataset, Y, M, D, R, recombine,
+                                              seconds, tag)
+                    next_row[period] = R[1] + 1
+                    if keep_going <= 0:
+                        done.add(period)
+                    elif next_row[period] > planned[period]:
+                        # More rows than counted, or no count at all.
+                        rows_per_file = R[1] - R[0] + 1
+                        pending.insert(0, [Y, M, D, [R[0] + rows_per_file,
+                                                     R[1] + rows_per_file]])
+                        planned[period] = next_row[period]
+                if period in done:
+                    pending = [x for x in pending if tuple(x[:3]) != period]
+                    for R in [x[0] for x in collected.pop(period).values()]:
+                        self._discard_chunk(dataset, Y, M, D, R, tag)
+
+            # Advance user_info in period order only.
+            while next_period < len(ymds) and tuple(ymds[next_period]) in done:
+                [Y, M, D] = ymds[next_period]
+                new_files = files_per_period[(Y, M, D)]
+                n_files += new_files
+                [dset2, outfile] = \
+                    wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+                self.update_user_info(n_files, new_files, fname=outfile,
+                                      dataset=dataset, year=Y, month=M, day=D,
+                                      seconds=seconds_per_period.get(
+                                          (Y, M, D)),
+                                      tag=tag)
+                next_period += 1
+
+        return n_files
+
+    def _wrds_loop_batch(self, dataset, ymds, poll_interval=1, query={}):
+        """Runs the periods ymds of wrds_loop as one SAS program written by
+        sas_query.wrds_sas_batch_script.
+
+        While SAS works through the periods, each output is downloaded as
+        soon as its ".done" marker appears, and checked against the row
+        count written in the marker.  user_info is advanced as each period
+        is collected, in order.
+
+        The periods are not split into row-chunks, so if the files left in
+        the home directory grow past WRDS_USER_QUOTA, SAS is stopped and the
+        remaining periods are downloaded one by one with get_wrds instead.
+
+        :param dataset:
+        :param ymds: list of [year, month, day] to download.
+        :param poll_interval: longest wait between checks for new markers.
+        :param query: keyword arguments for sas_query.wrds_sas_batch_script.
+        :return n_files:
+        """
+        tag = wrds_util.filter_tag(**query)
+        [sas_file, outfiles, dset2] = sas_query.wrds_sas_batch_script(
+            self.download_path, dataset, ymds, **query)
+        log_file = re.sub('\.sas$', '.log', sas_file)
+        put_success = self._put_sas_file(outfiles[0], sas_file)
+        for outfile in outfiles:
+            for fname in [outfile, outfile + '.done']:
+                try:
+                    self.sftp.remove(fname)
+                except (IOError, EOFError, paramiko.SSHException):
+                    pass
+
+        [exec_success, stdin, stdout, stderr] = \
+            self._try_exec('sas -noterminal ' + sas_file)
+        if not exec_success:
+            print('wrds_loop could not start SAS for ' + sas_file)
+            return 0
+
+        remaining = [ymd + [outfile] for [ymd, outfile] in zip(ymds, outfiles)]
+        [n_files, over_quota] = [0, 0]
+        while remaining:
+            exited = stdout.channel.exit_status_ready()
+            n_files = self._collect_batch_outputs(dataset, remaining, n_files,
+                                                  tag)
+            if exited or not remaining:
+                break
+            # Checked once the finished outputs are downloaded, so only
+            # what SAS is still writing or has yet to write is counted.
+            if self._remote_usage() > WRDS_USER_QUOTA:
+                over_quota = 1
+                break
+            stdout.channel.status_event.wait(poll_interval)
+
+        if over_quota:
+            print('wrds_loop: the outputs of ' + sas_file + ' exceed the '
+                  'quota on the wrds server; stopping SAS and downloading '
+                  'the remaining periods one by one.')
+            channel = stdout.channel
+            [exec_succes, stdin, stdout, stderr] = \
+                self._try_exec('pkill -f ' + sas_file)
+            exit_status = sshlib._wait_for_exit(channel)
+            # Periods SAS finished before it was stopped are kept.
+            n_files = self._collect_batch_outputs(dataset, remaining, n_files,
+                                                  tag)
+            if remaining:
+                try:
+                    self.sftp.remove(remaining[0][3])
+                except (IOError, EOFError, paramiko.SSHException):
+                    pass
+            got_log = self._get_log_file(log_file, sas_file)
+            return self._get_wrds_periods(dataset,
+                                          [x[:3] for x in remaining],
+                                          n_files, query)
+
+        if remaining:
+            print('wrds_loop: SAS exited with status ' +
+                  str(stdout.channel.recv_exit_status()) + ' before ' +
+                  'exporting ' + str(len(remaining)) + ' periods, starting ' +
+                  'with ' + remaining[0][3] + '.  For details, see log file "'
+                  + log_file + '"')
+        got_log = self._get_log_file(log_file, sas_file)
+        return n_files
+
+    def _collect_batch_outputs(self, dataset, remaining, n_files=0, tag=''):
+        """Collects, in order, the outputs of a batch SAS program whose
+        ".done" marker has appeared, see _collect_batch_output, and
+        advances user_info for each.
+
+        :param dataset:
+        :param remaining: list of [year, month, day, outfile] not collected
+            yet; collected periods are removed from it.
+        :param n_files: files downloaded so far by the calling loop.
+        :param tag: see wrds_util.filter_tag.
+        :return n_files: n_files plus the files downloaded.
+        """
+        file_list = self._try_listdir('.').keys()
+        while remaining and remaining[0][3] + '.done' in file_list:
+            [Y, M, D, outfile] = remaining.pop(0)
+            dname = self._make_output_dir(dataset, Y, M, D, tag)
+            new_files = self._collect_batch_output(outfile, file_list, dname)
+            n_files += new_files
+            if new_files:
+                self._finish_period(dataset, Y, M, D, recombine=0, tag=tag)
+            self.update_user_info(n_files, new_files, fname=outfile,
+                                  dataset=dataset, year=Y, month=M, day=D,
+                                  tag=tag)
+        return n_files
+
+    def _collect_batch_output(self, outfile, file_list, dname=None):
+        """Downloads one output of a batch SAS program once its ".done"
+        marker has appeared, and checks it against the row count in the
+        marker.
+
+        :param outfile:
+        :param file_list: names in the remote home directory.
+        :param dname: local directory for outfile, see _output_dir.
+        :return success (bool):
+        """
+        expected = -1
+        try:
+            with self.sftp.file(outfile + '.done') as fd:
+                expected = int(fd.read().strip())
+            self.sftp.remove(outfile + '.done')
+        except (IOError, EOFError, ValueError, paramiko.SSHException):
+            pass
+
+        if expected == -1 or outfile not in file_list:
+            print('wrds_loop: SAS failed to export ' + outfile)
+            return 0
+
+        if dname is None:
+            dname = self.download_path
+        success = self._collect_chunk(0, outfile, None, None, dname=dname)
+        local_path = os.path.join(dname, outfile)
+        if success and os.path.exists(local_path):
+            n_lines = wrds_util.get_n_lines(local_path)
+            if n_lines != expected:
+                print('wrds_loop error: file "' + outfile + '" has ' +
+                      str(n_lines) + ' lines, but ' + str(expected) +
+                      ' were expected.')
+                wrds_util.remove_file(local_path)
+                return 0
+        return success
+
+    def _wrds_loop_partitioned(self, dataset, ymds, partition='Y', query={}):
+        """Runs the periods ymds of wrds_loop grouped by year (or by month if
+        partition == 'M'), exporting each group of monthly or daily periods
+        with one scan of the source table, see _get_wrds_partition.
+
+        Yearly periods, and datasets stored as one table per period (e.g.
+        taq.cq), gain nothing from this and go through get_wrds as usual.
+
+        A group is not split into row-chunks, so once the manifest holds
+        earlier downloads of dataset (see sizing.SizeModel), groups are
+        cut into runs of periods expected to fill at most half of
+        WRDS_USER_QUOTA.
+
+        :param dataset:
+        :param ymds: list of [year, month, day] to download.
+        :param partition: 'Y' or 'M'.
+        :param query: keyword arguments for the sas_query scripts.
+        :return n_files:
+        """
+        groups = []
+        for [Y, M, D] in ymds:
+            key = [Y, M * (partition == 'M'), D != 0]
+            if not groups or groups[-1][0] != key:
+                groups.append([key, []])
+            groups[-1][1].append([Y, M, D])
+
+        bytes_per_year = self._size_model(
+            dataset, wrds_util.filter_tag(**query)).bytes_per_year
+        n_files = 0
+        for [[Y, M, daily], group] in groups:
+            [Y0, M0, D0] = group[0]
+            [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, 0, [])
+            [dset3, outfile] = wrds_util.fix_input_name(dataset, Y0, M0, D0,
+                                                        [])
+            if M0 == 0 or dset2 != dset3:
+                n_files = self._get_wrds_periods(dataset, group, n_files,
+                                                 query)
+                continue
+            frequency = 'D' if daily else 'M'
+            n_periods = len(group)
+            if bytes_per_year:
+                n_periods = max(1, int(WRDS_USER_QUOTA // 2 *
+                                       sizing.PERIODS_PER_YEAR[frequency] //
+                                       bytes_per_year))
+            for k in range(0, len(group), n_periods):
+                n_files = self._get_wrds_partition(
+                    dataset, group[k:k + n_periods], frequency, n_files,
+                    query=query)
+        return n_files
+
+    def _get_wrds_periods(self, dataset, ymds, n_files=0, query={}):
+        """Downloads the periods ymds one by one with get_wrds.
+
+        :param dataset:
+        :param ymds: list of [year, month, day] to download.
+        :param n_files: files downloaded so far by the calling loop.
+        :param query: keyword arguments for get_wrds.
+        :return n_files: n_files plus the files downloaded.
+        """
+        tag = wrds_util.filter_tag(**query)
+        for [Y, M, D] in ymds:
+            [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [],
+                                                        tag)
+            [new_files, total_lines, dt] = \
+                self.get_wrds(dataset, Y, M=M, D=D, **query)
+            n_files += new_files
+            self.update_user_info(n_files, new_files, fname=outfile,
+                                  dataset=dataset, year=Y, month=M, day=D,
+                                  tag=tag)
+        return n_files
+
+    def _get_wrds_partition(self, dataset, ymds, frequency, n_files=0,
+                            poll_interval=1, query={}):
+        """Exports the monthly or daily periods ymds with a single scan,
+        using sas_query.wrds_sas_partition_script, then downloads each
+        period's file and checks it against the row counts written by the
+        script.  Periods without any rows get a file holding only the
+        header line, as proc export would write.
+
+        If the files in the home directory grow past WRDS_USER_QUOTA while
+        SAS is running, SAS is stopped and ymds are downloaded one by one
+        with get_wrds instead.
+
+        :param dataset:
+        :param ymds: list of [year, month, day] to download, all read from
+            the same table.
+        :param frequency: 'M' or 'D'.
+        :param n_files: files downloaded so far by the calling loop.
+        :param poll_interval: longest wait between checks on the quota.
+        :param query: keyword arguments for
+            sas_query.wrds_sas_partition_script.
+        :return n_files: n_files plus the files downloaded.
+        """
+        [sas_file, counts_file, dset2] = sas_query.wrds_sas_partition_script(
+            self.download_path, dataset, ymds, frequency, **query)
+        log_file = re.sub('\.sas$', '.log', sas_file)
+        tag = wrds_util.filter_tag(**query)
+        outfiles = [wrds_util.fix_input_name(dataset, y, m, d, [], tag)[1]
+                    for [y, m, d] in ymds]
+        rm_outfiles = 'rm -f ' + ' '.join(outfiles)
+
+        put_success = self._put_sas_file(outfiles[0], sas_file)
+        [exec_success, stdin, stdout, stderr] = \
+            self._try_exec('sas -noterminal ' + sas_file)
+        if not exec_success:
+            print('wrds_loop could not start SAS for ' + sas_file)
+            return n_files
+        channel = stdout.channel
+        while not channel.exit_status_ready():
+            if self._remote_usage() > WRDS_USER_QUOTA:
+                print('wrds_loop: the outputs of ' + sas_file + ' exceed '
+                      'the quota on the wrds server; stopping SAS and '
+                      'downloading its ' + str(len(ymds)) + ' periods one '
+                      'by one.')
+                [exec_success, stdin, stdout, stderr] = \
+                    self._try_exec('pkill -f ' + sas_file)
+                exit_status = sshlib._wait_for_exit(channel)
+                [exec_success, stdin, stdout, stderr] = \
+                    self._try_exec(rm_outfiles)
+                got_log = self._get_log_file(log_file, sas_file)
+                return self._get_wrds_periods(dataset, ymds, n_files, query)
+            channel.status_event.wait(poll_interval)
+        exit_status = channel.recv_exit_status()
+
+        counts = {}
+        header = None
+        if exit_status in [0, 1]:
+            try:
+                with self.sftp.file(counts_file) as fd:
+                    count_lines = fd.read().splitlines()
+                header = count_lines[0]
+                for line in count_lines[1:]:
+                    [path, n_rows] = line.rsplit(None, 1)
+                    counts[os.path.basename(path)] = int(n_rows)
+            except (IOError, EOFError, IndexError, ValueError,
+                    paramiko.SSHException):
+                header = None
+        if header is None:
+            print('get_wrds failed on file "' + sas_file + '"\n' +
+                  'exit_status = ' + str(exit_status) + '\n' + 'For '
+                  'details, see log file "' + log_file + '"')
+            [exec_success, stdin, stdout, stderr] = \
+                self._try_exec(rm_outfiles)
+            got_log = self._get_log_file(log_file, sas_file)
+            return n_files
+
+        for ([Y, M, D], outfile) in zip(ymds, outfiles):
+            dname = self._make_output_dir(dataset, Y, M, D, tag)
+            local_path = os.path.join(dname, outfile)
+            if counts.get(outfile, 0) > 0:
+                new_files = self._collect_chunk(0, outfile, None, None,
+                                                dname=dname)
+                n_lines = -1
+                if os.path.exists(local_path):
+                    n_lines = wrds_util.get_n_lines(local_path)
+                if new_files and n_lines != counts[outfile]:
+                    print('get_wrds error: file "' + outfile + '" has ' +
+                          str(n_lines) + ' lines, but ' +
+                          str(counts[outfile]) + ' were expected.')
+                    wrds_util.remove_file(local_path)
+                    new_files = 0
+            else:
+                with open(local_path, 'wb') as fd:
+                    fd.write(header + '\n')
+                dirindex.file_added(local_path)
+                new_files = 1
+            n_files += new_files
+            if new_files:
+                self._finish_period(dataset, Y, M, D, recombine=0, tag=tag)
+            self.update_user_info(n_files, new_files, fname=outfile,
+                                  dataset=dataset, year=Y, month=M, day=D,
+                                  tag=tag)
+
+        [exec_success, stdin, stdout, stderr] = self._try_exec(rm_outfiles)
+        got_log = self._get_log_file(log_file, sas_file)
+        return n_files
+
+    def _finish_period(self, dataset, Y, M=0, D=0, recombine=1, tag=''):
+        """Runs _post_process for a period whose download is complete,
+        in the background if wrds_loop has started a PostProcessor.  The
+        space for recombining the row-chunks is reserved on the disk
+        before the work is queued.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param recombine:
+        :param tag: see wrds_util.filter_tag.
+        :return success (bool): always 1 if run in the background.
+        """
+        if self.postprocessor is None:
+            return self._post_process(dataset, Y, M, D, recombine, tag)
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+        dname = self._output_dir(dataset, Y, M, D, tag)
+        n_bytes = 0
+        if recombine == 1:
+            chunks = dirindex.get_index(dname).chunks(
+                re.sub('\.tsv$', '', outfile))
+            n_bytes = sum(os.path.getsize(os.path.join(dname, x[2]))
+                          for x in chunks)
+        self.postprocessor.submit(outfile, self._post_process,
+                                  [dataset, Y, M, D, recombine, tag], n_bytes,
+                                  dname)
+        return 1
+
+    def _post_process(self, dataset, Y, M=0, D=0, recombine=1, tag=''):
+        """Recombines the row-chunks of a period if recombine == 1 and
+        writes the columnar copy.  When run by the PostProcessor, the
+        recombined file is also verified against its metadata record.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param recombine:
+        :param tag: see wrds_util.filter_tag.
+        :return success (bool): 0 if chunks were left uncombined or the
+            recombined file does not match its record.
+        """
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+        dname = self._output_dir(dataset, Y, M, D, tag)
+        period_name = re.sub('\.tsv$', '', outfile)
+        index = dirindex.get_index(dname)
+        if recombine == 1 and index.chunks(period_name):
+            wrds_util.recombine_files(period_name, dname=dname)
+            if index.chunks(period_name):
+                return 0
+            path2file = os.path.join(dname, outfile)
+            if self.postprocessor is not None:
+                # Verifying reads the whole file again, which is only
+                # worth it off the download thread.
+                if wrds_util.verify_file_meta(path2file) == 0:
+                    print('get_wrds error: recombined file "' + outfile +
+                          '" does not match the rows of its chunks.')
+                    return 0
+                [n_rows, n_bytes, crc32] = manifest.file_stats(path2file)
+                self._open_manifest().record_period(
+                    wrds_util.dataset_key(dataset, tag), Y, M, D, 'done',
+                    n_rows, n_bytes, crc32)
+        self._convert_columnar(dataset, Y, M, D, tag)
+        return 1
+
+    def _convert_columnar(self, dataset, Y, M=0, D=0, tag=''):
+        """Writes the typed columnar copy of the file for one period, see
+        columnar.convert_file, if user_info asks for one and the file has
+        been downloaded and recombined.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param tag: see wrds_util.filter_tag.
+        :return cache: path of the copy, or None.
+        """
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, [], tag)
+        path2file = os.path.join(self._output_dir(dataset, Y, M, D, tag),
+                                 outfile)
+        if not (self.columnar and os.path.exists(path2file)):
+            return None
+        return columnar.convert_file(path2file, dataset, self.columnar)
+
+    def _output_dir(self, dataset, Y, M=0, D=0, tag=''):
+        """Returns the local directory for the files of one period under
+        the layout set in user_info, see layout.output_dir.  Filtered
+        downloads have directories of their own in the partitioned layout.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param tag: see wrds_util.filter_tag.
+        :return dname:
+        """
+        return layout.output_dir(self.download_path,
+                                 wrds_util.dataset_key(dataset, tag), Y, M, D,
+                                 self.layout)
+
+    def _make_output_dir(self, dataset, Y, M=0, D=0, tag=''):
+        """_output_dir, creating the directory if needed, for writing the
+        files of one period.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param tag: see wrds_util.filter_tag.
+        :return dname:
+        """
+        return layout.make_output_dir(self.download_path,
+                                      wrds_util.dataset_key(dataset, tag),
+                                      Y, M, D, self.layout)
+
+    def _probe_row_counts(self, dataset, ymds, query={}):
+        """Counts the rows of every period in ymds with a single SAS program
+        written by sas_query.wrds_sas_count_script, before any of them is
+        exported.
+
+        :param dataset:
+        :param ymds: list of [year, month, day].
+        :param query: keyword arguments for sas_query.wrds_sas_script; only
+            where applies to the count.
+        :return counts: dict of row counts keyed by (year, month, day),
+            without the periods whose count failed.
+        """
+        tag = wrds_util.filter_tag(**query)
+        [sas_file, counts_file, dset2] = sas_query.wrds_sas_count_script(
+            self.download_path, dataset, ymds, query.get('where'), tag)
+        log_file = re.sub('\.sas$', '.log', sas_file)
+        put_success = self._put_sas_file(counts_file, sas_file, purge=0)
+        [exec_success, stdin, stdout, stderr] = \
+            self._try_exec('sas -noterminal ' + sas_file)
+        if not exec_success:
+            print('wrds_loop could not start SAS for ' + sas_file)
+            return {}
+        exit_status = stdout.channel.recv_exit_status()
+
+        periods = dict((wrds_util.fix_input_name(dataset, Y, M, D, [], tag)[1],
+                        (Y, M, D)) for [Y, M, D] in ymds)
+        [counts, lines] = [{}, []]
+        try:
+            with self.sftp.file(counts_file) as fd:
+                lines = fd.read().splitlines()
+            self.sftp.remove(counts_file)
+        except (IOError, EOFError, paramiko.SSHException):
+            print('wrds_loop: could not count the rows of ' + dataset +
+                  ', exit_status = ' + str(exit_status) + '.  For '
+                  'details, see log file "' + log_file + '"')
+        # One line "<output_file> <n_obs>" per period; a line that cannot
+        # be read only loses the count of its own period.
+        for line in lines:
+            try:
+                [outfile, n_obs] = line.split()
+                n_obs = int(n_obs)
+            except ValueError:
+                print('wrds_loop: could not read the row count "' +
+                      str(line) + '" in ' + counts_file)
+                continue
+            if outfile in periods and n_obs >= 0:
+                counts[periods[outfile]] = n_obs
+        got_log = self._get_log_file(log_file, sas_file, purge=0)
+        return counts
+
+    def _discard_chunk(self, dataset, Y, M, D, R, tag=''):
+        """Removes a downloaded row-chunk that its period turned out not
+        to need.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param R:
+        :param tag: see wrds_util.filter_tag.
+        :return:
+        """
+        [dset2, outfile] = wrds_util.fix_input_name(dataset, Y, M, D, R, tag)
+        path2file = os.path.join(self._output_dir(dataset, Y, M, D, tag),
+                                 outfile)
+        if os.path.exists(path2file):
+            wrds_util.remove_file(path2file)
+
+    def _start_sas_job(self, dataset, Y, M, D, R, query={}):
+        """Writes and uploads the SAS script for one row-chunk and starts it
+        on the server without waiting for it to finish.
+
+        :param dataset:
+        :param Y:
+        :param M:
+        :param D:
+        :param R:
+        :param query: keyword arguments for sas_query.wrds_sas_script.
+        :return job (dict): job['stdout'] is None if SAS was not started,
+            in which case job['exit_status'] is 0 for a resumed download
+            and -1 if SAS could not be started.
+        """
+        [sas_file, outfile, dset2] = sas_query.wrds_sas_script(
+            self.download_path, dataset, Y, M, D, R, **query)
+        log_file = re.sub('\.sas$', '.log', sas_file)
+        [stdout, exit_status] = [None, None]
+        if self._resumable(outfile):
+            # As in _get_wrds_chunk, the unchanged server output of an
+            # interrupted run is downloaded without running SAS again.
+            print('wrds_loop resuming download of ' + outfile)
+            exit_status = 0
+        else:
+            put_success = self._put_sas_file(outfile, sas_file, purge=0)
+            [exec_success, stdin, stdout, stderr] = \
+                self._try_exec('sas -noterminal ' + sas_file)
+            if not exec_success:
+                print('wrds_loop could not start SAS for ' + sas_file)
+                [stdout, exit_status] = [None, -1]
+        return {'Y': Y, 'M': M, 'D': D, 'R': R, 'sas_file': sas_file,
+                'outfile': outfile, 'log_file': log_file, 'stdout': stdout,
+                'exit_status': exit_status,
+                'dname': self._make_output_dir(dataset, Y, M, D,
+                                               wrds_util.filter_tag(**query)),
+                'tic': time.time()}
+
+    def _remote_usage(self):
+        """Returns the total size in bytes of the files in the user's home
+        directory on the wrds server.
+
+        :return total_file_size:
+        """
+        remote_files = self._try_listdir('.')
+        return sum([x.st_size for x in remote_files.values()])
+
+    def _put_sas_file(self, outfile, sas_file, purge=1):
         """Puts sas_file in home directory on wrds server, checks autoexec
         and removes existing run and log scripts.
 
         Checks autoexec file present, and adds if not. Removes all previous sas
         and log files with the wrds_export prefix and any result files with the
-        rows<x>to<y>.tsv format.
+        rows<x>to<y>.tsv format.  If purge == 0, only files belonging to
+        outfile are removed, so that other SAS jobs running concurrently
+        keep their scripts and logs.
 
         1. Removes old files which may interfere with the new files.
             Assumes export files in format wrds_export_<outfile>.sas,
@@ -548,17 +1704,19 @@ class WrdsSession(object):
 
         :param outfile:
         :param sas_file:
+        :param purge:
         :return put_success (bool):
         """
         remote_files = self._try_listdir('.')
-        initial_files = remote_files.values()
+        initial_files = list(remote_files.values())
+        log_file = re.sub('\.sas$', '.log', sas_file)
 
         # 1. Removes old files, both .sas and .log files with wrds_export prefix
         old_export_files = \
             [x for x in initial_files
-             if re.search('wrds_export.*sas$', x.filename)
-             or re.search('wrds_export.*log$', x.filename)
-             or x.filename == sas_file]
+             if (purge and re.search('wrds_export.*sas$', x.filename))
+             or (purge and re.search('wrds_export.*log$', x.filename))
+             or x.filename in [sas_file, log_file]]
         for old_file in old_export_files:
             try:
                 self.sftp.remove(old_file.filename)
@@ -566,10 +1724,16 @@ class WrdsSession(object):
                 pass
             initial_files.remove(old_file)
 
-        # Catch the row fragment of any output files, e.g. rows1to1000000.tsv.
-        pattern = '[0-9]*rows[0-9]+to[0-9]+\.tsv$'
+        # Catch the row fragment of any output files, e.g. rows1to1000000.tsv,
+        # including compressed leftovers such as rows1to1000000.tsv.gz.
+        pattern = '[0-9]*rows[0-9]+to[0-9]+\.tsv(\.gz|\.zst)?$'
         old_outfiles = [x for x in initial_files
             if re.sub(pattern, '', x.filename) == re.sub(pattern, '', outfile)]
+        if not purge:
+            # The pattern above also strips the date digits, so it would
+            # catch the outputs of other periods still being computed.
+            old_outfiles = [x for x in old_outfiles
+                            if re.sub('(\.gz|\.zst)$', '', x.filename) == outfile]
 
         for old_file in old_outfiles:
             try:
@@ -613,6 +1777,13 @@ class WrdsSession(object):
             [exec_succes, stdin, stdout, stderr] = self._try_exec(ssh_command)
             os.remove('autoexec.sas')
 
+        # The ids filter of sas_file, if any, goes up alongside it.
+        ids_file = sas_query.ids_file_name(sas_file)
+        ids_path = os.path.join(self.download_path, ids_file)
+        if os.path.exists(ids_path):
+            [ids_success] = self._try_put(ids_path, ids_file)
+            os.remove(ids_path)
+
         local_path = os.path.join(self.download_path, sas_file)
         remote_path = sas_file
 
@@ -660,46 +1831,46 @@ class WrdsSession(object):
         """
         sas_command = ('sas -noterminal ' + sas_file)
         [stdin, stdout, stderr] = self.ssh.exec_command(sas_command)
-        [exit_status, exit_status2, waited, maxwait] = [-1, -1, 0, 1200]
-        while exit_status == -1 and waited < maxwait:
-            time.sleep(10)
-            waited += 10
-            exit_status = stdout.channel.recv_exit_status()
-
-        if waited >= maxwait:
-            print('get_wrds stopped waiting for SAS completion at step 1: '
+        exit_status = sshlib._wait_for_exit(stdout.channel)
+
+        if exit_status == -1:
+            print('get_wrds lost the connection before SAS completed: '
                   + outfile)
         return exit_status
 
-    def _handle_sas_failure(self, exit_status, outfile, log_file):
+    def _handle_sas_failure(self, exit_status, outfile, log_file, dname=None):
         """Checks sas exit status returned by wrds server and responds
         appropriately to any statuses other than success.
 
         :param exit_status:
         :param outfile:
         :param log_file:
+        :param dname: local directory for outfile, defaults to download_path.
         :return exit_status:
         """
+        if dname is None:
+            dname = self.download_path
         real_failure = 1
         remote_files = self._try_listdir('.')
 
-        if exit_status == 2 and log_file in remote_files.keys():
+        log_summary = None
+        if exit_status not in [0, 1] and log_file in remote_files.keys():
             with self.sftp.file(log_file) as fd:
-                logcontent = fd.read()
-            if re.search('error: file .* does not exist.', logcontent,
-                         flags=re.I):
+                log_summary = saslog.parse_log_text(fd.read())
+            if exit_status == 2 and log_summary['file_missing']:
                 real_failure = 0
 
         if exit_status not in [0, 1] and real_failure == 1:
             # 1 is "SAS system issued warnings", non-fatal    #
 
-            if outfile in remote_files.keys():
+            # -1: the connection was lost, SAS may still be writing outfile.
+            if outfile in remote_files.keys() and exit_status != -1:
                 print('SAS is apparently returning an incorrect exit status: '
                       + str(exit_status) + ', ' + outfile + '. ectools is ' +
                       'downloading the file for user inspection.')
 
                 remote_path = outfile
-                local_path = os.path.join(self.download_path, outfile)
+                local_path = os.path.join(dname, outfile)
                 [get_success, dt] = self._try_get(local_path, remote_path)
 
                 if get_success == 0:
@@ -709,50 +1880,64 @@ class WrdsSession(object):
                 print('get_wrds failed on file "' + outfile + '"\n' +
                       'exit_status = ' + str(exit_status) + '\n' + 'For '
                       'details, see log file "' + log_file + '"')
+                if log_summary is not None and log_summary['errors']:
+                    print('First error in the log: ' +
+                          log_summary['errors'][0])
 
         return exit_status
 
     def _wait_for_sas_file_completion(self, outfile):
         """Checks size of outfile on the wrds server within get_wrds.
 
-        Until it observes two successive measurements with the same file
-        size, it infers that the sas script is still writing the file.
+        Only called once the SAS process has exited, at which point
+        the file is complete, so a single stat gives its final size.
 
         :param outfile:
         :return remote_size:
         """
-        [remote_size, remote_size_delayed, mtime, total_wait, max_wait] \
-            = [0, 1, time.time(), 0, 1200]
-
-        while self.sftp and ((total_wait < max_wait) and
-                             remote_size != remote_size_delayed):
-            remote_size = remote_size_delayed
-            time.sleep(10)
-            total_wait += 10
-            try:
-                output_stat = self.sftp.stat(outfile)
-                remote_size_delayed = output_stat.st_size
-                mtime = output_stat.st_mtime
-            except (IOError, EOFError, paramiko.SSHException):
-                raise NotImplementedError
-                # TODO: ssh reconnect
-
-        if total_wait >= max_wait:
-            print('get_wrds stopped waiting for SAS completion at step 2',
-                  + remote_size + remote_size_delayed + mtime)
-            remote_size = 0
-            # should i remove the file in this case?
-
+        remote_size = 0
+        try:
+            remote_size = self.sftp.stat(outfile).st_size
+        except (IOError, EOFError, paramiko.SSHException):
+            # TODO: ssh reconnect
+            print('get_wrds could not stat ' + outfile + ' on the wrds '
+                  'server after SAS completed.')
         return remote_size
 
-    def _retrieve_file(self, outfile, remote_size):
+    def _compress_remote(self, outfile):
+        """Compresses outfile in place on the wrds server with the
+        compression given by self.compress.
+
+        :param outfile:
+        :return remote_file: name of the compressed file on the server, or
+            outfile if compression failed.
+        """
+        [command, ext] = transfer.COMPRESSORS[self.compress]
+        [exec_success, stdin, stdout, stderr] = self._try_exec(command + outfile)
+        if exec_success and stdout.channel.recv_exit_status() == 0:
+            return outfile + ext
+        print('get_wrds could not ' + self.compress + '-compress ' + outfile
+              + ' on the server, downloading it uncompressed.')
+        return outfile
+
+    def _retrieve_file(self, outfile, remote_size, remote_file=None):
         """Retrieves the outfile produced on the wrds server in
         get_wrds, including correct handling of several common network errors.
 
+        If remote_file is the compressed version of outfile made by
+        _compress_remote, it is decompressed while it is downloaded, so the
+        local file is the same as with an uncompressed transfer.
+
         :param outfile:
-        :param remote_size:
+        :param remote_size: size of the uncompressed outfile.
+        :param remote_file: name of the file to download, defaults to outfile.
         :return get_success:
         """
+        if remote_file is None:
+            remote_file = outfile
+        compression = None
+        if remote_file != outfile:
+            compression = self.compress
         tic = time.time()
         if remote_size == 0:
             return [0, time.time()-tic]
@@ -771,34 +1956,55 @@ class WrdsSession(object):
             return [0, time.time()-tic]
 
         remote_path = ('/home/' + self.wrds_institution + '/' +
-                       self.wrds_username + '/' + outfile)
+                       self.wrds_username + '/' + remote_file)
         write_file = '.' + outfile + '--writing'
         local_path = os.path.join(os.path.expanduser('~'), write_file)
-        [get_success, dt] = self._try_get(local_path, remote_path)
+        if compression:
+            [get_success, dt] = self._try_get(local_path, remote_path,
+                                              compression=compression)
+        elif (self.download_streams > 1
+                and remote_size >= transfer.PARALLEL_MIN_SIZE):
+            [get_success, stream_stats] = \
+                transfer.parallel_get(self.ssh, remote_path, local_path,
+                                      self.download_streams)
+            transfer.print_stream_stats(outfile, stream_stats)
+        else:
+            [get_success, dt] = self._try_get(local_path, remote_path)
 
         print('retrieve_file: ' + repr(outfile) + ' ('+repr(remote_size) +
               ' bytes) ' + ' time elapsed=' + repr(time.time()-tic))
 
         return [get_success, time.time()-tic]
 
-    def _compare_local_to_remote(self, outfile, remote_size, local_size):
+    def _compare_local_to_remote(self, outfile, remote_size, local_size,
+                                 remote_file=None, dname=None):
         """Compares the size of the file "outfile" downloaded (local_size) to
         the size of the file as listed on the server (remote_size) to
         check download completed properly.
 
+        For compressed transfers, remote_size is the size of outfile before
+        compression and local_size that of the decompressed download.
+
         :param outfile:
         :param remote_size:
         :param local_size:
+        :param remote_file: file to remove from the server on success,
+            defaults to outfile.
+        :param dname: local directory for outfile, defaults to download_path.
         :return compare_success (bool):
         """
+        if remote_file is None:
+            remote_file = outfile
+        if dname is None:
+            dname = self.download_path
         compare_success = 0
         write_file = '.' + outfile + '--writing'
         local_path = os.path.join(os.path.expanduser('~'), write_file)
         if remote_size == local_size != 0:
             [exec_succes, stdin, stdout, stderr] = \
-                self._try_exec('rm ' + outfile)
-            to_path = os.path.join(self.download_path, outfile)
-            shutil.move(local_path, to_path)
+                self._try_exec('rm ' + remote_file)
+            to_path = os.path.join(dname, outfile)
+            wrds_util.move_file(local_path, to_path)
             compare_success = 1
 
         elif local_size != 0:
@@ -809,31 +2015,44 @@ class WrdsSession(object):
                     +'the download stopping at 2^' + repr(log_size) + ' bytes.')
             error_file = '.' + outfile + '--size_error'
             from_file = os.path.join(os.path.expanduser('~'), error_file)
-            to_file = os.path.join(self.download_path, outfile)
+            to_file = os.path.join(dname, outfile)
             shutil.move(from_file, to_file)
+            dirindex.file_added(to_file)
             compare_success = 0
 
         return compare_success
 
-    def _get_log_file(self, log_file, sas_file):
+    def _get_log_file(self, log_file, sas_file, purge=1, dname=None):
         """Attempts to retrieve SAS log file generated by _get_wrds_chunk from
         the WRDS server.
 
         Also removes the sas_file from the local directory, though strictly
-        speaking this belongs in a separate function.
+        speaking this belongs in a separate function.  If purge == 0, only
+        this job's sas and log files are removed from the server instead of
+        every wrds_export* file.
 
         :param log_file:
         :param sas_file:
+        :param purge:
+        :param dname: local directory for log_file, defaults to
+            download_path.
         :return success (bool):
         """
+        if dname is None:
+            dname = self.download_path
         success = 0
         remote_path = ('/home/' + self.wrds_institution + '/' +
                        self.wrds_username + '/' + log_file)
-        local_path = os.path.join(self.download_path, log_file)
+        local_path = os.path.join(dname, log_file)
         [success, dt] = \
             self._try_get(local_path, remote_path)
         [exec_succes, stdin, stdout, stderr] = self._try_exec('rm ' + sas_file)
-        [exec_succes, stdin, stdout, stderr] = self._try_exec('rm wrds_export*')
+        if purge:
+            [exec_succes, stdin, stdout, stderr] = \
+                self._try_exec('rm wrds_export*')
+        else:
+            [exec_succes, stdin, stdout, stderr] = self._try_exec(
+                'rm -f ' + log_file + ' ' + sas_query.ids_file_name(sas_file))
 
         saspath = os.path.join(self.download_path, sas_file)
         if os.path.exists(saspath):
@@ -875,12 +2094,22 @@ class WrdsSession(object):
             n_tries += 1
         return [success]
 
-    def _try_get(self, local_path, remote_path, domain=None, username=None, ports=[22]):
+    def _try_get(self, local_path, remote_path, domain=None, username=None,
+                 ports=[22], compression=None):
         """Tries three times to download file from remote_path to local_path
         using the sftp client.
 
         TODO: If a connection error occurs, it is re-established.
 
+        A failed attempt at a tsv data download ("<outfile>--writing")
+        keeps the partial local file and its checkpoint, so the next
+        attempt (or a later run) resumes from the last verified offset
+        instead of starting from byte zero, see transfer.resumable_get.
+        Any other partial file, e.g. of a log, is removed once every
+        attempt has failed, so that it is never read as complete.  If
+        compression is given, remote_path is decompressed while it is
+        downloaded (without resumption).
+
         Does *not* check that the remote file exists, that the local_path is
         not already in use, or that there is enough space free on the local
         disk to complete the download.
@@ -890,24 +2119,35 @@ class WrdsSession(object):
         :param domain:
         :param username:
         :param ports:
+        :param compression:
         :return [success (bool), time_elapsed]:
         """
         tic = time.time()
         [success, n_tries, max_tries] = [0, 0, 3]
-        while not success and n_tries < max_tries:
-            try:
-                self.sftp.get(remotepath=remote_path, localpath=local_path)
-                success = 1
-            except (paramiko.SSHException, paramiko.SFTPError, IOError,
-                    EOFError):
-                if os.path.exists(local_path):
-                    os.remove(local_path)
-                # TODO: Handle sftp error, try to reconnect.
-                n_tries += 1
-            except KeyboardInterrupt:
+        try:
+            while not success and n_tries < max_tries:
+                try:
+                    if compression:
+                        transfer.decompress_get(self.sftp, remote_path,
+                                                local_path, compression)
+                    else:
+                        transfer.resumable_get(self.sftp, remote_path,
+                                               local_path)
+                    success = 1
+                except (paramiko.SSHException, paramiko.SFTPError, IOError,
+                        EOFError):
+                    # TODO: Handle sftp error, try to reconnect.
+                    n_tries += 1
+                except transfer.DECOMPRESS_ERRORS as err:
+                    # Corrupt or truncated; decompress_get starts over.
+                    print('retrieve_file: ' + remote_path + ': ' + str(err))
+                    n_tries += 1
+        finally:
+            if not success and (compression or not
+                                re.search('\.tsv--writing$', local_path)):
+                transfer.clear_checkpoint(local_path)
                 if os.path.exists(local_path):
-                    os.remove(local_path)
-                raise KeyboardInterrupt
+                    wrds_util.remove_file(local_path)
 
         return [success, time.time()-tic]
 
@@ -8,7 +8,7 @@ last edit: 2014-08-13
 thisAlgorithmBecomingSkynetCost = 99999999999
 import datetime, json, os, re, sys, time
 
-from . import sshlib
+from . import sshlib, trading_calendar
 from _wrds_db_descriptors import *
 
 now = time.localtime()
@@ -81,7 +81,8 @@ def get_ymd_range(min_date, dataset, weekdays=1):
     tuples [year, month, date] over which to iterate in wrds_loop.  Some
     datasets include very large files and need to be queried
     at a monthly or daily frequency to prevent giant files from
-    causing problems on the server.
+    causing problems on the server.  If weekdays is 1, daily datasets
+    are queried on NYSE trading days only, see trading_calendar.
 
     return ymdrange
     """
@@ -97,6 +98,9 @@ def get_ymd_range(min_date, dataset, weekdays=1):
         elif frequency =='M':
             new_ymd = [[year, x, 0] for x in range(1,13)]
             ymdrange = ymdrange + new_ymd
+        elif frequency == 'D' and weekdays == 1:
+            # Daily datasets only have tables for NYSE trading days.
+            ymdrange = ymdrange + trading_calendar.trading_days(year)
         elif frequency == 'D':
             new_ymd = [[year, x, y] for x in range(1,13) for y in range(1,32)]
             new_ymd = fix_weekdays(new_ymd, weekdays)
@@ -0,0 +1,75 @@
+__author__ = 'cpt'
+
+# Script to time recombining row-chunks: the old line-by-line copy against
+# utility.combine_tsv_files.  Writes n_chunks synthetic chunk files of
+# rows_per_chunk rows each to a temporary directory, e.g.
+#
+#   python bench_recombine.py 10 1000000
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pywrds import utility
+
+
+def line_by_line(paths, out_path):
+    """The copy loop recombine_files used before combine_tsv_files."""
+    with open(out_path, 'wb') as fd:
+        headers = None
+        for path in paths:
+            with open(path, 'rb') as fd1:
+                fsize1 = os.stat(path).st_size
+                headers1 = fd1.readline().strip(b'\r\n')
+                if headers is None:
+                    headers = headers1
+                    fd.write(headers1 + b'\n')
+                while fd1.tell() < fsize1:
+                    fd.write(fd1.readline().strip(b'\r\n') + b'\n')
+
+
+def make_chunks(dname, n_chunks, rows_per_chunk, newline=b'\n'):
+    paths = []
+    row = b'10107\t20080102\t0.012345\tMICROSOFT CORP' + newline
+    for n in range(n_chunks):
+        path = os.path.join(dname, 'optionm_opprcd2008rows%dto%d.tsv'
+                            % (n*rows_per_chunk + 1, (n + 1)*rows_per_chunk))
+        with open(path, 'wb') as fd:
+            fd.write(b'SECID\tDATE\tBEST_BID\tNAME' + newline)
+            for start in range(0, rows_per_chunk, 10**5):
+                fd.write(row * min(10**5, rows_per_chunk - start))
+        paths.append(path)
+    return paths
+
+
+def time_it(func, paths, out_path):
+    tic = time.time()
+    func(paths, out_path)
+    return time.time() - tic
+
+
+if __name__ == '__main__':
+    n_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rows_per_chunk = int(sys.argv[2]) if len(sys.argv) > 2 else 10**6
+
+    dname = tempfile.mkdtemp()
+    try:
+        for newline in [b'\n', b'\r\n']:
+            paths = make_chunks(dname, n_chunks, rows_per_chunk, newline)
+            MBs = sum(os.stat(x).st_size for x in paths) / 1e6
+            old_path = os.path.join(dname, 'line_by_line.tsv')
+            new_path = os.path.join(dname, 'blocks.tsv')
+            dt_old = time_it(line_by_line, paths, old_path)
+            dt_new = time_it(utility.combine_tsv_files, paths, new_path)
+            with open(old_path, 'rb') as fd_old:
+                with open(new_path, 'rb') as fd_new:
+                    same = fd_old.read() == fd_new.read()
+            print('%s endings, %d x %d rows (%.0f MB): line-by-line %.2fs '
+                  '(%.0f MB/s), blocks %.2fs (%.0f MB/s), speedup %.1fx, '
+                  'identical output: %s'
+                  % (repr(newline), n_chunks, rows_per_chunk, MBs, dt_old,
+                     MBs/dt_old, dt_new, MBs/dt_new, dt_old/dt_new, same))
+    finally:
+        shutil.rmtree(dname)